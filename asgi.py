@@ -0,0 +1,254 @@
+"""
+    ASGI deployment of the API. Reads that clients poll (users and trip listings, participants, chat
+    membership and messages) and chat subscriptions run as coroutines reading SQLite through aiosqlite,
+    so idle Server-Sent Events connections and slow clients cost no thread. Every other route, the
+    streamed (NDJSON) variants and all writes are served by the Flask app of server.py on a thread pool,
+    SQLite takes one writer at a time anyway. URLs and JSON bodies are the same as with server.py.
+    Run: python asgi.py, or any ASGI server with asgi:app
+"""
+import asyncio
+import re
+from contextlib import asynccontextmanager
+
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import quote_etag
+
+import config
+from db import aio
+from db.migrations import migrate_database
+from server import app as wsgi_app, parse_message_id, server_sent_event, token_error
+from services.broker import SubscriptionClosed, TooManySubscribers, chat_broker
+from services.conditional import cache_control, etag_matches, make_etag
+from services.membership_cache import membership_cache
+from services.metrics import metrics
+from services.pagination import InvalidPageParameter, encode_cursor, page_params
+from services.streaming import accepted_stream_mode
+
+wsgi = WSGIMiddleware(wsgi_app, workers=config.ASGI_WSGI_THREADS)
+
+
+class ServedByWsgi:
+    """
+        Response handing the request over to the Flask app, for variants the async routes don't implement.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await wsgi(scope, receive, send)
+
+
+def json_response(content, status_code=201, headers=None):
+    return JSONResponse(content, status_code=status_code, headers=headers)
+
+
+def token_checked(endpoint):
+    async def checked(request):
+        error = token_error(request.headers.get('authorization', ''), request.path_params['username'])
+        if error is not None:
+            return json_response(error[0], error[1])
+        return await endpoint(request)
+    return checked
+
+
+# status sent by the exception handlers of app
+ERROR_STATUS = {InvalidPageParameter: '422', TooManySubscribers: '503'}
+
+
+def measured(path, endpoint):
+    """
+        Metrics of requests an async route answers itself, under the route name of the Flask rule for the same
+        URL. Requests handed over to the Flask app are measured there; streams until they start.
+    """
+    rule = re.sub(r'\{(\w+)(?::(\w+))?\}', lambda m: '<%s:%s>' % (m.group(2) or 'string', m.group(1)), path)
+
+    async def timed(request):
+        state = metrics.begin_request(request.method, rule, request.url.path)
+        try:
+            response = await endpoint(request)
+        except BaseException as error:
+            state.status = ERROR_STATUS.get(type(error), '500')
+            metrics.end_request(state)
+            raise
+        if not isinstance(response, ServedByWsgi):
+            state.status = str(response.status_code)
+            state.size = len(getattr(response, 'body', b''))
+            metrics.end_request(state)
+        return response
+
+    return timed if metrics.enabled else endpoint
+
+
+def unless_profiled(endpoint):
+    """
+        Requests asking for a profile go to the Flask app, which profiles them (services/profiling.py).
+    """
+    async def checked(request):
+        if 'x-profile' in request.headers or 'profile' in request.query_params:
+            return ServedByWsgi()
+        return await endpoint(request)
+    return checked if config.ADMIN_SECRET else endpoint
+
+
+def route(path, endpoint):
+    return Route(path, measured(path, unless_profiled(endpoint)), methods=['GET'])
+
+
+def etag_headers(etag, private=True):
+    return {'ETag': quote_etag(etag, weak=True), 'Cache-Control': cache_control(private)}
+
+
+def not_modified(request, etag, private=True):
+    if not etag_matches(request.headers.get('if-none-match'), etag):
+        return None
+    return Response(status_code=304, headers=etag_headers(etag, private))
+
+
+def next_cursor_headers(headers, next_key):
+    if next_key is not None:
+        headers['X-Next-Cursor'] = encode_cursor(next_key)
+    return headers
+
+
+async def can_join_chat(username, trip_id):
+    is_member = membership_cache.get(trip_id, username)
+    if is_member is None:
+        generation = membership_cache.generation()
+        is_member = await aio.is_chat_member(username, trip_id)
+        membership_cache.set(trip_id, username, is_member, generation)
+    return is_member
+
+
+async def get_users(request):
+    if accepted_stream_mode(request.headers.get('accept')) is not None:
+        return ServedByWsgi()
+    limit, after = page_params(request.query_params, str)
+    etag = make_etag('users', await aio.users_version(), request.scope['query_string'])
+    cached = not_modified(request, etag, private=False)
+    if cached is not None:
+        return cached
+    users, next_key = await aio.users_page(limit, after)
+    next_cursor = encode_cursor(next_key) if next_key is not None else None
+    return json_response({'Users': [{'username': u} for u in users], 'next_cursor': next_cursor},
+                         headers=next_cursor_headers(etag_headers(etag, private=False), next_key))
+
+
+def trip_listing(resource, owned):
+    async def get_trips(request):
+        if accepted_stream_mode(request.headers.get('accept')) is not None:
+            return ServedByWsgi()
+        username = request.path_params['username']
+        limit, after = page_params(request.query_params)
+        version = await aio.user_version(username)
+        if version is None:
+            return json_response({'Response': 'Incorrect username'}, 400)
+        etag = make_etag(resource, version, request.scope['query_string'])
+        cached = not_modified(request, etag)
+        if cached is not None:
+            return cached
+        trips, next_key = await aio.trip_summaries_page(username, owned, limit, after)
+        return json_response(trips, headers=next_cursor_headers(etag_headers(etag), next_key))
+    return get_trips
+
+
+async def get_participants(request):
+    trip_id = request.path_params['trip_id']
+    version = await aio.trip_version(trip_id)
+    if version is None:
+        return json_response({'Response': 'Incorrect trip_id '}, 400)
+    etag = make_etag('participants', version, request.scope['query_string'])
+    cached = not_modified(request, etag, private=False)
+    if cached is not None:
+        return cached
+    return json_response({'Participants': await aio.trip_participants(trip_id)},
+                         headers=etag_headers(etag, private=False))
+
+
+async def join_chat(request):
+    if not await can_join_chat(request.path_params['username'], request.path_params['trip_id']):
+        return json_response({'Response': 'Can not join to this chat'}, 403)
+    return json_response({'Response': 'OK'})
+
+
+async def get_messages(request):
+    username, trip_id = request.path_params['username'], request.path_params['trip_id']
+    limit, _ = page_params(request.query_params)
+    after = parse_message_id(request.query_params.get('after')) or 0
+    if not await can_join_chat(username, trip_id):
+        return json_response({'Response': 'Can not join to this chat'}, 403)
+    return json_response({'Messages': await aio.trip_messages(trip_id, after, limit)})
+
+
+async def subscribe_messages(request):
+    username, trip_id = request.path_params['username'], request.path_params['trip_id']
+    after = parse_message_id(request.headers.get('last-event-id') or request.query_params.get('after'))
+    if not await can_join_chat(username, trip_id):
+        return json_response({'Response': 'Can not join to this chat'}, 403)
+    subscription = chat_broker.subscribe(trip_id, loop=asyncio.get_running_loop())
+    try:
+        missed = await aio.trip_messages(trip_id, after, config.PAGE_SIZE_MAX) if after is not None else []
+    except Exception:
+        subscription.close()
+        raise
+
+    async def generate():
+        last_id = after or 0
+        try:
+            for message in missed:
+                last_id = message['message_id']
+                yield server_sent_event(message)
+            while True:
+                try:
+                    message = await subscription.get(timeout=config.CHAT_HEARTBEAT)
+                except SubscriptionClosed:
+                    yield 'event: overflow\ndata: {}\n\n'
+                    return
+                if message is None:
+                    if not await can_join_chat(username, trip_id):
+                        return
+                    yield ': keep-alive\n\n'
+                elif message['message_id'] > last_id:
+                    last_id = message['message_id']
+                    yield server_sent_event(message)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def invalid_page_parameter(request, error):
+    return json_response({'error': 'Invalid limit or cursor'}, 422)
+
+
+async def server_busy(request, error):
+    return json_response({'error': 'Server busy, try again later'}, 503)
+
+
+@asynccontextmanager
+async def lifespan(application):
+    await aio.database.warm()
+    yield
+    await aio.database.close()
+
+
+app = Starlette(
+    routes=[
+        route('/api/users', get_users),
+        route('/api/user/{username}/trips', token_checked(trip_listing('trips', owned=True))),
+        route('/api/user/{username}/all-trips', token_checked(trip_listing('all-trips', owned=False))),
+        route('/api/trip/{trip_id:int}/participants', get_participants),
+        route('/api/user/{username}/join-chat/{trip_id:int}', token_checked(join_chat)),
+        route('/api/user/{username}/trip/{trip_id:int}/messages', token_checked(get_messages)),
+        route('/api/user/{username}/trip/{trip_id:int}/messages/stream', token_checked(subscribe_messages)),
+        Mount('/', app=wsgi),
+    ],
+    exception_handlers={InvalidPageParameter: invalid_page_parameter, TooManySubscribers: server_busy},
+    lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    migrate_database()
+    uvicorn.run(app, host=config.HOST, port=config.PORT, log_level='info')
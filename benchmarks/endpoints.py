@@ -0,0 +1,429 @@
+"""
+    Latency, throughput and SQL statements per request of every route of server.py under concurrent clients.
+    A synthetic dataset (users, trips with random dates and names, participants per trip) is generated into
+    a database file, then each endpoint is driven in turn by --threads clients, through Flask's test client
+    in this process or over HTTP against a server started on the same file (--url). Statements are counted
+    only in-process. Results can be saved as JSON and compared with an earlier run.
+    The chat stream route is left out, its requests don't end.
+    Run: python -m benchmarks.endpoints --users 2000 --trips 10000 --participants 4 --threads 8 --requests 50
+         --output results.json [--compare previous.json]
+    Against a server: python -m benchmarks.endpoints --database /tmp/bench.db --generate-only, start the
+    server with TRIP_DATABASE_URL=sqlite:////tmp/bench.db, then add --url http://127.0.0.1:5000 --no-generate
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import urlsplit
+
+PLACES = ['Warsaw', 'Paris', 'London', 'Cracow', 'Berlin', 'Rome', 'Lisbon', 'Oslo', 'Malta', 'Brussels',
+          'Liverpool', 'Vienna', 'Prague', 'Madrid', 'Athens', 'Dublin']
+KINDS = ['trip', 'weekend', 'holiday', 'conference', 'city break', 'hiking', 'reunion']
+PASSWORD = 'password'
+
+
+def generate(users, trips, participants, seed=0):
+    """
+        Fill a freshly migrated database (config.DATABASE_URL) with db.database's synthetic dataset: users
+        user0.., trips with on average about `participants` participants, skewed towards heavy users.
+    """
+    from db.database import generate_dataset, prepare_database
+
+    prepare_database()
+    generate_dataset(users, trips, participants, seed, password=PASSWORD, places=PLACES, kinds=KINDS)
+
+
+class Dataset:
+    """
+        What the scenarios pick their arguments from, read from the database file.
+    """
+
+    def __init__(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            self.usernames = [u for (u,) in connection.execute('SELECT username FROM users ORDER BY username')]
+            self.trips = connection.execute('SELECT trip_id, owner_name FROM trips ORDER BY trip_id').fetchall()
+            self.participants = connection.execute('SELECT trip_id, username FROM participants').fetchall()
+        finally:
+            connection.close()
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._tokens = {}
+
+    def user(self, rng):
+        return rng.choice(self.usernames)
+
+    def trip(self, rng):
+        return rng.choice(self.trips)
+
+    def member(self, rng):
+        """
+            (trip_id, username) of a participant, or of an owner when there are no participants.
+        """
+        return rng.choice(self.participants) if self.participants else self.trip(rng)
+
+    def new_name(self, prefix):
+        with self._lock:
+            self._sequence += 1
+            return '%s-%d-%d' % (prefix, os.getpid(), self._sequence)
+
+    def auth(self, transport, username, headers=None):
+        """
+            headers plus the Authorization of username, who logs in through transport the first time.
+        """
+        with self._lock:
+            token = self._tokens.get(username)
+        if token is None:
+            _, body, _ = transport.request('POST', '/api/user/login', {'username': username, 'password': PASSWORD})
+            token = _json(body)['token']
+            with self._lock:
+                self._tokens[username] = token
+        return dict(headers or {}, Authorization='Bearer %s' % token)
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, body=None, headers=None):
+        response = self.client.open(url, method=method, json=body, headers=headers or {})
+        data = response.get_data()
+        response.close()
+        return response.status_code, data, response.headers
+
+
+class HttpTransport:
+    """
+        One keep-alive connection per client thread.
+    """
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+    def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, url, body=payload, headers=headers)
+            response = self.connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        return response.status, response.read(), response.headers
+
+
+def _json(data):
+    return json.loads(data.decode('utf-8'))
+
+
+def _create_user(transport, data):
+    username = data.new_name('bench')
+    transport.request('POST', '/api/user/create', {'username': username, 'password': PASSWORD})
+    return username
+
+
+def _create_trip(transport, rng, data, owner):
+    _, body, _ = transport.request('POST', '/api/user/%s/create-trip' % owner, _trip_body(rng, data),
+                                   data.auth(transport, owner))
+    return _json(body)['Trip id']
+
+
+def _trip_body(rng, data):
+    date_from = date(2021, 1, 1) + timedelta(days=rng.randrange(365))
+    return {'trip_name': '%s %s' % (rng.choice(PLACES), rng.choice(KINDS)), 'date_from': str(date_from),
+            'date_to': str(date_from + timedelta(days=rng.randrange(14))),
+            'participants': [data.user(rng) for _ in range(3)]}
+
+
+def _date_window(rng):
+    date_from = date(2020, 1, 1) + timedelta(days=rng.randrange(3 * 365))
+    return 'date_from=%s&date_to=%s' % (date_from, date_from + timedelta(days=30))
+
+
+def _user_request(transport, data, method, username, path, body=None, headers=None):
+    """
+        A request to /api/user/<username>/<path> with username's token.
+    """
+    return method, '/api/user/%s/%s' % (username, path), body, data.auth(transport, username, headers)
+
+
+def _all_trips_not_modified(transport, rng, data):
+    username = data.user(rng)
+    _, _, headers = transport.request('GET', '/api/user/%s/all-trips' % username, None,
+                                      data.auth(transport, username))
+    return _user_request(transport, data, 'GET', username, 'all-trips',
+                         headers={'If-None-Match': headers.get('ETag', '')})
+
+
+def _logout(transport, rng, data):
+    _, body, _ = transport.request('POST', '/api/user/login', {'username': data.user(rng), 'password': PASSWORD})
+    return 'POST', '/api/user/logout', None, {'Authorization': 'Bearer %s' % _json(body)['token']}
+
+
+def _change_password(transport, rng, data):
+    username = _create_user(transport, data)
+    return _user_request(transport, data, 'PUT', username, 'change-password',
+                         {'password': PASSWORD, 'new_password': 'changed'})
+
+
+def _delete_user(transport, rng, data):
+    return _user_request(transport, data, 'DELETE', _create_user(transport, data), 'delete')
+
+
+def _delete_trip(transport, rng, data):
+    owner = data.user(rng)
+    return _user_request(transport, data, 'DELETE', owner, 'trip/%d/delete' % _create_trip(transport, rng, data, owner))
+
+
+def _delete_participants(transport, rng, data):
+    trip_id, owner = data.trip(rng)
+    guest = data.user(rng)
+    transport.request('POST', '/api/user/%s/trip/%d/add-participants' % (owner, trip_id), {'participants': [guest]},
+                      data.auth(transport, owner))
+    return _user_request(transport, data, 'DELETE', owner, 'trip/%d/delete-participants' % trip_id,
+                         {'participants': [guest]})
+
+
+def _user_get(path):
+    """
+        Scenario of a GET of path (formatted with rng) by a random user.
+    """
+    return lambda t, rng, data: _user_request(t, data, 'GET', data.user(rng), path(rng))
+
+
+def _member_request(method, path, body=None):
+    """
+        Scenario of a request to path (formatted with the trip id) by a random participant of the trip.
+    """
+    def scenario(transport, rng, data):
+        trip_id, username = data.member(rng)
+        return _user_request(transport, data, method, username, path % trip_id, body)
+    return scenario
+
+
+def _owner_request(method, path, body):
+    """
+        Scenario of a request to path (formatted with the trip id) by the owner of a random trip.
+    """
+    def scenario(transport, rng, data):
+        trip_id, owner = data.trip(rng)
+        return _user_request(transport, data, method, owner, path % trip_id, body(rng, data))
+    return scenario
+
+
+def _users_cursor(transport, rng, data):
+    from services.pagination import encode_cursor
+    return encode_cursor(data.user(rng))
+
+
+# name -> function (transport, rng, data) -> (method, url, json body, headers) of the measured request;
+# requests the function makes itself set up state and are not measured
+SCENARIOS = {
+    'users': lambda t, rng, data: ('GET', '/api/users', None, None),
+    'users-page': lambda t, rng, data: (
+        'GET', '/api/users?limit=50&cursor=' + _users_cursor(t, rng, data), None, None),
+    'trips': _user_get(lambda rng: 'trips'),
+    'all-trips': _user_get(lambda rng: 'all-trips'),
+    'all-trips-304': _all_trips_not_modified,
+    'all-trips-ndjson': lambda t, rng, data: _user_request(
+        t, data, 'GET', data.user(rng), 'all-trips', headers={'Accept': 'application/x-ndjson'}),
+    'trips-in-range': _user_get(lambda rng: 'trips-in-range?' + _date_window(rng)),
+    'conflicts': _user_get(lambda rng: 'conflicts'),
+    'search': _user_get(lambda rng: 'search?q=' + rng.choice(PLACES)[:4]),
+    'sync': _user_get(lambda rng: 'sync'),
+    'participants': lambda t, rng, data: ('GET', '/api/trip/%d/participants' % data.trip(rng)[0], None, None),
+    'join-chat': _member_request('GET', 'join-chat/%d'),
+    'messages': _member_request('GET', 'trip/%d/messages'),
+    'post-message': _member_request('POST', 'trip/%d/messages', {'text': 'benchmark message'}),
+    'membership-cache-stats': lambda t, rng, data: ('GET', '/api/stats/membership-cache', None, None),
+    'chat-stats': lambda t, rng, data: ('GET', '/api/stats/chat', None, None),
+    'create-user': lambda t, rng, data: (
+        'POST', '/api/user/create', {'username': data.new_name('bench'), 'password': PASSWORD}, None),
+    'login': lambda t, rng, data: ('POST', '/api/user/login', {'username': data.user(rng), 'password': PASSWORD},
+                                   None),
+    'logout': _logout,
+    'change-password': _change_password,
+    'delete-user': _delete_user,
+    'create-trip': lambda t, rng, data: _user_request(
+        t, data, 'POST', data.user(rng), 'create-trip', _trip_body(rng, data)),
+    'update-trip': _owner_request('PUT', 'trip/%d/update', lambda rng, data: {'trip_name': rng.choice(PLACES)}),
+    'delete-trip': _delete_trip,
+    'add-participants': _owner_request('POST', 'trip/%d/add-participants',
+                                       lambda rng, data: {'participants': [data.user(rng)]}),
+    'delete-participants': _delete_participants,
+    'health-live': lambda t, rng, data: ('GET', '/health/live', None, None),
+    'health-ready': lambda t, rng, data: ('GET', '/health/ready', None, None),
+}
+
+
+class StatementCounter:
+    """
+        Counts statements sent by any SQLAlchemy engine, per thread.
+    """
+
+    def __init__(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self._local = threading.local()
+        event.listen(Engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def _client(make_transport, scenario, data, requests, seed, counter, samples, lock):
+    transport = make_transport()
+    rng = random.Random(seed)
+    latencies, statuses, statements, errors = [], {}, 0, 0
+    for _ in range(requests):
+        try:
+            method, url, body, headers = scenario(transport, rng, data)
+            before = counter.count if counter is not None else 0
+            began = time.perf_counter()
+            status, _, _ = transport.request(method, url, body, headers)
+            latencies.append(time.perf_counter() - began)
+            if counter is not None:
+                statements += counter.count - before
+        except Exception:
+            errors += 1
+            continue
+        statuses[status] = statuses.get(status, 0) + 1
+        if status >= 500:
+            errors += 1
+    with lock:
+        samples['latencies'].extend(latencies)
+        samples['statements'] += statements
+        samples['errors'] += errors
+        for status, count in statuses.items():
+            samples['statuses'][str(status)] = samples['statuses'].get(str(status), 0) + count
+
+
+def run_scenario(name, make_transport, data, threads, requests, counter, seed=0):
+    samples = {'latencies': [], 'statements': 0, 'errors': 0, 'statuses': {}}
+    lock = threading.Lock()
+    clients = [threading.Thread(target=_client, args=(make_transport, SCENARIOS[name], data, requests,
+                                                      '%s-%d-%d' % (name, seed, i), counter, samples, lock))
+               for i in range(threads)]
+    began = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - began
+    ordered = sorted(samples['latencies'])
+    done = len(ordered)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {'requests': done, 'errors': samples['errors'], 'status_codes': samples['statuses'],
+            'seconds': round(elapsed, 3), 'requests_per_second': round(done / elapsed, 1) if elapsed else None,
+            'mean_ms': ms(sum(ordered) / done) if done else None, 'p50_ms': ms(percentile(ordered, 0.50)),
+            'p95_ms': ms(percentile(ordered, 0.95)), 'p99_ms': ms(percentile(ordered, 0.99)),
+            'statements_per_request': round(samples['statements'] / done, 2) if counter is not None and done
+            else None}
+
+
+def _format(value, spec):
+    return spec % value if value is not None else '%*s' % (len(spec % 0), '-')
+
+
+def print_results(results, previous=None):
+    print('%-24s %7s %6s %9s %9s %9s %9s %8s%s' % ('endpoint', 'reqs', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+                                                   'p99 ms', 'stmts', '  p95 vs previous' if previous else ''))
+    for name, result in results.items():
+        line = '%-24s %7d %6d %9s %9s %9s %9s %8s' % (
+            name, result['requests'], result['errors'], _format(result['requests_per_second'], '%9.1f'),
+            _format(result['p50_ms'], '%9.2f'), _format(result['p95_ms'], '%9.2f'),
+            _format(result['p99_ms'], '%9.2f'), _format(result['statements_per_request'], '%8.1f'))
+        before = (previous or {}).get(name)
+        if before and before.get('p95_ms') and result['p95_ms'] is not None:
+            line += '  %+7.1f%%' % (100.0 * (result['p95_ms'] - before['p95_ms']) / before['p95_ms'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--trips', type=int, default=10000)
+    parser.add_argument('--participants', type=float, default=4, help='mean participants per trip besides the owner')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='database file, a new temporary one by default')
+    parser.add_argument('--no-generate', action='store_true', help='use the data already in --database')
+    parser.add_argument('--generate-only', action='store_true')
+    parser.add_argument('--url', help='drive a running server instead of the in-process test client')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients per endpoint')
+    parser.add_argument('--requests', type=int, default=50, help='requests per client per endpoint')
+    parser.add_argument('--hash-rounds', type=int, default=1000,
+                        help='password hash rounds of the dataset and the in-process app, '
+                             'the default keeps login and create-user from dominating the run')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON of an earlier run to show p95 changes against')
+    args = parser.parse_args()
+
+    path = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['TRIP_DATABASE_URL'] = 'sqlite:///' + os.path.abspath(path)
+    os.environ['TRIP_PASSWORD_HASH_ROUNDS'] = str(args.hash_rounds)
+    os.environ.setdefault('TRIP_PASSWORD_HASH_WORKERS', '0')
+    if not args.no_generate:
+        began = time.perf_counter()
+        generate(args.users, args.trips, args.participants, args.seed)
+        print('Generated %d users and %d trips in %s in %.1fs' % (args.users, args.trips, path,
+                                                                   time.perf_counter() - began))
+    if args.generate_only:
+        return
+    data = Dataset(path)
+
+    counter = None
+    if args.url:
+        def make_transport():
+            return HttpTransport(args.url)
+    else:
+        import logging
+        import server
+        logging.getLogger(server.app.name).disabled = True
+        counter = StatementCounter()
+
+        def make_transport():
+            return TestClientTransport(server.app)
+
+    results = {}
+    for name in args.scenarios:
+        results[name] = run_scenario(name, make_transport, data, args.threads, args.requests, counter, args.seed)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'target': args.url or 'test-client',
+                       'dataset': {'users': len(data.usernames), 'trips': len(data.trips),
+                                   'participants': len(data.participants)},
+                       'threads': args.threads, 'requests': args.requests, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+    Write throughput of create-trip and add-participants under concurrent clients, for several SQLite profiles.
+    Every profile gets a fresh database; each worker process imports the app with the profile's settings
+    and runs several client threads through Flask's test client.
+    Run: python -m benchmarks.write_throughput --processes 4 --threads 8 --requests 50
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+PROFILES = {
+    'rollback-journal': {'TRIP_SQLITE_JOURNAL_MODE': 'DELETE', 'TRIP_SQLITE_SYNCHRONOUS': 'FULL',
+                         'TRIP_SQLITE_BUSY_TIMEOUT': '0', 'TRIP_WRITE_QUEUE': '0'},
+    'wal': {'TRIP_SQLITE_JOURNAL_MODE': 'WAL', 'TRIP_SQLITE_SYNCHRONOUS': 'NORMAL', 'TRIP_WRITE_QUEUE': '0'},
+    'wal+write-queue': {'TRIP_SQLITE_JOURNAL_MODE': 'WAL', 'TRIP_SQLITE_SYNCHRONOUS': 'NORMAL',
+                        'TRIP_WRITE_QUEUE': '1'},
+}
+
+
+def _prepare(env, users):
+    os.environ.update(env)
+    from db import base
+    from db.migrations import migrate_database
+    from models.User import User
+    from services.hashing import HashingService
+
+    migrate_database()
+    password_hash = HashingService(rounds=1000, workers=0).hash('password')
+    session = base.session_factory()
+    session.bulk_insert_mappings(User, [{'username': 'user%d' % i, 'password_hash': password_hash}
+                                        for i in range(users)])
+    session.commit()
+    session.close()
+
+
+def _client(app, users, requests, counts, lock):
+    from services.tokens import token_service
+
+    client = app.test_client()
+    tokens = {}
+    ok = failed = 0
+    for _ in range(requests):
+        owner = 'user%d' % random.randrange(users)
+        guests = ['user%d' % random.randrange(users) for _ in range(3)]
+        if owner not in tokens:
+            tokens[owner] = {'Authorization': 'Bearer %s' % token_service.issue(owner)}
+        response = client.post('/api/user/%s/create-trip' % owner, headers=tokens[owner],
+                               json={'trip_name': 'bench', 'date_from': '2020-06-01', 'date_to': '2020-06-05',
+                                     'participants': guests[:2]})
+        if response.status_code != 201:
+            failed += 1
+            continue
+        trip_id = response.get_json()['Trip id']
+        response = client.post('/api/user/%s/trip/%d/add-participants' % (owner, trip_id), headers=tokens[owner],
+                               json={'participants': guests[2:]})
+        if response.status_code == 201:
+            ok += 2
+        else:
+            ok += 1
+            failed += 1
+    with lock:
+        counts[0] += ok
+        counts[1] += failed
+
+
+def _worker(env, threads, requests, users, start, results):
+    os.environ.update(env)
+    import logging
+    import server
+    logging.getLogger(server.app.name).disabled = True
+
+    counts = [0, 0]
+    lock = threading.Lock()
+    clients = [threading.Thread(target=_client, args=(server.app, users, requests, counts, lock))
+               for _ in range(threads)]
+    start.wait()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    results.put(counts)
+
+
+def run_profile(name, processes, threads, requests, users):
+    ctx = multiprocessing.get_context('spawn')
+    directory = tempfile.mkdtemp()
+    env = dict(PROFILES[name], TRIP_DATABASE_URL='sqlite:///' + os.path.join(directory, 'bench.db'),
+               TRIP_PASSWORD_HASH_WORKERS='0')
+    prepare = ctx.Process(target=_prepare, args=(env, users))
+    prepare.start()
+    prepare.join()
+
+    start = ctx.Event()
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(env, threads, requests, users, start, results))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    time.sleep(2)
+    began = time.perf_counter()
+    start.set()
+    ok = failed = 0
+    for _ in workers:
+        worker_ok, worker_failed = results.get()
+        ok += worker_ok
+        failed += worker_failed
+    elapsed = time.perf_counter() - began
+    for worker in workers:
+        worker.join()
+    return {'profile': name, 'writes': ok, 'failed': failed, 'seconds': round(elapsed, 2),
+            'writes_per_second': round(ok / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help='create-trip calls per client thread')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    args = parser.parse_args()
+
+    print('%-18s %8s %8s %8s %10s' % ('profile', 'writes', 'failed', 'seconds', 'writes/s'))
+    for name in args.profiles:
+        result = run_profile(name, args.processes, args.threads, args.requests, args.users)
+        print('%-18s %8d %8d %8.2f %10.1f' % (name, result['writes'], result['failed'], result['seconds'],
+                                              result['writes_per_second']))
+
+
+if __name__ == '__main__':
+    main()
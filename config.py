@@ -0,0 +1,84 @@
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DATABASE_URL = os.environ.get('TRIP_DATABASE_URL',
+                              'sqlite:///' + os.path.join(BASE_DIR, 'trip_communicator.db'))
+
+DB_POOL_SIZE = int(os.environ.get('TRIP_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('TRIP_DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('TRIP_DB_POOL_RECYCLE', 3600))
+DB_POOL_PRE_PING = os.environ.get('TRIP_DB_POOL_PRE_PING', '1') == '1'
+
+PASSWORD_HASH_SCHEME = os.environ.get('TRIP_PASSWORD_HASH_SCHEME', 'sha512_crypt')
+PASSWORD_HASH_ROUNDS = int(os.environ.get('TRIP_PASSWORD_HASH_ROUNDS', 656000))
+PASSWORD_HASH_WORKERS = int(os.environ.get('TRIP_PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('TRIP_PASSWORD_HASH_MAX_PENDING', 8 * PASSWORD_HASH_WORKERS))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get('TRIP_PASSWORD_HASH_QUEUE_TIMEOUT', 5))
+
+SECRET_KEY = os.environ.get('TRIP_SECRET_KEY') or os.urandom(32).hex()
+TOKEN_TTL = int(os.environ.get('TRIP_TOKEN_TTL', 3600))
+REQUIRE_TOKEN = os.environ.get('TRIP_REQUIRE_TOKEN', '1') == '1'
+
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('TRIP_MEMBERSHIP_CACHE_SIZE', 100000))
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('TRIP_MEMBERSHIP_CACHE_TTL', 300))
+
+PAGE_SIZE_DEFAULT = int(os.environ.get('TRIP_PAGE_SIZE_DEFAULT', 100))
+PAGE_SIZE_MAX = int(os.environ.get('TRIP_PAGE_SIZE_MAX', 1000))
+
+STREAM_BATCH_SIZE = int(os.environ.get('TRIP_STREAM_BATCH_SIZE', 500))
+
+SQLITE_JOURNAL_MODE = os.environ.get('TRIP_SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('TRIP_SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('TRIP_SQLITE_BUSY_TIMEOUT', 5000))
+SQLITE_MMAP_SIZE = int(os.environ.get('TRIP_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE = int(os.environ.get('TRIP_SQLITE_CACHE_SIZE', -64 * 1024))
+
+WRITE_QUEUE_ENABLED = os.environ.get('TRIP_WRITE_QUEUE', '0') == '1'
+WRITE_QUEUE_MAX_BATCH = int(os.environ.get('TRIP_WRITE_QUEUE_MAX_BATCH', 64))
+WRITE_QUEUE_MAX_WAIT = float(os.environ.get('TRIP_WRITE_QUEUE_MAX_WAIT', 0.002))
+
+CHAT_SUBSCRIBER_QUEUE = int(os.environ.get('TRIP_CHAT_SUBSCRIBER_QUEUE', 100))
+CHAT_MAX_SUBSCRIBERS = int(os.environ.get('TRIP_CHAT_MAX_SUBSCRIBERS', 10000))
+CHAT_HEARTBEAT = float(os.environ.get('TRIP_CHAT_HEARTBEAT', 15))
+
+# max-age sent with ETagged responses, 0 makes clients revalidate every time
+HTTP_CACHE_MAX_AGE = int(os.environ.get('TRIP_HTTP_CACHE_MAX_AGE', 0))
+
+HOST = os.environ.get('TRIP_HOST', '0.0.0.0')
+PORT = int(os.environ.get('TRIP_PORT', 5000))
+# aiosqlite connections of the async read routes and threads running the WSGI routes under asgi.py
+AIO_DB_CONNECTIONS = int(os.environ.get('TRIP_AIO_DB_CONNECTIONS', 8))
+ASGI_WSGI_THREADS = int(os.environ.get('TRIP_ASGI_WSGI_THREADS', 32))
+
+# Production server (serve.py): worker processes, load the app before forking, seconds to drain on stop
+WORKERS = int(os.environ.get('TRIP_WORKERS', os.cpu_count() or 1))
+PRELOAD = os.environ.get('TRIP_PRELOAD', '1') == '1'
+GRACEFUL_TIMEOUT = float(os.environ.get('TRIP_GRACEFUL_TIMEOUT', 30))
+LISTEN_BACKLOG = int(os.environ.get('TRIP_LISTEN_BACKLOG', 2048))
+# Seconds between polls of new chat messages when several workers run, see db/chat_relay.py
+CHAT_RELAY_INTERVAL = float(os.environ.get('TRIP_CHAT_RELAY_INTERVAL', 0.2))
+# Seconds between polls of token revocations and membership changes of other workers, see db/invalidations.py
+INVALIDATION_RELAY_INTERVAL = float(os.environ.get('TRIP_INVALIDATION_RELAY_INTERVAL', 0.2))
+
+# Request and SQL metrics served on /metrics, statements slower than TRIP_SLOW_QUERY_MS are logged
+METRICS = os.environ.get('TRIP_METRICS', '1') == '1'
+SLOW_QUERY_MS = float(os.environ.get('TRIP_SLOW_QUERY_MS', 100))
+# Directory where each worker of serve.py leaves its metrics for /metrics to add up, a temporary one when unset,
+# and the seconds between writes
+METRICS_DIR = os.environ.get('TRIP_METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('TRIP_METRICS_FLUSH_INTERVAL', 1))
+# Slowest requests kept with their SQL for /api/admin/slow-requests, over the last one or two windows of seconds
+SLOW_REQUESTS = int(os.environ.get('TRIP_SLOW_REQUESTS', 20))
+SLOW_REQUESTS_WINDOW = float(os.environ.get('TRIP_SLOW_REQUESTS_WINDOW', 3600))
+
+# Secret of the X-Admin-Secret header of /api/admin routes and of profiling, the routes are off while it is unset
+ADMIN_SECRET = os.environ.get('TRIP_ADMIN_SECRET', '')
+# Profiles of requests sent with X-Profile kept in memory, and the directory they are also saved to as .prof files
+PROFILE_KEEP = int(os.environ.get('TRIP_PROFILE_KEEP', 20))
+PROFILE_DIR = os.environ.get('TRIP_PROFILE_DIR', '')
+
+# Most operations accepted by one /api/batch request
+BATCH_MAX_OPERATIONS = int(os.environ.get('TRIP_BATCH_MAX_OPERATIONS', 50))
+# Rows inserted per transaction by the NDJSON import, see db/transfer.py
+IMPORT_BATCH_SIZE = int(os.environ.get('TRIP_IMPORT_BATCH_SIZE', 10000))
@@ -0,0 +1,145 @@
+"""
+    Read-only SQLite access for the async routes of asgi.py through aiosqlite, which runs every connection
+    in its own thread so queries don't block the event loop. Connections are opened with the same pragmas
+    as the engine's plus query_only, writes stay on the SQLAlchemy session in server.py. WAL lets these
+    readers run next to the writer.
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import aiosqlite
+from sqlalchemy.engine.url import make_url
+
+import config
+from db.base import sqlite_pragmas
+from db.sync import USERS_SEQUENCE
+from services.metrics import metrics
+
+
+class AsyncDatabase:
+    def __init__(self, url=None, size=config.AIO_DB_CONNECTIONS):
+        self.url = url
+        self.size = size
+        self._idle = None
+        self._connections = []
+
+    async def _connect(self):
+        connection = await aiosqlite.connect(make_url(self.url or config.DATABASE_URL).database)
+        connection.row_factory = aiosqlite.Row
+        for pragma in sqlite_pragmas() + ['PRAGMA query_only = ON']:
+            await connection.execute(pragma)
+        return connection
+
+    async def _acquire(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                self._idle.put_nowait(None)
+        connection = await self._idle.get()
+        if connection is None:
+            try:
+                connection = await self._connect()
+            except Exception:
+                self._idle.put_nowait(None)
+                raise
+            self._connections.append(connection)
+        return connection
+
+    async def warm(self):
+        connections = [await self._acquire() for _ in range(self.size)]
+        for connection in connections:
+            self._idle.put_nowait(connection)
+
+    async def fetch_all(self, sql, params=()):
+        connection = await self._acquire()
+        started = time.perf_counter()
+        try:
+            async with connection.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._idle.put_nowait(connection)
+            if metrics.enabled:
+                metrics.statement(sql, time.perf_counter() - started)
+
+    async def fetch_one(self, sql, params=()):
+        rows = await self.fetch_all(sql, params)
+        return rows[0] if rows else None
+
+    async def close(self):
+        for connection in self._connections:
+            await connection.close()
+        self._connections = []
+        self._idle = None
+
+
+database = AsyncDatabase()
+
+
+async def users_version():
+    row = await database.fetch_one('SELECT version FROM sync_sequence WHERE sequence_id = ?', (USERS_SEQUENCE,))
+    return row['version'] if row is not None else 0
+
+
+async def user_version(username):
+    row = await database.fetch_one('SELECT version FROM users WHERE username = ?', (username,))
+    return row['version'] if row is not None else None
+
+
+async def trip_version(trip_id):
+    row = await database.fetch_one('SELECT version FROM trips WHERE trip_id = ?', (trip_id,))
+    return row['version'] if row is not None else None
+
+
+async def users_page(limit, after):
+    """
+        Same page as paginate over User.username, (usernames, key of the last one or None on the last page).
+    """
+    rows = await database.fetch_all('SELECT username FROM users WHERE username > ? ORDER BY username LIMIT ?',
+                                    ('' if after is None else after, limit + 1))
+    usernames = [row['username'] for row in rows]
+    return usernames[:limit], usernames[limit - 1] if len(usernames) > limit else None
+
+
+async def trip_summaries_page(username, owned, limit, after):
+    """
+        Rows of /trips (owned) or /all-trips as TripSummary.convert_to_json_for_user,
+        (trips, key of the last one or None on the last page).
+    """
+    rows = await database.fetch_all(
+        'SELECT trip_id, trip_name, date_from, date_to, participants, owner_name, role, participant_count '
+        'FROM trip_summaries WHERE username = ? AND %s AND trip_id > ? ORDER BY trip_id LIMIT ?'
+        % ("role = 'owner'" if owned else 'is_participant'),
+        (username, -1 if after is None else after, limit + 1))
+    trips = [{'trip_id': row['trip_id'], 'trip_name': row['trip_name'],
+              'date_from': str(row['date_from']), 'date_to': str(row['date_to']),
+              'participants': json.loads(row['participants']), 'owner': row['owner_name'],
+              'role': row['role'], 'participant_count': row['participant_count']} for row in rows]
+    return trips[:limit], trips[limit - 1]['trip_id'] if len(trips) > limit else None
+
+
+async def trip_participants(trip_id):
+    rows = await database.fetch_all('SELECT username FROM participants WHERE trip_id = ? ORDER BY participant_id',
+                                    (trip_id,))
+    return [row['username'] for row in rows]
+
+
+async def is_chat_member(username, trip_id):
+    row = await database.fetch_one(
+        'SELECT EXISTS (SELECT 1 FROM participants WHERE trip_id = ? AND username = ?) '
+        'OR EXISTS (SELECT 1 FROM trips WHERE trip_id = ? AND owner_name = ?) AS is_member',
+        (trip_id, username, trip_id, username))
+    return bool(row['is_member'])
+
+
+async def trip_messages(trip_id, after, limit):
+    """
+        As load_messages in server.py, messages in Message.convert_to_json form.
+    """
+    rows = await database.fetch_all(
+        'SELECT message_id, trip_id, username, text, created_at FROM messages '
+        'WHERE trip_id = ? AND message_id > ? ORDER BY message_id LIMIT ?', (trip_id, after, limit))
+    return [{'message_id': row['message_id'], 'trip_id': row['trip_id'], 'username': row['username'],
+             'text': row['text'], 'created_at': datetime.fromisoformat(row['created_at']).isoformat()}
+            for row in rows]
@@ -1,8 +1,65 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 
-engine = create_engine("sqlite:///../trip_communicator.db")
-Session = sessionmaker(bind=engine)
+import config
 
-Base = declarative_base()
\ No newline at end of file
+
+def sqlite_pragmas():
+    return ['PRAGMA foreign_keys = ON',
+            'PRAGMA journal_mode = %s' % config.SQLITE_JOURNAL_MODE,
+            'PRAGMA synchronous = %s' % config.SQLITE_SYNCHRONOUS,
+            'PRAGMA busy_timeout = %d' % config.SQLITE_BUSY_TIMEOUT,
+            'PRAGMA mmap_size = %d' % config.SQLITE_MMAP_SIZE,
+            'PRAGMA cache_size = %d' % config.SQLITE_CACHE_SIZE]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas():
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def make_engine(url=None):
+    url = url or config.DATABASE_URL
+    is_sqlite = url.startswith('sqlite')
+    new_engine = create_engine(url, poolclass=QueuePool,
+                               pool_size=config.DB_POOL_SIZE,
+                               max_overflow=config.DB_MAX_OVERFLOW,
+                               pool_recycle=config.DB_POOL_RECYCLE,
+                               pool_pre_ping=config.DB_POOL_PRE_PING,
+                               connect_args={'check_same_thread': False} if is_sqlite else {})
+    if is_sqlite:
+        event.listen(new_engine, 'connect', set_sqlite_pragmas)
+    return new_engine
+
+
+engine = make_engine()
+session_factory = sessionmaker(bind=engine)
+Session = scoped_session(session_factory)
+
+Base = declarative_base()
+
+
+def warm_pool(size=None):
+    """
+        Open the pool's connections up front, so first requests don't pay for connecting and pragmas.
+    """
+    connections = [engine.connect() for _ in range(size or config.DB_POOL_SIZE)]
+    for connection in connections:
+        connection.close()
+
+
+def init_engine(url=None):
+    """
+        Replace the application engine, e.g. to point at another database file
+        or to get fresh connections in a forked worker process.
+    """
+    global engine
+    Session.remove()
+    engine.dispose()
+    engine = make_engine(url)
+    session_factory.configure(bind=engine)
+    return engine
@@ -0,0 +1,51 @@
+"""
+    One transaction for several route handlers. Inside batch_session() the thread's scoped Session is a
+    BatchSession: handlers' commit() only flushes and close() does nothing, so their changes wait for the
+    batch's own commit. Each operation runs in a savepoint, a handler's rollback() undoes just that operation.
+"""
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session as OrmSession
+
+from db import base
+from db.base import Session
+
+
+class BatchSession(OrmSession):
+    def commit(self):
+        self.flush()
+
+    def close(self):
+        pass
+
+    def commit_batch(self):
+        super().commit()
+
+    def end(self):
+        super().close()
+
+
+def in_batch():
+    return Session.registry.has() and isinstance(Session.registry(), BatchSession)
+
+
+@contextmanager
+def batch_session():
+    """
+        Install a BatchSession as the thread's Session for the block. The caller commits with commit_batch(),
+        anything not committed when the block ends is rolled back.
+    """
+    Session.remove()
+    session = BatchSession(**base.session_factory.kw)
+    Session.registry.set(session)
+    if session.get_bind().dialect.name == 'sqlite':
+        # pysqlite begins no transaction before the first write, the first SAVEPOINT would begin its own and
+        # its RELEASE would commit
+        session.execute(text('BEGIN'))
+    try:
+        yield session
+    finally:
+        session.end()
+        Session.registry.clear()
+
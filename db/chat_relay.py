@@ -0,0 +1,65 @@
+"""
+    Chat delivery across worker processes. Every worker polls the messages table for ids above the last one
+    it has seen and publishes them to its own subscribers, in message_id order, which SQLite's single writer
+    makes the commit order. While the worker has no subscribers a poll only reads max(message_id).
+"""
+import logging
+import threading
+
+from sqlalchemy import func
+
+import config
+from db import base
+from models.Message import Message
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRelay:
+    def __init__(self, broker, interval=config.CHAT_RELAY_INTERVAL, batch_size=config.PAGE_SIZE_MAX):
+        self.broker = broker
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_id = 0
+
+    def start(self):
+        self.broker.relayed = True
+        self._last_id = self._max_id()
+        self._thread = threading.Thread(target=self._run, name='chat-relay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _max_id(self):
+        session = base.session_factory()
+        try:
+            return session.query(func.max(Message.message_id)).scalar() or 0
+        finally:
+            session.close()
+
+    def poll(self):
+        if not self.broker.has_subscribers():
+            self._last_id = self._max_id()
+            return 0
+        session = base.session_factory()
+        try:
+            messages = [m.convert_to_json() for m in session.query(Message).filter(
+                Message.message_id > self._last_id).order_by(Message.message_id).limit(self.batch_size)]
+        finally:
+            session.close()
+        for message in messages:
+            self.broker.publish(message['trip_id'], message)
+            self._last_id = message['message_id']
+        return len(messages)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.poll() == self.batch_size:
+                    continue
+            except Exception:
+                logger.exception('Polling chat messages failed')
+            self._stop.wait(self.interval)
@@ -1,18 +1,50 @@
-from datetime import date
+"""
+    Database setup, a four-user sample (add_initial_values) and a synthetic dataset of any size
+    (generate_dataset) with the sample's queries timed against it (time_queries).
+    Run: python -m db.database --generate --users 1000000 --trips 2000000 --participants 4 --time
+"""
+import argparse
+import math
+import random
+import time
+from collections import namedtuple
+from datetime import date, timedelta
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func, select
 
-from db.base import Base, engine, Session
+from db import base
+from db.base import Session
+from db.intervals import bulk_participant_intervals
+from db.migrations import migrate_database
+from db.search import bulk_trip_search
+from db.summaries import summary_rows
 from models.Participant import Participant
 from models.Trip import Trip
+from models.TripSummary import TripSummary
 from models.User import User
+from services.hashing import HashingService
+
+PLACES = ['Paris', 'Warsaw', 'Cracow', 'Brussels', 'Liverpool', 'Malta', 'London', 'Berlin', 'Rome', 'Lisbon',
+          'Oslo', 'Vienna', 'Prague', 'Madrid', 'Athens', 'Dublin']
+KINDS = ['trip', 'weekend', 'holiday', 'conference', 'city break', 'hiking', 'reunion']
+# Share of owners and participants drawn from the heavy users, whose ranks follow Zipf's law: the busiest
+# user owns about ln 2 / ln(users) of those trips; the rest are drawn uniformly
+HEAVY_USERS_SHARE = 0.5
+# Participants per trip follow a Pareto (Lomax) distribution of this shape, smaller means a longer tail.
+# Every member's summary row lists all participants, so summaries grow with the square of trip sizes
+TRIP_SIZE_SHAPE = 2.0
+MAX_TRIP_SIZE = 100
+# Trips starting in this share fall into the summer season, the rest anywhere in the years generated
+SUMMER_SHARE = 0.6
+FIRST_DAY = date(2019, 1, 1)
+YEARS = 4
+
+_TripRow = namedtuple('_TripRow', 'trip_id trip_name date_from date_to owner_name version')
+_SUMMARY_COLUMNS = [column.name for column in TripSummary.__table__.columns]
 
 
 def run_database():
-    e = create_engine("sqlite:///../trip_communicator.db")
-    Ses = sessionmaker(bind=engine)
-    return e, Ses
+    return base.engine, Session
 
 
 def commit_and_close(session):
@@ -21,9 +53,7 @@ def commit_and_close(session):
 
 
 def prepare_database():
-    Base.metadata.create_all(engine)
-    session = Session()
-    commit_and_close(session)
+    migrate_database(base.engine)
 
 
 def add_initial_values():
@@ -97,7 +127,183 @@ def test_queries():
     commit_and_close(session)
 
 
+class _Users:
+    """
+        Draws user indexes for generate_dataset, HEAVY_USERS_SHARE of them by a Zipf rank. Ranks are spread
+        over the indexes by a stride coprime to their count, so heavy users aren't the first usernames.
+    """
+
+    def __init__(self, count, rng):
+        self.count = count
+        self.rng = rng
+        self.stride = 40503
+        while math.gcd(self.stride, count) != 1:
+            self.stride += 1
+
+    def draw(self):
+        if self.rng.random() < HEAVY_USERS_SHARE:
+            # continuous Zipf with exponent 1: rank = count ** u is log-uniform
+            return int(self.count ** self.rng.random()) * self.stride % self.count
+        return self.rng.randrange(self.count)
+
+
+def _trip_dates(rng):
+    year = FIRST_DAY.replace(year=FIRST_DAY.year + rng.randrange(YEARS))
+    if rng.random() < SUMMER_SHARE:
+        day = min(364, max(0, int(rng.gauss(195, 25))))
+    else:
+        day = rng.randrange(365)
+    date_from = year + timedelta(days=day)
+    return date_from, date_from + timedelta(days=min(27, int(rng.expovariate(1 / 4))))
+
+
+def generate_dataset(users, trips, participants=4.0, seed=0, password='password', places=PLACES, kinds=KINDS,
+                     batch_size=10000, engine=None):
+    """
+        Fill an empty migrated database with users user0.. sharing `password` and trips with on average about
+        `participants` participants each besides the owner, who is a participant of their trips as add_trip
+        makes them. The data is skewed like real data: a few heavy users own and join many trips, trip sizes
+        have a long tail and dates cluster in summers, so that a user's trips overlap. Summary rows are
+        written along with their trips. Rows go in batch_size at a time, one transaction each, through plain
+        DB-API executemany; the search and date indexes are filled once at the end instead of by their
+        triggers, and the password is hashed once.
+    """
+    engine = engine or base.engine
+    rng = random.Random(seed)
+    pick = _Users(users, rng)
+    password_hash = HashingService(workers=0).hash(password)
+    # Lomax scale giving the wanted mean, rounding down taken into account, before the cap
+    scale = (participants + 0.5) * (TRIP_SIZE_SHAPE - 1)
+    max_size = min(MAX_TRIP_SIZE, users // 2)
+    with engine.connect() as connection:
+        if connection.execute(select([func.count()]).select_from(User.__table__)).scalar():
+            raise ValueError('generate_dataset needs an empty database')
+        cursor = connection.connection.cursor()
+        try:
+            for first in range(0, users, batch_size):
+                with connection.begin():
+                    # user_key given, the insert trigger would look up the largest one for each row
+                    cursor.executemany(_insert_sql(User.__table__, ['username', 'password_hash', 'user_key']), [
+                        ('user%d' % i, password_hash, i + 1) for i in range(first, min(users, first + batch_size))])
+            with bulk_trip_search(cursor), bulk_participant_intervals(cursor):
+                for first in range(1, trips + 1, batch_size):
+                    trip_rows, participant_rows = _trip_batch(range(first, min(trips + 1, first + batch_size)),
+                                                              rng, pick, participants and scale, max_size,
+                                                              places, kinds)
+                    with connection.begin():
+                        cursor.executemany(_insert_sql(Trip.__table__, _TripRow._fields), trip_rows)
+                        cursor.executemany(_insert_sql(Participant.__table__, ['trip_id', 'username']),
+                                           participant_rows)
+                        cursor.executemany(_insert_sql(TripSummary.__table__, _SUMMARY_COLUMNS), [
+                            tuple(row[column] for column in _SUMMARY_COLUMNS)
+                            for row in summary_rows(trip_rows, participant_rows)])
+        finally:
+            cursor.close()
+
+
+def _trip_batch(trip_ids, rng, pick, scale, max_size, places, kinds):
+    """
+        (trip rows, (trip_id, username) participant rows) of generate_dataset's trips with the given ids, no
+        participants but the owners when scale is 0.
+    """
+    trip_rows, participant_rows = [], []
+    for trip_id in trip_ids:
+        owner = pick.draw()
+        date_from, date_to = _trip_dates(rng)
+        trip_rows.append(_TripRow(trip_id, '%s %s %d' % (rng.choice(places), rng.choice(kinds), trip_id),
+                                  date_from.isoformat(), date_to.isoformat(), 'user%d' % owner, 0))
+        size = min(max_size, int(scale * (rng.paretovariate(TRIP_SIZE_SHAPE) - 1))) if scale else 0
+        members = set()
+        while len(members) < size:
+            user = pick.draw()
+            if user in members or user == owner:
+                user = rng.randrange(pick.count)
+            if user not in members and user != owner:
+                members.add(user)
+                participant_rows.append((trip_id, 'user%d' % user))
+        # after the invited participants, like add_trip
+        participant_rows.append((trip_id, 'user%d' % owner))
+    return trip_rows, participant_rows
+
+
+def _insert_sql(table, columns):
+    """
+        INSERT of the columns as DB-API parameters, version (not null, defaulted by SQLAlchemy) set to 0.
+    """
+    columns = list(columns)
+    values = ['?'] * len(columns)
+    if 'version' in table.c and 'version' not in columns:
+        columns.append('version')
+        values.append('0')
+    return 'INSERT INTO %s (%s) VALUES (%s)' % (table.name, ', '.join(columns), ', '.join(values))
+
+
+def _timed(session, query, repeat):
+    """
+        (rows, best milliseconds) of loading every row of the query, repeat times.
+    """
+    best, rows = None, 0
+    for _ in range(repeat):
+        session.expunge_all()
+        started = time.perf_counter()
+        rows = sum(1 for _ in query.yield_per(1000))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best * 1000
+
+
+def time_queries(repeat=3):
+    """
+        The queries of test_queries against a dataset of any size, rows loaded but not printed. The heaviest
+        owner stands in for Ala and the largest trip for trip 1.
+    """
+    _, Ses = run_database()
+    session = Ses()
+    heavy_owner = session.query(Trip.owner_name).group_by(Trip.owner_name).\
+        order_by(func.count().desc()).limit(1).scalar()
+    largest_trip = session.query(Participant.trip_id).group_by(Participant.trip_id).\
+        order_by(func.count().desc()).limit(1).scalar()
+    scenarios = [
+        ('All users', session.query(User)),
+        ('All trips', session.query(Trip)),
+        ('All trips starting in June', session.query(Trip).filter(
+            Trip.date_from.between(date(2020, 6, 1), date(2020, 6, 30)))),
+        ('All trips of %s' % heavy_owner, session.query(Trip).join(User, Trip.owner).filter(
+            User.username == heavy_owner)),
+        ('Participants', session.query(Participant)),
+        ('Participants for trip %s' % largest_trip, session.query(Participant).filter(
+            Participant.trip_id == largest_trip)),
+    ]
+    print('%-40s %10s %10s' % ('query', 'rows', 'best ms'))
+    for name, query in scenarios:
+        rows, ms = _timed(session, query, repeat)
+        print('%-40s %10d %10.1f' % (name, rows, ms))
+    commit_and_close(session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--generate', action='store_true', help='fill the empty database with a synthetic dataset')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--trips', type=int, default=2000000)
+    parser.add_argument('--participants', type=float, default=4, help='mean participants per trip besides the owner')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time', action='store_true', help='time the sample queries against the database')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each timed query, the best is shown')
+    args = parser.parse_args()
+
+    if args.generate:
+        prepare_database()
+        began = time.perf_counter()
+        generate_dataset(args.users, args.trips, args.participants, args.seed)
+        print('Generated %d users and %d trips in %.1fs' % (args.users, args.trips, time.perf_counter() - began))
+    if args.time:
+        time_queries(args.repeat)
+    if not args.generate and not args.time:
+        test_queries()
+
+
 if __name__ == '__main__':
     # prepare_database()
     # add_initial_values()
-    test_queries()
+    main()
@@ -0,0 +1,124 @@
+"""
+    Date intervals of participations. participant_intervals is an SQLite R*Tree with one box per
+    participant row, spanning the user's key on one axis and the trip's days on the other, so the trips of
+    one user overlapping a range are found by a tree search instead of a scan of all the user's trips.
+    Triggers on users, trips and participants keep it up to date, deletes included, as they go through
+    ON DELETE CASCADE. Days are julian day numbers, integral so that the rtree_i32 bounds are exact.
+"""
+import heapq
+from contextlib import contextmanager
+
+from sqlalchemy import Column, Integer, MetaData, Table, and_, select
+
+# Not in Base.metadata, create_all can't build virtual tables; created by create_participant_intervals
+participant_intervals = Table('participant_intervals', MetaData(),
+                              Column('participant_id', Integer, primary_key=True),
+                              Column('user_from', Integer),
+                              Column('user_to', Integer),
+                              Column('day_from', Integer),
+                              Column('day_to', Integer),
+                              Column('trip_id', Integer))
+
+# date.toordinal() of the day starting at julian day 1721424.5
+_JULIAN_DAY_OFFSET = 1721424
+
+_DAY_FROM = 'min(CAST(julianday(t.date_from) AS INTEGER), CAST(julianday(t.date_to) AS INTEGER))'
+_DAY_TO = 'max(CAST(julianday(t.date_from) AS INTEGER), CAST(julianday(t.date_to) AS INTEGER))'
+_INSERT_INTERVALS = ('INSERT INTO participant_intervals (participant_id, user_from, user_to, day_from, day_to, '
+                     'trip_id) SELECT p.participant_id, u.user_key, u.user_key, %s, %s, t.trip_id '
+                     'FROM participants p JOIN trips t ON t.trip_id = p.trip_id JOIN users u ON u.username = '
+                     'p.username WHERE t.date_from IS NOT NULL AND t.date_to IS NOT NULL') % (_DAY_FROM, _DAY_TO)
+_CREATE_INSERT_TRIGGER = ('CREATE TRIGGER participant_intervals_insert AFTER INSERT ON participants BEGIN '
+                          '%s AND p.participant_id = NEW.participant_id; END' % _INSERT_INTERVALS)
+
+
+def day_number(day):
+    return day.toordinal() + _JULIAN_DAY_OFFSET
+
+
+def create_participant_intervals(cursor):
+    """
+        Create the R*Tree and its triggers and index the existing participants, on a DB-API cursor.
+        users.user_key must exist.
+    """
+    cursor.execute('CREATE TRIGGER users_user_key AFTER INSERT ON users WHEN NEW.user_key IS NULL BEGIN '
+                   'UPDATE users SET user_key = (SELECT coalesce(max(user_key), 0) + 1 FROM users) '
+                   'WHERE username = NEW.username; END')
+    cursor.execute('CREATE VIRTUAL TABLE participant_intervals USING '
+                   'rtree_i32(participant_id, user_from, user_to, day_from, day_to, +trip_id)')
+    cursor.execute(_CREATE_INSERT_TRIGGER)
+    cursor.execute('CREATE TRIGGER participant_intervals_update AFTER UPDATE OF participant_id, username, trip_id '
+                   'ON participants BEGIN '
+                   'DELETE FROM participant_intervals WHERE participant_id = OLD.participant_id; '
+                   '%s AND p.participant_id = NEW.participant_id; END' % _INSERT_INTERVALS)
+    cursor.execute('CREATE TRIGGER participant_intervals_delete AFTER DELETE ON participants BEGIN '
+                   'DELETE FROM participant_intervals WHERE participant_id = OLD.participant_id; END')
+    cursor.execute('CREATE TRIGGER participant_intervals_trip_dates AFTER UPDATE OF date_from, date_to ON trips '
+                   'BEGIN DELETE FROM participant_intervals WHERE participant_id IN '
+                   '(SELECT participant_id FROM participants WHERE trip_id = NEW.trip_id); '
+                   '%s AND t.trip_id = NEW.trip_id; END' % _INSERT_INTERVALS)
+    cursor.execute(_INSERT_INTERVALS)
+
+
+@contextmanager
+def bulk_participant_intervals(cursor):
+    """
+        Leave participants inserted within the block out of the R*Tree and add them in one statement at its
+        end, which takes about half the time of the insert trigger's row at a time. For bulk loads only,
+        until then the tree misses the new participants. Commits on the cursor's connection at the end.
+    """
+    cursor.execute('DROP TRIGGER participant_intervals_insert')
+    try:
+        yield
+    finally:
+        cursor.execute(_CREATE_INSERT_TRIGGER)
+        cursor.execute('%s AND p.participant_id NOT IN (SELECT participant_id FROM participant_intervals)'
+                       % _INSERT_INTERVALS)
+        cursor.connection.commit()
+
+
+def overlapping_trip_ids(user_key, date_from, date_to):
+    """
+        Select of trip_id of the user's participations with at least one day in [date_from, date_to].
+    """
+    return select([participant_intervals.c.trip_id]).where(and_(
+        participant_intervals.c.user_from <= user_key, participant_intervals.c.user_to >= user_key,
+        participant_intervals.c.day_from <= day_number(date_to),
+        participant_intervals.c.day_to >= day_number(date_from)))
+
+
+def _trip_key(date_from, date_to, trip_id):
+    return date_from.toordinal(), date_to.toordinal(), trip_id
+
+
+def find_conflicts(trips, limit=None, after=None):
+    """
+        trips: (trip_id, date_from, date_to). Sweeps the days in order keeping the trips still in progress on
+        a heap by their end, so it costs O(n log n + conflicts) instead of comparing all pairs. Conflicts are
+        (first trip_id, second trip_id, first common day, last common day), dates inclusive, ordered by the
+        second trip and then the first, each trip by (start, end, trip_id). Returns up to limit of them after
+        the key after, and the key of the last one returned when more follow, else None. A key is the six
+        ints of both trips' (start ordinal, end ordinal, trip_id), second trip first.
+    """
+    intervals = sorted((min(date_from, date_to), max(date_from, date_to), trip_id)
+                       for trip_id, date_from, date_to in trips if date_from is not None and date_to is not None)
+    after = tuple(after) if after is not None else None
+    conflicts = []
+    last_key = None
+    in_progress = []
+    for date_from, date_to, trip_id in intervals:
+        while in_progress and in_progress[0][0] < date_from:
+            heapq.heappop(in_progress)
+        second_key = _trip_key(date_from, date_to, trip_id)
+        # trips before the cursor's second trip only feed the heap
+        if after is None or second_key >= after[:3]:
+            for other_from, other_to, other_id in sorted((f, t, i) for t, f, i in in_progress):
+                key = second_key + _trip_key(other_from, other_to, other_id)
+                if after is not None and key <= after:
+                    continue
+                if limit is not None and len(conflicts) == limit:
+                    return conflicts, last_key
+                conflicts.append((other_id, trip_id, date_from, min(date_to, other_to)))
+                last_key = key
+        heapq.heappush(in_progress, (date_to, date_from, trip_id))
+    return conflicts, None
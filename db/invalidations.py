@@ -0,0 +1,109 @@
+"""
+    Token revocations and membership cache invalidations shared by worker processes. A write adds rows to the
+    invalidations table in its own transaction and applies them to its process at once; every worker's
+    InvalidationRelay polls the table for ids above the last one it has seen and applies them to its own
+    TokenService and MembershipCache, like db/chat_relay.py does for chat messages. A starting worker first
+    applies every row still kept. Rows live until the tokens they revoke expire, membership rows for the
+    cache TTL, and expired ones are deleted by later writes.
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import and_
+
+import config
+from db import base
+from models.Invalidation import Invalidation
+
+logger = logging.getLogger(__name__)
+
+# kinds of rows: subject is the token's jti, a username whose tokens issued up to `at` are revoked, the trip_id
+# or username whose memberships changed, or '' when the whole membership cache is to be dropped
+TOKEN = 'token'
+USER_TOKENS = 'user_tokens'
+TRIP_MEMBERS = 'trip_members'
+USER_MEMBERS = 'user_members'
+ALL_MEMBERS = 'all_members'
+
+
+def _add(session, rows):
+    now = time.time()
+    session.query(Invalidation).filter(Invalidation.expires_at < now).delete(synchronize_session=False)
+    session.bulk_insert_mappings(Invalidation, rows)
+
+
+def add_token_revocation(session, claims):
+    _add(session, [{'kind': TOKEN, 'subject': claims['jti'], 'at': time.time(), 'expires_at': claims['exp']}])
+
+
+def add_user_revocation(session, username, at, ttl=config.TOKEN_TTL):
+    _add(session, [{'kind': USER_TOKENS, 'subject': username, 'at': at, 'expires_at': at + ttl}])
+
+
+def add_membership_changes(session, trip_ids=(), usernames=(), everything=False, ttl=config.MEMBERSHIP_CACHE_TTL):
+    """
+        Within the caller's transaction: memberships of the trips and users changed, or of everyone.
+    """
+    now = time.time()
+    subjects = [(TRIP_MEMBERS, str(int(trip_id))) for trip_id in trip_ids] + \
+        [(USER_MEMBERS, username) for username in usernames] + ([(ALL_MEMBERS, '')] if everything else [])
+    _add(session, [{'kind': kind, 'subject': subject, 'at': now, 'expires_at': now + ttl}
+                   for kind, subject in subjects])
+
+
+class InvalidationRelay:
+    def __init__(self, tokens, cache, interval=config.INVALIDATION_RELAY_INTERVAL,
+                 batch_size=config.PAGE_SIZE_MAX):
+        self.tokens = tokens
+        self.cache = cache
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_id = 0
+
+    def start(self):
+        while self.poll() == self.batch_size:
+            pass
+        self._thread = threading.Thread(target=self._run, name='invalidation-relay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def poll(self):
+        session = base.session_factory()
+        try:
+            rows = session.query(Invalidation.invalidation_id, Invalidation.kind, Invalidation.subject,
+                                 Invalidation.at, Invalidation.expires_at).filter(and_(
+                                     Invalidation.invalidation_id > self._last_id,
+                                     Invalidation.expires_at >= time.time())).\
+                order_by(Invalidation.invalidation_id).limit(self.batch_size).all()
+        finally:
+            session.close()
+        for row in rows:
+            self.apply(row.kind, row.subject, row.at, row.expires_at)
+            self._last_id = row.invalidation_id
+        return len(rows)
+
+    def apply(self, kind, subject, at, expires_at):
+        if kind == TOKEN:
+            self.tokens.revoke_id(subject, expires_at)
+        elif kind == USER_TOKENS:
+            self.tokens.revoke_user(subject, at)
+        elif kind == TRIP_MEMBERS:
+            self.cache.invalidate_trip(int(subject))
+        elif kind == USER_MEMBERS:
+            self.cache.invalidate_user(subject)
+        elif kind == ALL_MEMBERS:
+            self.cache.clear()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.poll() == self.batch_size:
+                    continue
+            except Exception:
+                logger.exception('Polling invalidations failed')
+            self._stop.wait(self.interval)
@@ -0,0 +1,271 @@
+"""
+    Schema migrations for existing SQLite databases. The schema version is kept in PRAGMA user_version.
+    A database without tables is created from the models and SCHEMA_EXTRAS and marked with the latest version.
+    Data migrations need the whole schema, so they run after the last schema migration. Each is recorded in
+    pending_data_migrations along with its schema migration and removed once it finished, a run stopped by a
+    failure in between leaves it to the next one.
+    Run: python -m db.migrations
+"""
+from db import base
+from db.base import Base
+from db.intervals import create_participant_intervals
+from db.search import create_trip_search
+from db.summaries import rebuild_trip_summaries
+from models.Invalidation import Invalidation  # noqa: F401 (registers the table)
+from models.Message import Message  # noqa: F401
+from models.Participant import Participant  # noqa: F401
+from models.SyncTombstone import SyncTombstone  # noqa: F401
+from models.Trip import Trip  # noqa: F401
+from models.TripSummary import TripSummary  # noqa: F401
+from models.User import User  # noqa: F401
+
+
+def _rebuild_table(cursor, table, create_sql, insert_sql, index_sql):
+    """
+        SQLite can't change column types or add constraints, so the table is renamed, created again and
+        filled from the old one. legacy_alter_table keeps foreign keys of other tables pointing at the name.
+    """
+    for (index,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                   "AND sql IS NOT NULL", (table,)).fetchall():
+        cursor.execute('DROP INDEX "%s"' % index)
+    cursor.execute('ALTER TABLE %s RENAME TO _%s_old' % (table, table))
+    cursor.execute(create_sql)
+    cursor.execute(insert_sql)
+    cursor.execute('DROP TABLE _%s_old' % table)
+    for sql in index_sql:
+        cursor.execute(sql)
+
+
+def _typed_columns_and_participant_constraints(cursor):
+    _rebuild_table(
+        cursor, 'trips',
+        'CREATE TABLE trips (trip_id INTEGER NOT NULL, trip_name VARCHAR, date_from DATE, date_to DATE, '
+        'owner_name VARCHAR, PRIMARY KEY (trip_id), FOREIGN KEY(owner_name) REFERENCES users (username))',
+        'INSERT INTO trips (trip_id, trip_name, date_from, date_to, owner_name) '
+        'SELECT trip_id, trip_name, date_from, date_to, owner_name FROM _trips_old',
+        ['CREATE INDEX ix_trips_trip_name ON trips (trip_name)',
+         'CREATE INDEX ix_trips_date_from ON trips (date_from)',
+         'CREATE INDEX ix_trips_owner_name ON trips (owner_name)'])
+    _rebuild_table(
+        cursor, 'participants',
+        'CREATE TABLE participants (participant_id INTEGER NOT NULL, username VARCHAR, trip_id INTEGER, '
+        'PRIMARY KEY (participant_id), '
+        'CONSTRAINT uq_participants_trip_id_username UNIQUE (trip_id, username), '
+        'FOREIGN KEY(username) REFERENCES users (username), FOREIGN KEY(trip_id) REFERENCES trips (trip_id))',
+        'INSERT INTO participants (participant_id, username, trip_id) '
+        'SELECT MIN(participant_id), username, trip_id FROM _participants_old GROUP BY trip_id, username',
+        ['CREATE INDEX ix_participants_username ON participants (username)'])
+
+
+def _cascading_foreign_keys(cursor):
+    cursor.execute('DELETE FROM trips WHERE owner_name NOT IN (SELECT username FROM users)')
+    cursor.execute('DELETE FROM participants WHERE username NOT IN (SELECT username FROM users) '
+                   'OR trip_id NOT IN (SELECT trip_id FROM trips)')
+    _rebuild_table(
+        cursor, 'trips',
+        'CREATE TABLE trips (trip_id INTEGER NOT NULL, trip_name VARCHAR, date_from DATE, date_to DATE, '
+        'owner_name VARCHAR, PRIMARY KEY (trip_id), '
+        'FOREIGN KEY(owner_name) REFERENCES users (username) ON DELETE CASCADE)',
+        'INSERT INTO trips (trip_id, trip_name, date_from, date_to, owner_name) '
+        'SELECT trip_id, trip_name, date_from, date_to, owner_name FROM _trips_old',
+        ['CREATE INDEX ix_trips_trip_name ON trips (trip_name)',
+         'CREATE INDEX ix_trips_date_from ON trips (date_from)',
+         'CREATE INDEX ix_trips_owner_name ON trips (owner_name)'])
+    _rebuild_table(
+        cursor, 'participants',
+        'CREATE TABLE participants (participant_id INTEGER NOT NULL, username VARCHAR, trip_id INTEGER, '
+        'PRIMARY KEY (participant_id), '
+        'CONSTRAINT uq_participants_trip_id_username UNIQUE (trip_id, username), '
+        'FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE, '
+        'FOREIGN KEY(trip_id) REFERENCES trips (trip_id) ON DELETE CASCADE)',
+        'INSERT INTO participants (participant_id, username, trip_id) '
+        'SELECT participant_id, username, trip_id FROM _participants_old',
+        ['CREATE INDEX ix_participants_username ON participants (username)'])
+
+
+def _messages(cursor):
+    cursor.execute('CREATE TABLE messages (message_id INTEGER NOT NULL, trip_id INTEGER NOT NULL, '
+                   'username VARCHAR NOT NULL, text VARCHAR NOT NULL, created_at DATETIME NOT NULL, '
+                   'PRIMARY KEY (message_id), '
+                   'FOREIGN KEY(trip_id) REFERENCES trips (trip_id) ON DELETE CASCADE, '
+                   'FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE)')
+    cursor.execute('CREATE INDEX ix_messages_trip_id_created_at ON messages (trip_id, created_at)')
+
+
+def _trip_summaries(cursor):
+    cursor.execute('CREATE TABLE trip_summaries (username VARCHAR NOT NULL, trip_id INTEGER NOT NULL, '
+                   'role VARCHAR NOT NULL, is_participant BOOLEAN NOT NULL, trip_name VARCHAR, date_from DATE, '
+                   'date_to DATE, owner_name VARCHAR, participant_count INTEGER NOT NULL, '
+                   'participants VARCHAR NOT NULL, PRIMARY KEY (username, trip_id), '
+                   'FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE, '
+                   'FOREIGN KEY(trip_id) REFERENCES trips (trip_id) ON DELETE CASCADE)')
+    cursor.execute('CREATE INDEX ix_trip_summaries_trip_id ON trip_summaries (trip_id)')
+
+
+def _sync_versions(cursor):
+    for table in ('trips', 'participants'):
+        cursor.execute('ALTER TABLE %s ADD COLUMN version INTEGER NOT NULL DEFAULT 0' % table)
+        cursor.execute('ALTER TABLE %s ADD COLUMN updated_at DATETIME' % table)
+    cursor.execute('ALTER TABLE trip_summaries ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX ix_trip_summaries_username_version ON trip_summaries (username, version)')
+    cursor.execute('CREATE TABLE sync_sequence (sequence_id INTEGER NOT NULL, version INTEGER NOT NULL, '
+                   'PRIMARY KEY (sequence_id))')
+    cursor.execute('INSERT INTO sync_sequence (sequence_id, version) VALUES (1, 0)')
+    cursor.execute('CREATE TABLE sync_tombstones (tombstone_id INTEGER NOT NULL, username VARCHAR NOT NULL, '
+                   'trip_id INTEGER NOT NULL, version INTEGER NOT NULL, deleted_at DATETIME NOT NULL, '
+                   'PRIMARY KEY (tombstone_id), '
+                   'FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE)')
+    cursor.execute('CREATE INDEX ix_sync_tombstones_username_version ON sync_tombstones (username, version)')
+
+
+def _user_versions(cursor):
+    cursor.execute('ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('INSERT INTO sync_sequence (sequence_id, version) VALUES (2, 0)')
+
+
+def _invalidations(cursor):
+    # AUTOINCREMENT: ids of pruned rows are never reused, workers poll for ids above the last one they saw
+    cursor.execute('CREATE TABLE invalidations (invalidation_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+                   'kind VARCHAR NOT NULL, subject VARCHAR NOT NULL, at FLOAT NOT NULL, expires_at FLOAT NOT NULL)')
+    cursor.execute('CREATE INDEX ix_invalidations_expires_at ON invalidations (expires_at)')
+
+
+def _message_ids_autoincrement(cursor):
+    # ids of deleted messages were given again to the next ones, hidden from readers and subscribers past them
+    _rebuild_table(
+        cursor, 'messages',
+        'CREATE TABLE messages (message_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, trip_id INTEGER NOT NULL, '
+        'username VARCHAR NOT NULL, text VARCHAR NOT NULL, created_at DATETIME NOT NULL, '
+        'FOREIGN KEY(trip_id) REFERENCES trips (trip_id) ON DELETE CASCADE, '
+        'FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE)',
+        'INSERT INTO messages (message_id, trip_id, username, text, created_at) '
+        'SELECT message_id, trip_id, username, text, created_at FROM _messages_old',
+        ['CREATE INDEX ix_messages_trip_id_created_at ON messages (trip_id, created_at)'])
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'messages'")
+    cursor.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'messages', coalesce(max(message_id), 0) "
+                   "FROM messages")
+
+
+def _messages_by_id(cursor):
+    # history is paged by message_id, the created_at index made every page scan the trip's messages from the start
+    cursor.execute('DROP INDEX ix_messages_trip_id_created_at')
+    cursor.execute('CREATE INDEX ix_messages_trip_id_message_id ON messages (trip_id, message_id)')
+
+
+def _participant_intervals(cursor):
+    cursor.execute('ALTER TABLE users ADD COLUMN user_key INTEGER')
+    cursor.execute('UPDATE users SET user_key = rowid')
+    cursor.execute('CREATE UNIQUE INDEX ix_users_user_key ON users (user_key)')
+    create_participant_intervals(cursor)
+
+
+MIGRATIONS = [
+    (1, _typed_columns_and_participant_constraints),
+    (2, _cascading_foreign_keys),
+    (3, _messages),
+    (4, _trip_summaries),
+    (5, _sync_versions),
+    (6, _user_versions),
+    (7, _participant_intervals),
+    (8, create_trip_search),
+    (9, _invalidations),
+    (10, _message_ids_autoincrement),
+    (11, _messages_by_id),
+]
+
+# Data migrations needing the ORM, pending from the schema migration with the same number until they finish
+DATA_MIGRATIONS = {
+    4: rebuild_trip_summaries,
+}
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Virtual tables and triggers create_all doesn't know about, made by their migrations on existing databases
+SCHEMA_EXTRAS = [
+    create_participant_intervals,
+    create_trip_search,
+]
+
+
+def _run(engine, work):
+    raw = engine.raw_connection()
+    connection = raw.connection
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        return work(connection.cursor())
+    finally:
+        connection.isolation_level = isolation_level
+        raw.close()
+
+
+def schema_version(engine=None):
+    return _run(engine or base.engine, lambda cursor: cursor.execute('PRAGMA user_version').fetchone()[0])
+
+
+def migrate_database(engine=None):
+    """
+        Bring the database to LATEST_VERSION, each migration runs in its own transaction.
+        Returns the list of applied migration numbers.
+    """
+    engine = engine or base.engine
+    has_tables = _run(engine, lambda cursor: cursor.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone()[0])
+    if not has_tables:
+        Base.metadata.create_all(engine)
+
+        def finish(cursor):
+            for create in SCHEMA_EXTRAS:
+                create(cursor)
+            cursor.execute('PRAGMA user_version = %d' % LATEST_VERSION)
+        _run(engine, finish)
+        return []
+
+    def apply(cursor):
+        applied = []
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        foreign_keys = cursor.execute('PRAGMA foreign_keys').fetchone()[0]
+        cursor.execute('PRAGMA foreign_keys = OFF')
+        cursor.execute('PRAGMA legacy_alter_table = ON')
+        try:
+            for number, migration in MIGRATIONS:
+                if number <= version:
+                    continue
+                cursor.execute('BEGIN')
+                try:
+                    migration(cursor)
+                    if number in DATA_MIGRATIONS:
+                        cursor.execute('CREATE TABLE IF NOT EXISTS pending_data_migrations '
+                                       '(number INTEGER NOT NULL PRIMARY KEY)')
+                        cursor.execute('INSERT OR IGNORE INTO pending_data_migrations (number) VALUES (?)', (number,))
+                    if cursor.execute('PRAGMA foreign_key_check').fetchone() is not None:
+                        raise RuntimeError('Migration %d left rows violating foreign keys' % number)
+                    cursor.execute('PRAGMA user_version = %d' % number)
+                    cursor.execute('COMMIT')
+                except Exception:
+                    cursor.execute('ROLLBACK')
+                    raise
+                applied.append(number)
+        finally:
+            cursor.execute('PRAGMA legacy_alter_table = OFF')
+            cursor.execute('PRAGMA foreign_keys = %d' % foreign_keys)
+        return applied
+
+    applied = _run(engine, apply)
+    for number in _run(engine, _pending_data_migrations):
+        DATA_MIGRATIONS[number](engine)
+        _run(engine, lambda cursor: cursor.execute('DELETE FROM pending_data_migrations WHERE number = ?',
+                                                   (number,)))
+    return applied
+
+
+def _pending_data_migrations(cursor):
+    if cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' "
+                      "AND name = 'pending_data_migrations'").fetchone()[0] == 0:
+        return []
+    return [number for (number,) in cursor.execute('SELECT number FROM pending_data_migrations ORDER BY number')]
+
+
+if __name__ == '__main__':
+    applied = migrate_database()
+    print('Applied migrations: %s, schema version: %d' % (applied or 'none', schema_version()))
@@ -0,0 +1,68 @@
+"""
+    Full-text search over trip names. trip_search is an external content FTS5 table reading trip_name from
+    trips, with rowid = trip_id; triggers on trips keep the index in step with inserts, renames and deletes,
+    cascading ones included. Prefix indexes make 'wars*' queries a range read of the index.
+"""
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, select
+
+# Not in Base.metadata, create_all can't build virtual tables; created by create_trip_search
+trip_search = Table('trip_search', MetaData(),
+                    Column('rowid', Integer, primary_key=True),
+                    Column('trip_name', String),
+                    Column('trip_search', String),
+                    Column('rank', Float))
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_DELETE = "INSERT INTO trip_search (trip_search, rowid, trip_name) VALUES ('delete', OLD.trip_id, OLD.trip_name); "
+_CREATE_INSERT_TRIGGER = ('CREATE TRIGGER trip_search_insert AFTER INSERT ON trips BEGIN '
+                          'INSERT INTO trip_search (rowid, trip_name) VALUES (NEW.trip_id, NEW.trip_name); END')
+
+
+def create_trip_search(cursor):
+    """
+        Create the FTS5 table and its triggers and index the existing trips, on a DB-API cursor.
+    """
+    cursor.execute("CREATE VIRTUAL TABLE trip_search USING fts5(trip_name, content='trips', content_rowid='trip_id', "
+                   "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+    cursor.execute(_CREATE_INSERT_TRIGGER)
+    cursor.execute('CREATE TRIGGER trip_search_update AFTER UPDATE OF trip_id, trip_name ON trips BEGIN '
+                   '%sINSERT INTO trip_search (rowid, trip_name) VALUES (NEW.trip_id, NEW.trip_name); END' % _DELETE)
+    cursor.execute('CREATE TRIGGER trip_search_delete AFTER DELETE ON trips BEGIN %sEND' % _DELETE)
+    cursor.execute("INSERT INTO trip_search (trip_search) VALUES ('rebuild')")
+
+
+@contextmanager
+def bulk_trip_search(cursor):
+    """
+        Leave trips inserted within the block out of the index and rebuild it from trips at its end, for bulk
+        loads into a database with few trips before. Commits on the cursor's connection at the end.
+    """
+    cursor.execute('DROP TRIGGER trip_search_insert')
+    try:
+        yield
+    finally:
+        cursor.execute(_CREATE_INSERT_TRIGGER)
+        cursor.execute("INSERT INTO trip_search (trip_search) VALUES ('rebuild')")
+        cursor.connection.commit()
+
+
+def match_expression(text):
+    """
+        FTS5 query matching trips having a word starting with each word of text, None if text has no words.
+        Words are quoted, so FTS5 operators in text are taken literally.
+    """
+    words = _WORD.findall(text or '')
+    if not words:
+        return None
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def ranked_trip_ids(expression):
+    """
+        Subquery of (trip_id, rank) of trips matching expression, lower rank is a better match (bm25).
+    """
+    return select([trip_search.c.rowid.label('trip_id'), trip_search.c.rank.label('rank')]).\
+        where(trip_search.c.trip_search.match(expression)).alias('ranked_trips')
@@ -0,0 +1,91 @@
+"""
+    Maintenance of the trip_summaries table. Every write that changes a trip or its participants calls
+    refresh_trip_summaries in its transaction; rows of deleted trips and users go with ON DELETE CASCADE.
+    Run: python -m db.summaries to rebuild the table of an existing database.
+"""
+import json
+from collections import defaultdict
+
+from db import base
+from models.Participant import Participant
+from models.Trip import Trip
+from models.TripSummary import TripSummary
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def summary_rows(trips, participants):
+    """
+        trips: list of Trip, participants: (trip_id, username) pairs in insertion order.
+    """
+    usernames = defaultdict(list)
+    for trip_id, username in participants:
+        usernames[trip_id].append(username)
+    rows = []
+    for trip in trips:
+        members = usernames[trip.trip_id]
+        encoded = json.dumps(members)
+        for username in dict.fromkeys(members + [trip.owner_name]):
+            rows.append({'username': username, 'trip_id': trip.trip_id,
+                         'role': 'owner' if username == trip.owner_name else 'participant',
+                         'is_participant': username in members,
+                         'trip_name': trip.trip_name, 'date_from': trip.date_from, 'date_to': trip.date_to,
+                         'owner_name': trip.owner_name, 'participant_count': len(members),
+                         'participants': encoded, 'version': trip.version})
+    return rows
+
+
+def refresh_trip_summaries(session, trip_ids):
+    """
+        Rewrite the summary rows of the given trips from trips and participants, within the caller's
+        transaction. Trips that no longer exist just lose their rows. Returns the usernames whose rows were
+        removed or written.
+    """
+    trip_ids = {int(trip_id) for trip_id in trip_ids}
+    usernames = set()
+    if not trip_ids:
+        return usernames
+    session.flush()
+    for chunk in _chunks(trip_ids):
+        usernames.update(username for (username,) in
+                         session.query(TripSummary.username).filter(TripSummary.trip_id.in_(chunk)))
+        session.query(TripSummary).filter(TripSummary.trip_id.in_(chunk)).delete(synchronize_session=False)
+        trips = session.query(Trip).filter(Trip.trip_id.in_(chunk)).populate_existing().all()
+        participants = session.query(Participant.trip_id, Participant.username).\
+            filter(Participant.trip_id.in_(chunk)).order_by(Participant.participant_id).all()
+        rows = summary_rows(trips, participants)
+        if rows:
+            session.bulk_insert_mappings(TripSummary, rows)
+        usernames.update(row['username'] for row in rows)
+    return usernames
+
+
+def rebuild_trip_summaries(engine=None, batch_size=1000):
+    """
+        Recompute the whole table, batch_size trips per transaction.
+    """
+    session = base.session_factory(bind=engine or base.engine)
+    try:
+        session.query(TripSummary).delete(synchronize_session=False)
+        session.commit()
+        after = 0
+        while True:
+            trip_ids = [trip_id for (trip_id,) in session.query(Trip.trip_id).filter(Trip.trip_id > after).
+                        order_by(Trip.trip_id).limit(batch_size)]
+            if not trip_ids:
+                return
+            refresh_trip_summaries(session, trip_ids)
+            session.commit()
+            session.expunge_all()
+            after = trip_ids[-1]
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    rebuild_trip_summaries()
+    print('Trip summaries rebuilt')
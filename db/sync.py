@@ -0,0 +1,94 @@
+"""
+    Versioning of trips and participants for incremental sync. Every write transaction takes a new version
+    from sync_sequence, stamps the trips and participants it changes with it and leaves tombstones for
+    trips users can no longer see. SQLite runs one write transaction at a time, so versions become
+    visible in increasing order. Users whose trip lists change are stamped with the same version, which
+    together with Trip.version and the users list sequence backs the ETags of the read endpoints.
+"""
+from datetime import datetime
+
+from sqlalchemy import and_
+
+from db.summaries import refresh_trip_summaries
+from models.Participant import Participant
+from models.SyncTombstone import SyncTombstone, sync_sequence
+from models.Trip import Trip
+from models.TripSummary import TripSummary
+from models.User import User
+
+# Rows of sync_sequence
+TRIPS_SEQUENCE = 1
+USERS_SEQUENCE = 2
+
+
+def next_version(session, sequence_id=TRIPS_SEQUENCE):
+    updated = session.execute(sync_sequence.update().where(sync_sequence.c.sequence_id == sequence_id).
+                              values(version=sync_sequence.c.version + 1)).rowcount
+    if updated == 0:
+        session.execute(sync_sequence.insert().values(sequence_id=sequence_id, version=1))
+    return current_version(session, sequence_id)
+
+
+def current_version(session, sequence_id=TRIPS_SEQUENCE):
+    row = session.execute(sync_sequence.select().where(sync_sequence.c.sequence_id == sequence_id)).first()
+    return row.version if row is not None else 0
+
+
+def touch_users(session, usernames, version):
+    usernames = list(usernames)
+    for i in range(0, len(usernames), 500):
+        session.query(User).filter(User.username.in_(usernames[i:i + 500])).\
+            update({User.version: version}, synchronize_session=False)
+
+
+def touch_trip_users(session, trip_ids, version):
+    """
+        Stamp everyone having the trips on their lists, before the trips are deleted.
+    """
+    touch_users(session, {username for (username,) in session.query(TripSummary.username).
+                          filter(TripSummary.trip_id.in_(trip_ids))}, version)
+
+
+def record_trip_changes(session, trip_ids, version):
+    """
+        Stamp the trips with version and rewrite their summaries, within the caller's transaction.
+    """
+    trip_ids = [int(trip_id) for trip_id in trip_ids]
+    for i in range(0, len(trip_ids), 500):
+        session.query(Trip).filter(Trip.trip_id.in_(trip_ids[i:i + 500])).\
+            update({Trip.version: version, Trip.updated_at: datetime.utcnow()}, synchronize_session=False)
+    touch_users(session, refresh_trip_summaries(session, trip_ids), version)
+
+
+def add_tombstones(session, pairs, version):
+    """
+        pairs: (username, trip_id) of users who lost access to the trip.
+    """
+    now = datetime.utcnow()
+    rows = [{'username': username, 'trip_id': int(trip_id), 'version': version, 'deleted_at': now}
+            for username, trip_id in pairs]
+    if rows:
+        session.bulk_insert_mappings(SyncTombstone, rows)
+
+
+def tombstone_trip_participants(session, trip_ids, version, except_username=None):
+    query = session.query(Participant.username, Participant.trip_id).filter(Participant.trip_id.in_(trip_ids))
+    if except_username is not None:
+        query = query.filter(Participant.username != except_username)
+    add_tombstones(session, query.all(), version)
+
+
+def changes_since(session, username, since):
+    """
+        Trips visible to username (as in all-trips) changed after version since, and ids of trips the user
+        lost access to. The upper bound is read first, so a write committing meanwhile is left for the next
+        call instead of being skipped. Returns (summaries, deleted_trip_ids, version).
+    """
+    until = current_version(session)
+    changed = session.query(TripSummary).filter(and_(
+        TripSummary.username == username, TripSummary.is_participant,
+        TripSummary.version > since, TripSummary.version <= until)).order_by(TripSummary.trip_id).all()
+    changed_ids = {s.trip_id for s in changed}
+    deleted = {trip_id for (trip_id,) in session.query(SyncTombstone.trip_id).filter(and_(
+        SyncTombstone.username == username, SyncTombstone.version > since, SyncTombstone.version <= until))}
+    return changed, sorted(deleted - changed_ids), until
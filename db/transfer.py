@@ -0,0 +1,262 @@
+"""
+    Export and import of users, trips, participants and chat messages as NDJSON, one row per line with its
+    table: {"table": "users", "username": ..., "password_hash": ...}. Export reads each table in key order,
+    STREAM_BATCH_SIZE rows per SELECT; import inserts batch_size rows per executemany and transaction, so
+    neither holds more than a batch in memory. Passwords are moved as their hashes. Derived tables are not
+    exported: each imported batch stamps its trips with a new version and rewrites their summaries like API
+    writes do, the search and date indexes follow through their triggers. Rows whose key already exists are
+    skipped, so an interrupted import can be run again; any other row the database refuses stops the import
+    at its line with the database's reason. Column types are checked while parsing, before anything is written.
+    Run: python -m db.transfer export [file], python -m db.transfer import file ('-' for stdout / stdin)
+"""
+import argparse
+import json
+import sys
+from datetime import date, datetime
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.exc import IntegrityError
+
+import config
+from db import base
+from db.migrations import migrate_database
+from db.sync import USERS_SEQUENCE, next_version, record_trip_changes
+from models.Message import Message
+from models.Participant import Participant
+from models.Trip import Trip
+from models.User import User
+from services.hashing import hashing_service
+
+
+class InvalidImportLine(Exception):
+    def __init__(self, line_number, reason):
+        super().__init__('line %d: %s' % (line_number, reason))
+        self.line_number = line_number
+        self.reason = reason
+
+
+def _string(value):
+    if not isinstance(value, str):
+        raise ValueError('must be a string')
+    return value
+
+
+def _integer(value):
+    if type(value) is not int:
+        raise ValueError('must be an integer')
+    return value
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(_string(value))
+    except ValueError:
+        raise ValueError('must be an ISO date')
+
+
+def _datetime(value):
+    try:
+        return datetime.fromisoformat(_string(value))
+    except ValueError:
+        raise ValueError('must be an ISO date and time')
+
+
+def _nullable(validate):
+    return lambda value: None if value is None else validate(value)
+
+
+# table name -> (table, key column, exported columns, columns a row conflicts on, validators of imported
+# values), in dependency order
+TABLES = {
+    'users': (User.__table__, 'username', ['username', 'password_hash'], ['username'],
+              {'username': _string, 'password_hash': _string}),
+    'trips': (Trip.__table__, 'trip_id', ['trip_id', 'trip_name', 'date_from', 'date_to', 'owner_name'],
+              ['trip_id'], {'trip_id': _integer, 'trip_name': _nullable(_string), 'date_from': _nullable(_date),
+                            'date_to': _nullable(_date), 'owner_name': _string}),
+    'participants': (Participant.__table__, 'participant_id', ['trip_id', 'username'], ['trip_id', 'username'],
+                     {'trip_id': _integer, 'username': _string}),
+    'messages': (Message.__table__, 'message_id', ['message_id', 'trip_id', 'username', 'text', 'created_at'],
+                 ['message_id'], {'message_id': _nullable(_integer), 'trip_id': _integer, 'username': _string,
+                                  'text': _string, 'created_at': _datetime}),
+}
+
+
+def _exported(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def export_rows(engine=None, batch_size=config.STREAM_BATCH_SIZE):
+    """
+        Yield every exported row as a dict with its 'table', table after table, all from one snapshot of
+        the database.
+    """
+    connection = (engine or base.engine).connect()
+    transaction = connection.begin()
+    try:
+        if connection.dialect.name == 'sqlite':
+            # pysqlite begins no transaction for reads, without one each SELECT would see later writes
+            connection.execute(text('BEGIN'))
+        for name, (table, key, columns, _, _) in TABLES.items():
+            key_column = table.c[key]
+            after = None
+            while True:
+                query = select([key_column] + [table.c[column] for column in columns if column != key])
+                if after is not None:
+                    query = query.where(key_column > after)
+                rows = connection.execute(query.order_by(key_column).limit(batch_size)).fetchall()
+                for row in rows:
+                    line = {'table': name}
+                    line.update((column, _exported(row[column])) for column in columns)
+                    yield line
+                if len(rows) < batch_size:
+                    break
+                after = rows[-1][key]
+    finally:
+        transaction.rollback()
+        connection.close()
+
+
+def export_ndjson(engine=None):
+    for row in export_rows(engine):
+        yield json.dumps(row, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+def _parse(line_number, line):
+    try:
+        row = json.loads(line)
+    except ValueError:
+        raise InvalidImportLine(line_number, 'not JSON')
+    if not isinstance(row, dict) or row.get('table') not in TABLES:
+        raise InvalidImportLine(line_number, 'expected an object with table one of %s' % ', '.join(TABLES))
+    name = row.pop('table')
+    _, _, columns, _, validators = TABLES[name]
+    if name == 'users' and 'password_hash' not in row and isinstance(row.get('password'), str):
+        row['password_hash'] = hashing_service.hash(row.pop('password'))
+    if name == 'messages':
+        # without an id the message gets a new one
+        row.setdefault('message_id', None)
+    missing = [column for column in columns if column not in row]
+    if missing:
+        raise InvalidImportLine(line_number, 'missing %s' % ', '.join(missing))
+    values = {}
+    for column in columns:
+        try:
+            values[column] = validators[column](row[column])
+        except ValueError as e:
+            raise InvalidImportLine(line_number, '%s %s' % (column, e))
+    return name, values
+
+
+def _insert_statement(name):
+    """
+        INSERT of one row of the table that does nothing when a row with its key exists. Other constraints
+        still fail, unlike INSERT OR IGNORE which would skip rows with a NULL in a NOT NULL column too.
+    """
+    table, _, columns, conflict_columns, _ = TABLES[name]
+    names, values = list(columns), [':' + column for column in columns]
+    if 'version' in table.c:
+        names.append('version')
+        values.append('0')
+    statement = text('INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO NOTHING'
+                     % (table.name, ', '.join(names), ', '.join(values), ', '.join(conflict_columns)))
+    return statement.bindparams(*[bindparam(column, type_=table.c[column].type) for column in columns])
+
+
+def _refused_line(engine, statement, pending, line_numbers):
+    """
+        (line number, reason) of the first pending row the database refuses, inserting them one at a time
+        in a transaction that is rolled back.
+    """
+    session = base.session_factory(bind=engine)
+    try:
+        for values, line_number in zip(pending, line_numbers):
+            try:
+                session.execute(statement, values)
+            except IntegrityError as e:
+                reason = str(e.orig)
+                if 'FOREIGN KEY' in reason:
+                    reason = 'references a missing user or trip'
+                return line_number, reason
+        return line_numbers[0], 'refused by the database'
+    finally:
+        session.rollback()
+        session.close()
+
+
+def import_ndjson(lines, engine=None, batch_size=config.IMPORT_BATCH_SIZE):
+    """
+        Insert rows of NDJSON lines (an iterable of str or bytes), batch_size rows per transaction.
+        Returns {table: {'inserted': n, 'skipped': n}}. A bad line raises InvalidImportLine,
+        batches before it stay committed.
+    """
+    engine = engine or base.engine
+    counts = {name: {'inserted': 0, 'skipped': 0} for name in TABLES}
+    statements = {name: _insert_statement(name) for name in TABLES}
+    pending, line_numbers, pending_table = [], [], None
+
+    def flush():
+        if not pending:
+            return
+        session = base.session_factory(bind=engine)
+        try:
+            inserted = session.execute(statements[pending_table], pending).rowcount
+            if inserted and pending_table == 'users':
+                next_version(session, USERS_SEQUENCE)
+            elif inserted and pending_table in ('trips', 'participants'):
+                record_trip_changes(session, {row['trip_id'] for row in pending}, next_version(session))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise InvalidImportLine(*_refused_line(engine, statements[pending_table], pending, line_numbers))
+        finally:
+            session.close()
+        counts[pending_table]['inserted'] += inserted
+        counts[pending_table]['skipped'] += len(pending) - inserted
+        del pending[:]
+        del line_numbers[:]
+
+    for line_number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        name, values = _parse(line_number, line)
+        if name != pending_table or len(pending) >= batch_size:
+            flush()
+            pending_table = name
+        pending.append(values)
+        line_numbers.append(line_number)
+    flush()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', nargs='?', default='-')
+    parser.add_argument('--batch-size', type=int, default=config.IMPORT_BATCH_SIZE, help='rows per transaction')
+    args = parser.parse_args()
+
+    migrate_database()
+    if args.command == 'export':
+        out = sys.stdout if args.file == '-' else open(args.file, 'w', encoding='utf-8')
+        try:
+            out.writelines(export_ndjson())
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
+    source = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+    try:
+        counts = import_ndjson(source, batch_size=args.batch_size)
+    except InvalidImportLine as e:
+        sys.exit('Import stopped at %s' % e)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    for name, count in counts.items():
+        print('%-13s %10d inserted %10d skipped' % (name, count['inserted'], count['skipped']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import contextvars
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import config
+from db import base
+from db.batch import in_batch
+from db.base import Session
+
+
+class WriteQueue:
+    """
+        Single writer thread for SQLite. Jobs are callables taking a session and returning plain data;
+        jobs queued at the same time run in one transaction with one commit. If a batch fails it is rolled
+        back and its jobs are retried one by one, so only the failing job sees the error.
+    """
+
+    def __init__(self, max_batch=config.WRITE_QUEUE_MAX_BATCH, max_wait=config.WRITE_QUEUE_MAX_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, job):
+        future = Future()
+        self._ensure_thread()
+        # the job runs in the caller's context, so its statements count for the caller's request
+        self._queue.put((job, future, contextvars.copy_context()))
+        return future.result()
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=self.max_wait))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not self._run_batch(batch) and len(batch) > 1:
+                for job in batch:
+                    self._run_batch([job])
+
+    @staticmethod
+    def _run_batch(batch):
+        session = base.session_factory()
+        try:
+            results = [context.run(job, session) for job, _, context in batch]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            return False
+        finally:
+            session.close()
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+        return True
+
+
+write_queue = WriteQueue()
+
+
+def run_write(job):
+    """
+        Run job(session) and commit. With TRIP_WRITE_QUEUE=1 the job goes through the writer thread and may
+        share its transaction with other requests, so it must not return ORM objects. Inside /api/batch the job
+        runs on the batch's session (db/batch.py).
+    """
+    if config.WRITE_QUEUE_ENABLED and not in_batch():
+        return write_queue.submit(job)
+    session = Session()
+    try:
+        result = job(session)
+        session.commit()
+        return result
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Float, Integer, String
+
+from db.base import Base
+
+
+class Invalidation(Base):
+    """
+        A revoked token or a change of chat memberships, for every worker process to apply to its own token
+        service and membership cache, see db/invalidations.py. Kept until expires_at (unix time).
+    """
+    __tablename__ = 'invalidations'
+    __table_args__ = {'sqlite_autoincrement': True}
+    invalidation_id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    at = Column(Float, nullable=False)
+    expires_at = Column(Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<Invalidation(id='%s', kind='%s', subject='%s')>" % (self.invalidation_id, self.kind, self.subject)
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
+
+from db.base import Base
+
+
+class Message(Base):
+    __tablename__ = 'messages'
+    # AUTOINCREMENT: ids of messages deleted with their user or trip are never given again, readers and
+    # subscribers resume after the last id they saw
+    # pages of a trip's history are read by message_id, from the cursor on
+    __table_args__ = (Index('ix_messages_trip_id_message_id', 'trip_id', 'message_id'), {'sqlite_autoincrement': True})
+    message_id = Column(Integer, primary_key=True)
+    trip_id = Column(Integer, ForeignKey('trips.trip_id', ondelete='CASCADE'), nullable=False)
+    username = Column(String, ForeignKey('users.username', ondelete='CASCADE'), nullable=False)
+    text = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    def __init__(self, trip_id, username, text):
+        self.trip_id = trip_id
+        self.username = username
+        self.text = text
+        self.created_at = datetime.utcnow()
+
+    def convert_to_json(self):
+        return {"message_id": self.message_id, "trip_id": self.trip_id, "username": self.username,
+                "text": self.text, "created_at": self.created_at.isoformat()}
+
+    def __repr__(self):
+        return "<Message(id='%s', trip='%s', from='%s')>" % (self.message_id, self.trip_id, self.username)
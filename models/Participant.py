@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, DateTime
 from sqlalchemy.orm import relationship
 
 from db.base import Base
@@ -6,11 +6,14 @@ from db.base import Base
 
 class Participant(Base):
     __tablename__ = 'participants'
+    __table_args__ = (UniqueConstraint('trip_id', 'username', name='uq_participants_trip_id_username'),)
     participant_id = Column(Integer, primary_key=True, autoincrement=True)
-    username = Column(Integer, ForeignKey('users.username'))
+    username = Column(String, ForeignKey('users.username', ondelete='CASCADE'), index=True)
     user = relationship("User", backref='participants', cascade_backrefs=False, cascade="save-update, merge, delete")
-    trip_id = Column(Integer, ForeignKey('trips.trip_id'))
+    trip_id = Column(Integer, ForeignKey('trips.trip_id', ondelete='CASCADE'))
     trip = relationship("Trip", backref='participants', cascade_backrefs=False, cascade="save-update, merge, delete")
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
 
     def __init__(self, user, trip):
         self.user = user
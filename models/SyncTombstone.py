@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index, Table
+
+from db.base import Base
+
+# Last version handed out per sequence: trip writes and changes of the users list, see db/sync.py
+sync_sequence = Table('sync_sequence', Base.metadata,
+                      Column('sequence_id', Integer, primary_key=True),
+                      Column('version', Integer, nullable=False))
+
+
+class SyncTombstone(Base):
+    """
+        Trip trip_id stopped being visible to username at version: the trip was deleted or the user was
+        removed from its participants.
+    """
+    __tablename__ = 'sync_tombstones'
+    __table_args__ = (Index('ix_sync_tombstones_username_version', 'username', 'version'),)
+    tombstone_id = Column(Integer, primary_key=True)
+    username = Column(String, ForeignKey('users.username', ondelete='CASCADE'), nullable=False)
+    trip_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<SyncTombstone(user='%s', trip='%s', version='%s')>" % (self.username, self.trip_id, self.version)
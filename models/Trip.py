@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Date
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime
 from sqlalchemy.orm import relationship
 
 from db.base import Base
@@ -8,10 +8,12 @@ class Trip(Base):
     __tablename__ = 'trips'
     trip_id = Column(Integer, primary_key=True)
     trip_name = Column(String, index=True)
-    date_from = Column(Date)
+    date_from = Column(Date, index=True)
     date_to = Column(Date)
-    owner_name = Column(Integer, ForeignKey('users.username'))
+    owner_name = Column(String, ForeignKey('users.username', ondelete='CASCADE'), index=True)
     owner = relationship("User")
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
 
     def __init__(self, trip_name, date_from, date_to, owner):
         self.trip_name = trip_name
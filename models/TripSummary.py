@@ -0,0 +1,35 @@
+import json
+
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, Boolean, Index
+
+from db.base import Base
+
+
+class TripSummary(Base):
+    """
+        One row per trip and user who owns or participates in it, with the trip's participants copied in,
+        so that listing a user's trips is a single range read on the primary key. Maintained by
+        db/summaries.py whenever a trip or its participants change.
+    """
+    __tablename__ = 'trip_summaries'
+    __table_args__ = (Index('ix_trip_summaries_username_version', 'username', 'version'),)
+    username = Column(String, ForeignKey('users.username', ondelete='CASCADE'), primary_key=True)
+    trip_id = Column(Integer, ForeignKey('trips.trip_id', ondelete='CASCADE'), primary_key=True, index=True)
+    role = Column(String, nullable=False)
+    is_participant = Column(Boolean, nullable=False)
+    trip_name = Column(String)
+    date_from = Column(Date)
+    date_to = Column(Date)
+    owner_name = Column(String)
+    participant_count = Column(Integer, nullable=False)
+    participants = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+
+    def convert_to_json_for_user(self):
+        return {"trip_id": self.trip_id, "trip_name": self.trip_name,
+                "date_from": str(self.date_from), "date_to": str(self.date_to),
+                "participants": json.loads(self.participants), "owner": self.owner_name,
+                "role": self.role, "participant_count": self.participant_count}
+
+    def __repr__(self):
+        return "<TripSummary(user='%s', trip='%s', role='%s')>" % (self.username, self.trip_id, self.role)
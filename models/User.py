@@ -1,23 +1,33 @@
-from sqlalchemy import Column, String
-from passlib.apps import custom_app_context as pwd_context
+from sqlalchemy import Column, Integer, String
 
 from db.base import Base
+from services.hashing import hashing_service
 
 
 class User(Base):
     __tablename__ = 'users'
     username = Column(String, index=True, primary_key=True, nullable=False)
     password_hash = Column(String, nullable=False)
+    # Version of the last change to the user's trip lists, see db/sync.py
+    version = Column(Integer, nullable=False, default=0)
+    # Small integer naming the user in participant_intervals, assigned by a trigger, see db/intervals.py
+    user_key = Column(Integer, unique=True, index=True)
 
-    def __init__(self, username, password):
+    def __init__(self, username, password=None, password_hash=None):
         self.username = username
-        self.hash_password(password)
+        if password_hash is not None:
+            self.password_hash = password_hash
+        else:
+            self.hash_password(password)
 
     def hash_password(self, password):
-        self.password_hash = pwd_context.encrypt(password)
+        self.password_hash = hashing_service.hash(password)
 
     def verify_password(self, password):
-        return pwd_context.verify(password, self.password_hash)
+        is_valid, new_hash = hashing_service.verify_and_update(password, self.password_hash)
+        if is_valid and new_hash is not None:
+            self.password_hash = new_hash
+        return is_valid
 
     def convert_to_json(self):
         return {"username": self.username}
@@ -0,0 +1,215 @@
+"""
+    Production entry point. The master process migrates the database, loads asgi:app (TRIP_PRELOAD),
+    binds the listening socket and forks TRIP_WORKERS uvicorn workers sharing it. Each worker opens its own
+    database connections and hashing pool after the fork and warms them before taking requests.
+    With several workers TRIP_SECRET_KEY must be set, revoked tokens and chat membership changes reach
+    every worker through db/invalidations.py, and /metrics adds up the metrics of all workers from files in
+    TRIP_METRICS_DIR. Signals to the master: TERM or INT stop gracefully, HUP reloads by starting a new set of
+    workers and then draining the old ones (picks up code changes only with TRIP_PRELOAD=0). Dead workers are
+    replaced.
+    Run: python serve.py
+"""
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+import config
+from db import base
+from db.migrations import migrate_database
+
+
+def bind_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((config.HOST, config.PORT))
+    sock.listen(config.LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def load_app():
+    from asgi import app
+    return app
+
+
+def run_worker(sock, workers):
+    """
+        Body of a forked worker, never returns.
+    """
+    import uvicorn
+    from db.chat_relay import ChatRelay
+    from db.invalidations import InvalidationRelay
+    from services.broker import chat_broker
+    from services.hashing import hashing_service
+    from services.membership_cache import membership_cache
+    from services.metrics import SharedMetrics, metrics
+    from services.tokens import token_service
+
+    for signum in (signal.SIGHUP, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    # uvicorn handles TERM and INT while serving and may raise them again once it stopped
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: None)
+    status = 0
+    try:
+        app = load_app()
+        base.init_engine()
+        if 'TRIP_PASSWORD_HASH_WORKERS' not in os.environ:
+            hashing_service.workers = max(1, (os.cpu_count() or 1) // workers)
+        base.warm_pool()
+        hashing_service.warm()
+        if workers > 1:
+            ChatRelay(chat_broker).start()
+            InvalidationRelay(token_service, membership_cache).start()
+            if config.METRICS:
+                SharedMetrics(metrics, config.METRICS_DIR).start()
+        uvicorn.Server(uvicorn.Config(app, log_level='info')).run(sockets=[sock])
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        hashing_service.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+class Master:
+    def __init__(self, sock, workers=config.WORKERS):
+        self.sock = sock
+        self.workers = workers
+        self.generation = 0
+        self.children = {}
+        self.deadlines = {}
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.sock, self.workers)
+        self.children[pid] = (self.generation, time.monotonic())
+        return pid
+
+    def signal_children(self, signum, generation=None):
+        for pid, (child_generation, _) in list(self.children.items()):
+            if generation is None or child_generation <= generation:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            generation, started = self.children.pop(pid, (None, None))
+            self.deadlines.pop(pid, None)
+            if generation == self.generation and not self.stopping and time.monotonic() - started < 1:
+                # crashing on start, don't fork in a tight loop
+                time.sleep(1)
+
+    def current_workers(self):
+        return sum(1 for generation, _ in self.children.values() if generation == self.generation)
+
+    def drain(self, generation=None):
+        """
+            Ask workers to finish their requests and exit, they are killed after TRIP_GRACEFUL_TIMEOUT.
+        """
+        deadline = time.monotonic() + config.GRACEFUL_TIMEOUT
+        for pid, (child_generation, _) in self.children.items():
+            if generation is None or child_generation <= generation:
+                self.deadlines.setdefault(pid, deadline)
+        self.signal_children(signal.SIGTERM, generation)
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.deadlines.items()):
+            if deadline < now:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def reload(self):
+        self.generation += 1
+        for _ in range(self.workers):
+            self.spawn()
+        self.drain(self.generation - 1)
+
+    def stop(self):
+        self.drain()
+        while self.children:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+
+    def run(self):
+        def request_stop(signum, frame):
+            self.stopping = True
+
+        def request_reload(signum, frame):
+            self.reloading = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGHUP, request_reload)
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            self.reap()
+            self.kill_overdue()
+            while not self.stopping and self.current_workers() < self.workers:
+                self.spawn()
+            time.sleep(0.2)
+        self.stop()
+
+
+def metrics_dir():
+    """
+        Empty directory for the metrics files of the workers, and whether it is a temporary one to remove.
+    """
+    if not config.METRICS_DIR:
+        return tempfile.mkdtemp(prefix='trip-metrics-'), True
+    os.makedirs(config.METRICS_DIR, exist_ok=True)
+    # files of a previous run, a restart starts the counters from zero as a single process would
+    for name in os.listdir(config.METRICS_DIR):
+        if name.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(config.METRICS_DIR, name))
+    return config.METRICS_DIR, False
+
+
+def main():
+    if config.WORKERS > 1 and not os.environ.get('TRIP_SECRET_KEY'):
+        sys.exit('TRIP_SECRET_KEY must be set to run more than one worker, each would sign tokens with its own key')
+    migrate_database()
+    if config.PRELOAD:
+        load_app()
+    # connections opened so far belong to the master, workers open their own after the fork
+    base.engine.dispose()
+    sock = bind_socket()
+    temporary = False
+    if config.WORKERS > 1 and config.METRICS:
+        # workers are forked and read the directory from config
+        config.METRICS_DIR, temporary = metrics_dir()
+    print('Master %d listening on %s:%d with %d workers' % (os.getpid(), config.HOST, config.PORT, config.WORKERS))
+    try:
+        Master(sock).run()
+    finally:
+        if temporary:
+            shutil.rmtree(config.METRICS_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,65 @@
 import json
+import os
+import re
+import sys
+from collections import OrderedDict
 from datetime import datetime
+from functools import wraps
+from urllib.parse import quote
 
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, request, jsonify, make_response
 from flask_restful import Api
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.elements import and_
+from werkzeug.test import EnvironBuilder
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.elements import and_, or_
 
+import config
+from db.base import Session
+from db.batch import batch_session
 from db.database import commit_and_close
+from db.intervals import find_conflicts, overlapping_trip_ids
+from db.invalidations import add_membership_changes, add_token_revocation, add_user_revocation
+from db.migrations import LATEST_VERSION, migrate_database, schema_version
+from db.search import match_expression, ranked_trip_ids
+from db.sync import USERS_SEQUENCE, add_tombstones, changes_since, current_version, next_version, \
+    record_trip_changes, tombstone_trip_participants, touch_trip_users
+from db.transfer import InvalidImportLine, export_ndjson, import_ndjson
+from db.writer import run_write
+from models.Message import Message
 from models.Participant import Participant
 from models.Trip import Trip
+from models.TripSummary import TripSummary
 from models.User import User
+from services.broker import SubscriptionClosed, TooManySubscribers, chat_broker
+from services.conditional import not_modified, version_etag, with_etag
+from services.hashing import HashingBusy, hashing_service
+from services.membership_cache import membership_cache
+from services.metrics import MetricsMiddleware, instrument_sqlalchemy, metrics, name_route
+from services.pagination import InvalidPageParameter, decode_cursor, encode_cursor, page_params, paginate
+from services.profiling import ProfilingMiddleware, is_admin, profile_store, report
+from services.streaming import iter_keyset, iter_query, stream_mode, stream_response
+from services.tokens import InvalidToken, token_service
 
 app = Flask(__name__)
 api = Api(app)
+if config.ADMIN_SECRET:
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app)
+if config.METRICS:
+    instrument_sqlalchemy()
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+
+@app.before_request
+def name_metrics_route():
+    if request.url_rule is not None:
+        name_route(request.url_rule.rule)
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    if exception is not None:
+        Session.rollback()
+    Session.remove()
 
 
 @app.errorhandler(422)
@@ -26,6 +72,95 @@ def not_found():
     return make_response(jsonify({'error': 'Bad Request'}), 400)
 
 
+@app.errorhandler(InvalidPageParameter)
+def invalid_page_parameter(error):
+    return make_response(jsonify({'error': 'Invalid limit or cursor'}), 422)
+
+
+class InvalidDateRange(Exception):
+    pass
+
+
+@app.errorhandler(InvalidDateRange)
+def invalid_date_range(error):
+    return make_response(jsonify({'error': 'Invalid date_from or date_to'}), 422)
+
+
+class InvalidParticipants(Exception):
+    pass
+
+
+@app.errorhandler(InvalidParticipants)
+def invalid_participants(error):
+    return make_response(jsonify({'error': 'Invalid participants'}), 422)
+
+
+def with_next_cursor(response, next_cursor):
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+@app.errorhandler(HashingBusy)
+@app.errorhandler(TooManySubscribers)
+def server_busy(error):
+    return make_response(jsonify({'error': 'Server busy, try again later'}), 503)
+
+
+def bearer_token(header=None):
+    if header is None:
+        header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[len('Bearer '):].strip()
+    return None
+
+
+def token_error(authorization, username):
+    """
+        None if the Authorization header value lets the request act as username, ({'error': ...}, status)
+        otherwise. Requests without a token are rejected unless TRIP_REQUIRE_TOKEN=0.
+    """
+    token = bearer_token(authorization)
+    if token is None:
+        return ({'error': 'Unauthorized'}, 401) if config.REQUIRE_TOKEN else None
+    try:
+        claims = token_service.verify(token)
+    except InvalidToken:
+        return {'error': 'Invalid or expired token'}, 401
+    if claims['sub'] != username:
+        return {'error': 'Token does not belong to this user'}, 403
+    return None
+
+
+def token_required(f):
+    """
+        Checks the 'Authorization: Bearer <token>' header of routes taking a username. The token must belong
+        to that username.
+    """
+    @wraps(f)
+    def decorated(username, *args, **kwargs):
+        error = token_error(request.headers.get('Authorization', ''), username)
+        if error is not None:
+            return make_response(jsonify(error[0]), error[1])
+        return f(username, *args, **kwargs)
+    return decorated
+
+
+def admin_required(f):
+    """
+        Routes under /api/admin answer requests with 'X-Admin-Secret: <TRIP_ADMIN_SECRET>' only, and don't exist
+        while TRIP_ADMIN_SECRET is unset.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not config.ADMIN_SECRET:
+            return make_response(jsonify({'error': 'Not found'}), 404)
+        if not is_admin(request.headers.get('X-Admin-Secret')):
+            return make_response(jsonify({'error': 'Unauthorized'}), 401)
+        return f(*args, **kwargs)
+    return decorated
+
+
 """
 
     Adding user to database, username need to be unique
@@ -44,43 +179,78 @@ def add_user():
     if not request.json or ('username' not in request.json or 'password' not in request.json):
         return make_response(jsonify({'error': 'Missing required parameter'}), 422)
     username = request.json.get('username')
-    password = request.json.get('password')
+    # hashed here, the writer thread shouldn't wait for it
+    password_hash = hashing_service.hash(request.json.get('password'))
 
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
+    def create_user(session):
+        if session.query(User.username).filter_by(username=username).first() is not None:
+            return False
+        session.add(User(username, password_hash=password_hash))
+        next_version(session, USERS_SEQUENCE)
+        return True
 
-    if session.query(User).filter_by(username=username).first() is not None:
-        commit_and_close(session)
+    if not run_write(create_user):
         return make_response(jsonify({'error': 'Bad Request'}), 400)
-    user = User(username, password)
-    session.add(user)
-    commit_and_close(session)
-
     return make_response(jsonify({'username': username}), 201)
 
 
 """
 
-    Get all users from database
-    Example: curl -i -X GET -H "Content-Type: application/json" -d http://127.0.0.1:5000/api/users
-    Params: None
+    Get users from database ordered by username, one page at a time
+    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/users?limit=50
+    Params: limit (optional, default 100), cursor (optional, next_cursor of the previous page)
     Response: 
-        - {'Users': <list off users>}
+        - {'Users': <list off users>, 'next_cursor': <cursor or null on the last page>},
+          the cursor is also sent in X-Next-Cursor header
+        - with 'Accept: application/x-ndjson' one user per line, with 'Accept: application/stream+json'
+          {'Users': <list off users>}, both streamed from the cursor to the end or up to limit
+        - HTTP Error 422 if limit or cursor is invalid
+        - HTTP 304 with empty body if If-None-Match holds the ETag of the previous response and no user
+          was added or deleted since
 
 """
 
 
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
+    limit, after = page_params(request.args, str)
+    session = Session()
 
-    users = session.query(User).all()
+    etag = version_etag(request, 'users', current_version(session, USERS_SEQUENCE))
+    cached = not_modified(request, etag, private=False)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    mode = stream_mode(request)
+    if mode is not None:
+        query = session.query(User).order_by(User.username)
+        if after is not None:
+            query = query.filter(User.username > after)
+        return with_etag(stream_response(mode, (u.convert_to_json() for u in iter_query(query)),
+                                         limit=limit if 'limit' in request.args else None, wrapper_key='Users',
+                                         on_close=lambda: commit_and_close(session)), etag, private=False)
+
+    users, next_cursor = paginate(session.query(User), User.username, limit, after, lambda u: u.username)
     r = [u.convert_to_json() for u in users]
     commit_and_close(session)
-    return make_response(jsonify({'Users': r}), 201)
+    response = make_response(jsonify({'Users': r, 'next_cursor': next_cursor}), 201)
+    return with_etag(with_next_cursor(response, next_cursor), etag, private=False)
+
+
+def read_password_hash(username):
+    session = Session()
+    password_hash = session.query(User.password_hash).filter_by(username=username).scalar()
+    commit_and_close(session)
+    return password_hash
+
+
+def replace_password_hash(session, username, old_hash, new_hash):
+    """
+        Write job: set the user's hash if it is still old_hash, the password was verified against it outside
+        the job. Returns whether it was replaced.
+    """
+    return session.query(User).filter_by(username=username, password_hash=old_hash).\
+        update({'password_hash': new_hash}, synchronize_session=False) == 1
 
 
 """
@@ -90,7 +260,8 @@ def get_users():
     http://127.0.0.1:5000/api/user/login
     Params: username, password
     Response: 
-        - {'Response': 'OK'} if password is correct
+        - {'Response': 'OK', 'token': '<token>', 'expires_in': <seconds>} if password is correct,
+          send the token as 'Authorization: Bearer <token>' header to other endpoints
         - HTTP Error 422 'Missing required parameter' - if some params is missing
         -HTTP Error 401  'Unauthorized' - if password is incorrect
         - HTTP Error 400 ' Bad request' if username doesn't exist
@@ -105,18 +276,37 @@ def authenticate_user():
     username = request.json.get('username')
     password = request.json.get('password')
 
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
-        commit_and_close(session)
+    password_hash = read_password_hash(username)
+    if password_hash is None:
         return make_response(jsonify({'error': 'Bad Request'}), 400)
-    if not user.verify_password(password):
-        commit_and_close(session)
+    is_valid, new_hash = hashing_service.verify_and_update(password, password_hash)
+    if not is_valid:
         return make_response(jsonify({'Response': 'Wrong password'}), 401)
-    commit_and_close(session)
+    if new_hash is not None:
+        run_write(lambda session: replace_password_hash(session, username, password_hash, new_hash))
+    return make_response(jsonify({'Response': 'OK', 'token': token_service.issue(username),
+                                  'expires_in': token_service.ttl}), 201)
+
+
+"""
+
+    Revoke the token sent in Authorization header
+    Example: curl -i -X POST -H "Authorization: Bearer <token>" http://127.0.0.1:5000/api/user/logout
+    Params: None
+    Response: 
+        - {'Response': 'OK'} if token was revoked
+        -HTTP Error 401 if token is missing, invalid or expired
+"""
+
+
+@app.route('/api/user/logout', methods=['POST'])
+def logout_user():
+    token = bearer_token()
+    try:
+        claims = token_service.revoke(token)
+    except InvalidToken:
+        return make_response(jsonify({'error': 'Invalid or expired token'}), 401)
+    run_write(lambda session: add_token_revocation(session, claims))
     return make_response(jsonify({'Response': 'OK'}), 201)
 
 
@@ -132,22 +322,187 @@ def authenticate_user():
 """
 
 
+def can_join_chat(username, trip_id):
+    is_member = membership_cache.get(trip_id, username)
+    if is_member is None:
+        generation = membership_cache.generation()
+        session = Session()
+        is_member = session.query(or_(
+            session.query(Participant).filter(
+                and_(Participant.trip_id == trip_id, Participant.username == username)).exists(),
+            session.query(Trip).filter(
+                and_(Trip.trip_id == trip_id, Trip.owner_name == username)).exists())).scalar()
+        commit_and_close(session)
+        membership_cache.set(trip_id, username, is_member, generation)
+    return is_member
+
+
 @app.route('/api/user/<string:username>/join-chat/<int:trip_id>', methods=['GET'])
+@token_required
 def join_chat(username, trip_id):
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
+    if not can_join_chat(username, trip_id):
+        return make_response(jsonify({'Response': 'Can not join to this chat'}), 403)
+    return make_response(jsonify({'Response': 'OK'}), 201)
 
-    participant = session.query(Participant).filter(
-        and_(Participant.trip_id == trip_id, Participant.username == username)).first()
-    owner = session.query(Trip).filter(
-        and_(Trip.trip_id == trip_id, Trip.owner_name == username)).first()
 
-    if participant is None and owner is None:
-        commit_and_close(session)
+"""
+
+    Hit and miss counters of the join chat membership cache
+    Example: curl -i -X GET http://127.0.0.1:5000/api/stats/membership-cache
+    Params: None
+    Response: 
+        - {'size': <entries>, 'max_size': <limit>, 'ttl': <seconds>, 'hits': <n>, 'misses': <n>, 'evictions': <n>}
+"""
+
+
+@app.route('/api/stats/membership-cache', methods=['GET'])
+def get_membership_cache_stats():
+    return make_response(jsonify(membership_cache.stats()), 200)
+
+
+"""
+
+    Post message to the trip chat. You need to be able to join trip chat to post
+    Example: curl -i -X POST -H "Content-Type: application/json" -d '{"text": "See you at the airport"}'
+     http://127.0.0.1:5000/api/user/ala/trip/3/messages
+    Params: text
+    Response: 
+        - {'message_id': <id>, 'trip_id': <trip_id>, 'username': <username>, 'text': <text>, 'created_at': <time>}
+          if message was sent
+        - HTTP Error 422 'Missing required parameter' - if text is missing
+        -HTTP Error 403 if user can not join chat
+"""
+
+
+@app.route('/api/user/<string:username>/trip/<int:trip_id>/messages', methods=['POST'])
+@token_required
+def post_message(username, trip_id):
+    if not request.json or 'text' not in request.json:
+        return make_response(jsonify({'error': 'Missing required parameter'}), 422)
+    if not can_join_chat(username, trip_id):
+        return make_response(jsonify({'Response': 'Can not join to this chat'}), 403)
+    text = request.json.get('text')
+
+    def save_message(session):
+        message = Message(trip_id, username, text)
+        session.add(message)
+        session.flush()
+        return message.convert_to_json()
+
+    try:
+        message = run_write(save_message)
+    except IntegrityError:
+        membership_cache.invalidate_trip(trip_id)
         return make_response(jsonify({'Response': 'Can not join to this chat'}), 403)
+    chat_broker.post(trip_id, message)
+    return make_response(jsonify(message), 201)
+
+
+"""
+
+    Get messages of the trip chat in message_id order, the order they were sent. You need to be able to join
+    trip chat
+    Example: curl -i -X GET http://127.0.0.1:5000/api/user/ala/trip/3/messages?after=120&limit=50
+    Params: after (optional, message_id of the last message the client has), limit (optional, default 100)
+    Response: 
+        - {'Messages': <list of messages>}
+        - HTTP Error 422 if after or limit is invalid
+        -HTTP Error 403 if user can not join chat
+"""
+
+
+def parse_message_id(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        raise InvalidPageParameter()
+
+
+def load_messages(trip_id, after, limit):
+    session = Session()
+    messages = session.query(Message).filter(and_(Message.trip_id == trip_id, Message.message_id > after)).\
+        order_by(Message.message_id).limit(limit).all()
+    response = [m.convert_to_json() for m in messages]
+    commit_and_close(session)
+    return response
+
+
+@app.route('/api/user/<string:username>/trip/<int:trip_id>/messages', methods=['GET'])
+@token_required
+def get_messages(username, trip_id):
+    limit, _ = page_params(request.args)
+    after = parse_message_id(request.args.get('after')) or 0
+    if not can_join_chat(username, trip_id):
+        return make_response(jsonify({'Response': 'Can not join to this chat'}), 403)
+    return make_response(jsonify({'Messages': load_messages(trip_id, after, limit)}), 201)
+
+
+"""
+
+    Subscribe to the trip chat with Server-Sent Events. Every message is sent as event 'message' with its
+    message_id as event id. Messages after Last-Event-ID header (or 'after' param) are sent first, up to
+    TRIP_PAGE_SIZE_MAX of them. A client that reads too slowly gets event 'overflow' and should reconnect.
+    Example: curl -N -H "Last-Event-ID: 120" http://127.0.0.1:5000/api/user/ala/trip/3/messages/stream
+    Params: after (optional)
+    Response: 
+        - text/event-stream with the messages
+        -HTTP Error 403 if user can not join chat
+        -HTTP Error 503 if the server has too many subscribers
+"""
+
+
+def server_sent_event(message):
+    return 'id: %d\nevent: message\ndata: %s\n\n' % (message['message_id'], json.dumps(message))
+
+
+@app.route('/api/user/<string:username>/trip/<int:trip_id>/messages/stream', methods=['GET'])
+@token_required
+def subscribe_messages(username, trip_id):
+    after = parse_message_id(request.headers.get('Last-Event-ID') or request.args.get('after'))
+    if not can_join_chat(username, trip_id):
+        return make_response(jsonify({'Response': 'Can not join to this chat'}), 403)
+    subscription = chat_broker.subscribe(trip_id)
+    missed = load_messages(trip_id, after, config.PAGE_SIZE_MAX) if after is not None else []
+
+    def generate():
+        last_id = after or 0
+        try:
+            for message in missed:
+                last_id = message['message_id']
+                yield server_sent_event(message)
+            while True:
+                try:
+                    message = subscription.get(timeout=config.CHAT_HEARTBEAT)
+                except SubscriptionClosed:
+                    yield 'event: overflow\ndata: {}\n\n'
+                    return
+                if message is None:
+                    if not can_join_chat(username, trip_id):
+                        return
+                    yield ': keep-alive\n\n'
+                elif message['message_id'] > last_id:
+                    last_id = message['message_id']
+                    yield server_sent_event(message)
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+"""
+
+    Subscriber and message counters of the chat broker
+    Example: curl -i -X GET http://127.0.0.1:5000/api/stats/chat
+    Params: None
+    Response: 
+        - {'subscribers': <n>, 'trips': <n>, 'published': <n>, 'dropped_subscribers': <n>}
+"""
 
-    return make_response(jsonify({'Response': 'OK'}), 201)
+
+@app.route('/api/stats/chat', methods=['GET'])
+def get_chat_stats():
+    return make_response(jsonify(chat_broker.stats()), 200)
 
 
 """
@@ -158,7 +513,7 @@ def join_chat(username, trip_id):
     Params: new_password, password 
     
     Response:
-        - {'Response': 'OK'} if password successfully changed 
+        - {'Response': 'OK'} if password successfully changed, all tokens of the user are revoked
         - HTTP Error 422 'Missing required parameter' - if some params is missing 
         -HTTP Error 400 Incorrect username if user doesn't exist 
         -HTTP Error 403 if user provided wrong current password 
@@ -166,7 +521,17 @@ def join_chat(username, trip_id):
 """
 
 
+def revoke_user_tokens(username):
+    """
+        After the commit of a password change or user deletion: tokens issued until now stop working in every
+        worker process.
+    """
+    at = token_service.revoke_user(username)
+    run_write(lambda session: add_user_revocation(session, username, at))
+
+
 @app.route('/api/user/<string:username>/change-password', methods=['PUT'])
+@token_required
 def change_password(username):
     if not request.json or ('new_password' not in request.json or 'password' not in request.json):
         return make_response(jsonify({'error': 'Missing required parameter'}), 422)
@@ -174,21 +539,18 @@ def change_password(username):
     current_password = request.json.get('password')
     new_password = request.json.get('new_password')
 
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
-        commit_and_close(session)
+    password_hash = read_password_hash(username)
+    if password_hash is None:
         return make_response(jsonify({'Response': 'Incorrect username'}), 400)
-
-    if user.verify_password(current_password):
-        user.hash_password(new_password)
-        commit_and_close(session)
-        return make_response(jsonify({'Response': 'OK'}), 201)
-    commit_and_close(session)
-    return make_response(jsonify({'Response': 'Incorrect current password'}), 403)
+    is_valid, _ = hashing_service.verify_and_update(current_password, password_hash)
+    if not is_valid:
+        return make_response(jsonify({'Response': 'Incorrect current password'}), 403)
+    new_hash = hashing_service.hash(new_password)
+    # a password changed meanwhile was not the one verified
+    if not run_write(lambda session: replace_password_hash(session, username, password_hash, new_hash)):
+        return make_response(jsonify({'Response': 'Incorrect current password'}), 403)
+    revoke_user_tokens(username)
+    return make_response(jsonify({'Response': 'OK'}), 201)
 
 
 """
@@ -203,23 +565,31 @@ def change_password(username):
 
 
 @app.route('/api/user/<string:username>/delete', methods=['DELETE'])
+@token_required
 def delete_user(username):
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
-        commit_and_close(session)
+    def remove_user(session):
+        if session.query(User.username).filter_by(username=username).first() is None:
+            return None
+        owned_trip_ids = [trip_id for (trip_id,) in session.query(Trip.trip_id).filter_by(owner_name=username)]
+        participated_trip_ids = [trip_id for (trip_id,) in
+                                 session.query(Participant.trip_id).filter_by(username=username)]
+        version = next_version(session)
+        touch_trip_users(session, owned_trip_ids, version)
+        tombstone_trip_participants(session, owned_trip_ids, version, except_username=username)
+        # trips of the user and all participations go with it through ON DELETE CASCADE
+        session.query(User).filter_by(username=username).delete(synchronize_session=False)
+        record_trip_changes(session, participated_trip_ids, version)
+        next_version(session, USERS_SEQUENCE)
+        add_membership_changes(session, owned_trip_ids, [username])
+        return owned_trip_ids
+
+    owned_trip_ids = run_write(remove_user)
+    if owned_trip_ids is None:
         return make_response(jsonify({'Response': 'Incorrect username'}), 400)
-    trips = session.query(Trip).filter_by(owner_name=username).all()
-    for trip in trips:
-        session.query(Participant).filter_by(trip_id=trip.trip_id).delete()
-    session.query(Trip).filter_by(owner_name=username).delete()
-    session.query(User).filter_by(username=username).delete()
-    session.query(Participant).filter_by(username=username).delete()
-
-    commit_and_close(session)
+    revoke_user_tokens(username)
+    membership_cache.invalidate_user(username)
+    for trip_id in owned_trip_ids:
+        membership_cache.invalidate_trip(trip_id)
     return make_response(jsonify({'Response': 'OK'}), 201)
 
 
@@ -230,107 +600,309 @@ def delete_user(username):
     "date_to": "2020-06-12", "date_from": "2020-06-10", "participants": [{"username": "ela"}, {"username": "aala"}]}'
      http://127.0.0.1:5000/api/user/ela2/create-trip 
 
-    Params: trip_name, date_from, date_to (dates must be in format '%Y-%m-%d' -> 2020-06-12)
+    Params: trip_name, date_from, date_to (dates must be in format '%Y-%m-%d' -> 2020-06-12), participants
     Response: 
-        - {'Trip id': '<trip_id>'} if trip was created successfully 
+        - {'Trip id': '<trip_id>', 'Participants': {<username>: <status>}} if trip was created successfully,
+          status is one of 'added', 'already present', 'unknown user' 
+        - HTTP Error 422 'Invalid participants' if participants is not a list of usernames or {'username': ...}
         -HTTP Error 400 Incorrect username if user doesn't exist
 """
 
 
 @app.route('/api/user/<string:username>/create-trip', methods=['POST'])
+@token_required
 def add_trip(username):
     if not request.json or ('trip_name' not in request.json or 'date_from' not in request.json
                             or 'date_to' not in request.json or 'participants' not in request.json):
         return make_response(jsonify({'error': 'Missing required parameter'}), 422)
 
     datetime_format = '%Y-%m-%d'  # The format
-    participants = request.json.get('participants')
+    participants = participant_usernames(request.json.get('participants'))
     date_from = datetime.strptime(request.json.get('date_from'), datetime_format).date()
     date_to = datetime.strptime(request.json.get('date_to'), datetime_format).date()
     trip_name = request.json.get('trip_name')
 
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
-        commit_and_close(session)
+    def create_trip(session):
+        user = session.query(User).filter_by(username=username).first()
+        if user is None:
+            return None, None
+        version = next_version(session)
+        trip = Trip(trip_name, date_from, date_to, user)
+        session.add(trip)
+        session.flush()
+        results = add_trip_participants(session, participants, trip, version)
+        add_trip_participants(session, [username], trip, version)
+        record_trip_changes(session, [trip.trip_id], version)
+        add_membership_changes(session, [trip.trip_id])
+        return trip.trip_id, results
+
+    trip_id, results = run_write(create_trip)
+    if trip_id is None:
         return make_response(jsonify({'Response': 'Incorrect username'}), 400)
+    membership_cache.invalidate_trip(trip_id)
+    return make_response(jsonify({'Trip id': trip_id, 'Participants': results}), 201)
 
-    trip = Trip(trip_name, date_from, date_to, user)
-    session.add(trip)
-    session.commit()
-    for p in participants:
-        participant = add_participant_from_response(session, p, trip)
-        if participant is not None:
-            session.add(participant)
-    owner_participant = Participant(user, trip)
-    session.add(owner_participant)
-    session.commit()
-    trip_id = trip.trip_id
 
-    session.close()
-    return make_response(jsonify({'Trip id': trip_id}), 201)
+def stream_trips(mode, session, query, limit, after):
+    trips = iter_keyset(query, TripSummary.trip_id, lambda t: t.trip_id, after)
+    return stream_response(mode, (t.convert_to_json_for_user() for t in trips),
+                           limit=limit if 'limit' in request.args else None,
+                           on_close=lambda: commit_and_close(session))
 
 
 """
 
     Get all trips for user where the user is owner. 
-    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/trips 
-    Params: None
+    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/trips?limit=20 
+    Params: limit (optional, default 100), cursor (optional, X-Next-Cursor header of the previous page)
     Response: 
-        - {'Trips: '<list of trip for user>'} if user exists
+        - {'Trips: '<list of trip for user>'} if user exists, ordered by trip_id,
+          X-Next-Cursor header holds the cursor of the next page unless this is the last one
+        - with 'Accept: application/x-ndjson' one trip per line, with 'Accept: application/stream+json'
+          the same list, both streamed from the cursor to the end or up to limit
+        - HTTP Error 422 if limit or cursor is invalid
+        - HTTP 304 with empty body if If-None-Match holds the ETag of the previous response and none of
+          the user's trips changed since
         -HTTP Error 400 Incorrect username if user doesn't exist
 """
 
 
 @app.route('/api/user/<string:username>/trips', methods=['GET'])
+@token_required
 def get_user_trips(username):
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
+    limit, after = page_params(request.args)
+    session = Session()
 
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
+    user_version = session.query(User.version).filter_by(username=username).scalar()
+    if user_version is None:
         commit_and_close(session)
         return make_response(jsonify({'Response': 'Incorrect username'}), 400)
-    trips = session.query(Trip).filter(Trip.owner_name == username).all()
-    participants = []
-    for t in trips:
-        participants.append(session.query(Participant).filter(Participant.trip_id == t.trip_id).all())
-
-    return make_response(jsonify([trips[i].convert_to_json_for_user(participants[i]) for i in range(len(trips))]), 201)
+    etag = version_etag(request, 'trips', user_version)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    query = session.query(TripSummary).filter(and_(TripSummary.username == username, TripSummary.role == 'owner'))
+    mode = stream_mode(request)
+    if mode is not None:
+        return with_etag(stream_trips(mode, session, query, limit, after), etag)
+    trips, next_cursor = paginate(query, TripSummary.trip_id, limit, after, lambda t: t.trip_id)
+    response = [t.convert_to_json_for_user() for t in trips]
+    commit_and_close(session)
+    return with_etag(with_next_cursor(make_response(jsonify(response), 201), next_cursor), etag)
 
 
 """
 
     Get all trips for user. 
-    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/all-trips 
-    Params: None
+    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/all-trips?limit=20 
+    Params: limit (optional, default 100), cursor (optional, X-Next-Cursor header of the previous page)
     Response: 
-        - {'Trips: '<list of trip for user>'} if user exists
+        - {'Trips: '<list of trip for user>'} if user exists, ordered by trip_id,
+          X-Next-Cursor header holds the cursor of the next page unless this is the last one
+        - with 'Accept: application/x-ndjson' one trip per line, with 'Accept: application/stream+json'
+          the same list, both streamed from the cursor to the end or up to limit
+        - HTTP Error 422 if limit or cursor is invalid
+        - HTTP 304 with empty body if If-None-Match holds the ETag of the previous response and none of
+          the user's trips changed since
         -HTTP Error 400 Incorrect username if user doesn't exist
 """
 
 
 @app.route('/api/user/<string:username>/all-trips', methods=['GET'])
+@token_required
 def get_trips(username):
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
+    limit, after = page_params(request.args)
+    session = Session()
 
-    user = session.query(User).filter_by(username=username).first()
+    user_version = session.query(User.version).filter_by(username=username).scalar()
+    if user_version is None:
+        commit_and_close(session)
+        return make_response(jsonify({'Response': 'Incorrect username'}), 400)
+    etag = version_etag(request, 'all-trips', user_version)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    query = session.query(TripSummary).filter(and_(TripSummary.username == username, TripSummary.is_participant))
+    mode = stream_mode(request)
+    if mode is not None:
+        return with_etag(stream_trips(mode, session, query, limit, after), etag)
+    trips_participated, next_cursor = paginate(query, TripSummary.trip_id, limit, after, lambda t: t.trip_id)
+
+    response = [t.convert_to_json_for_user() for t in trips_participated]
+    commit_and_close(session)
+    return with_etag(with_next_cursor(make_response(jsonify(response), 201), next_cursor), etag)
+
+
+def date_range_params(args, required=True):
+    """
+        Read 'date_from' and 'date_to' query parameters, returns (date_from, date_to), (None, None) when
+        both are absent and not required. Raises InvalidDateRange otherwise.
+    """
+    if not required and 'date_from' not in args and 'date_to' not in args:
+        return None, None
+    try:
+        date_from = datetime.strptime(args['date_from'], '%Y-%m-%d').date()
+        date_to = datetime.strptime(args['date_to'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        raise InvalidDateRange()
+    if date_to < date_from:
+        raise InvalidDateRange()
+    return date_from, date_to
+
+
+"""
+
+    Trips of the user (as in all-trips) having at least one day between date_from and date_to
+    Example: curl -i -X GET -H "Content-Type: application/json" 
+    "http://127.0.0.1:5000/api/user/ala/trips-in-range?date_from=2020-06-01&date_to=2020-06-30"
+    Params: date_from, date_to (format '%Y-%m-%d', both days included), limit, cursor (as in all-trips)
+    Response: 
+        - '<list of trips>' ordered by trip_id, X-Next-Cursor header holds the cursor of the next page
+          unless this is the last one, ETag and HTTP 304 as in all-trips
+        - HTTP Error 422 if a date is missing or invalid, date_to is before date_from, or limit or cursor
+          is invalid
+        -HTTP Error 400 Incorrect username if user doesn't exist
+"""
+
+
+@app.route('/api/user/<string:username>/trips-in-range', methods=['GET'])
+@token_required
+def get_trips_in_range(username):
+    limit, after = page_params(request.args)
+    date_from, date_to = date_range_params(request.args)
+    session = Session()
+
+    user = session.query(User.version, User.user_key).filter_by(username=username).first()
     if user is None:
         commit_and_close(session)
         return make_response(jsonify({'Response': 'Incorrect username'}), 400)
-    trips_participated = session.query(Trip).join(Participant, Trip.trip_id == Participant.trip_id).\
-        filter(Participant.username == username).all()
+    etag = version_etag(request, 'trips-in-range', user.version)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    query = session.query(TripSummary).filter(and_(
+        TripSummary.username == username, TripSummary.trip_id.in_(overlapping_trip_ids(user.user_key, date_from,
+                                                                                       date_to))))
+    trips, next_cursor = paginate(query, TripSummary.trip_id, limit, after, lambda t: t.trip_id)
+    response = [t.convert_to_json_for_user() for t in trips]
+    commit_and_close(session)
+    return with_etag(with_next_cursor(make_response(jsonify(response), 201), next_cursor), etag)
+
 
-    participants = []
-    for t in trips_participated:
-        participants.append(session.query(Participant).filter(Participant.trip_id == t.trip_id).all())
-    response = [trips_participated[i].convert_to_json_for_user(participants[i]) for i in range(len(trips_participated))]
+"""
+
+    Pairs of the user's trips (as in all-trips) sharing at least one day
+    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/conflicts
+    Params: date_from, date_to (optional, only trips having days in this range are checked),
+            limit (optional, default 100), cursor (optional, X-Next-Cursor header of the previous page)
+    Response: 
+        - {'Conflicts': [{'trip_ids': [<trip_id>, <trip_id>], 'date_from': <first common day>,
+          'date_to': <last common day>}]} ordered by the start of the second trip, X-Next-Cursor header holds
+          the cursor of the next page unless this is the last one, ETag and HTTP 304 as in all-trips
+        - HTTP Error 422 if a date is invalid or date_to is before date_from, or limit or cursor is invalid
+        -HTTP Error 400 Incorrect username if user doesn't exist
+"""
+
+
+@app.route('/api/user/<string:username>/conflicts', methods=['GET'])
+@token_required
+def get_conflicts(username):
+    limit, after = page_params(request.args, list)
+    if after is not None and (len(after) != 6 or not all(type(value) is int for value in after)):
+        raise InvalidPageParameter()
+    date_from, date_to = date_range_params(request.args, required=False)
+    session = Session()
+
+    user = session.query(User.version, User.user_key).filter_by(username=username).first()
+    if user is None:
+        commit_and_close(session)
+        return make_response(jsonify({'Response': 'Incorrect username'}), 400)
+    etag = version_etag(request, 'conflicts', user.version)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    query = session.query(TripSummary.trip_id, TripSummary.date_from, TripSummary.date_to).\
+        filter(and_(TripSummary.username == username, TripSummary.is_participant))
+    if date_from is not None:
+        query = query.filter(TripSummary.trip_id.in_(overlapping_trip_ids(user.user_key, date_from, date_to)))
+    conflicts, next_key = find_conflicts(query.all(), limit, after)
+    response = [{'trip_ids': [first, second], 'date_from': str(common_from), 'date_to': str(common_to)}
+                for first, second, common_from, common_to in conflicts]
+    commit_and_close(session)
+    next_cursor = encode_cursor(next_key) if next_key is not None else None
+    return with_etag(with_next_cursor(make_response(jsonify({'Conflicts': response}), 201), next_cursor), etag)
+
+
+"""
+
+    Search the user's trips (owned or participated) by name, every word of q matches the beginning of a word
+    of the name, case and accents are ignored
+    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/search?q=wars
+    Params: q, limit (optional, default 100)
+    Response: 
+        - '<list of trips>' best matches first, ETag and HTTP 304 as in all-trips
+        - HTTP Error 422 if q has no words or limit is invalid
+        -HTTP Error 400 Incorrect username if user doesn't exist
+"""
+
+
+@app.route('/api/user/<string:username>/search', methods=['GET'])
+@token_required
+def search_trips(username):
+    limit, _ = page_params(request.args)
+    expression = match_expression(request.args.get('q'))
+    if expression is None:
+        return make_response(jsonify({'error': 'Missing required parameter'}), 422)
+    session = Session()
+
+    user_version = session.query(User.version).filter_by(username=username).scalar()
+    if user_version is None:
+        commit_and_close(session)
+        return make_response(jsonify({'Response': 'Incorrect username'}), 400)
+    etag = version_etag(request, 'search', user_version)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    ranked = ranked_trip_ids(expression)
+    trips = session.query(TripSummary).join(ranked, ranked.c.trip_id == TripSummary.trip_id).\
+        filter(TripSummary.username == username).order_by(ranked.c.rank, TripSummary.trip_id).limit(limit).all()
+    response = [t.convert_to_json_for_user() for t in trips]
+    commit_and_close(session)
+    return with_etag(make_response(jsonify(response), 201), etag)
+
+
+"""
+
+    Changes of the user's trips (the trips returned by all-trips) since the previous sync
+    Example: curl -i -X GET -H "Content-Type: application/json" http://127.0.0.1:5000/api/user/ala/sync?cursor=Mw
+    Params: cursor (optional, 'cursor' from the previous response, without it all trips are returned)
+    Response: 
+        - {'Trips': <list of changed or new trips>, 'Deleted': <list of trip_id no longer on the list>,
+          'cursor': <cursor for the next sync>} if user exists
+        -HTTP Error 400 Incorrect username if user doesn't exist
+        - HTTP Error 422 if cursor is invalid
+"""
+
+
+@app.route('/api/user/<string:username>/sync', methods=['GET'])
+@token_required
+def sync_trips(username):
+    cursor = request.args.get('cursor')
+    since = decode_cursor(cursor, int) if cursor else -1
+    session = Session()
+
+    user = session.query(User).filter_by(username=username).first()
+    if user is None:
+        commit_and_close(session)
+        return make_response(jsonify({'Response': 'Incorrect username'}), 400)
+    changed, deleted, version = changes_since(session, username, since)
+    response = {'Trips': [t.convert_to_json_for_user() for t in changed], 'Deleted': deleted,
+                'cursor': encode_cursor(version)}
     commit_and_close(session)
     return make_response(jsonify(response), 201)
 
@@ -348,25 +920,28 @@ def get_trips(username):
 
 
 @app.route('/api/user/<string:username>/trip/<string:trip_id>/delete', methods=['DELETE'])
+@token_required
 def delete_trip(username, trip_id):
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
-        commit_and_close(session)
+    def remove_trip(session):
+        if session.query(User.username).filter_by(username=username).first() is None:
+            return 'unknown user'
+        owned = session.query(Trip.trip_id).filter(and_(Trip.trip_id == trip_id, Trip.owner_name == username))
+        if owned.first() is None:
+            return 'not owner'
+        version = next_version(session)
+        touch_trip_users(session, owned, version)
+        tombstone_trip_participants(session, owned, version)
+        owned.delete(synchronize_session=False)
+        add_membership_changes(session, [trip_id])
+        return 'deleted'
+
+    result = run_write(remove_trip)
+    if result == 'unknown user':
         return make_response(jsonify({'Response': 'Incorrect username'}), 400)
-    trip = session.query(Trip).filter_by(trip_id=trip_id).first()
-
-    if trip is not None and trip.is_owner(user):
-        session.query(Trip).filter_by(trip_id=trip_id).delete()
-        session.query(Participant).filter_by(trip_id=trip_id).delete()
-        commit_and_close(session)
-        return make_response(jsonify({'Response': 'OK'}), 201)
-    else:
-        commit_and_close(session)
+    if result == 'not owner':
         return make_response(jsonify({'Response': 'User is not the owner of trip or trip doesn\'t exist'}), 403)
+    membership_cache.invalidate_trip(trip_id)
+    return make_response(jsonify({'Response': 'OK'}), 201)
 
 
 """
@@ -375,66 +950,56 @@ def delete_trip(username, trip_id):
     Example: curl -i -X PUT -H "Content-Type: application/json" -d '{ "trip_name": "hohonewtrip"}'
      http://127.0.0.1:5000/api/user/aala/trip/1/update
      
-    Params: trip_name or (date_to and date_form) 
+    Params: trip_name or (date_to and date_form) or participants
     Response: 
-    - {'Response': 'OK'} if trip was updated successfully 
+    - {'Response': 'OK'} if trip was updated successfully, with 'Participants': {<username>: <status>}
+      when participants were sent 
     - HTTP Error 422 'Missing required parameter' - if some params is missing 
+    - HTTP Error 422 'Invalid participants' if participants is not a list of usernames or {'username': ...}
     -HTTP Error 400 Incorrect username if user doesn't exist 
     -HTTP Error 403 if user is not the owner of trip or trip doesn't exist 
     
 """
 
 
-def update_participants(participants, trip, session):
-    for p in participants:
-        user = session.query(User).filter_by(username=p).first()
-
-        if user is not None:
-            participant = session.query(Participant).filter_by(username=user.username, trip_id=trip.trip_id).first()
-            if participant is None:
-                new_participant = Participant(user, trip)
-                session.add(new_participant)
-
-
 @app.route('/api/user/<string:username>/trip/<string:trip_id>/update', methods=['PUT'])
+@token_required
 def update_trip(username, trip_id):
     if request.json is None:
         return make_response(jsonify({'error': 'Missing required parameter'}), 422)
-
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    user = session.query(User).filter_by(username=username).first()
-    if user is None:
-        commit_and_close(session)
-        return make_response(jsonify({'error': 'Incorrect username'}), 400)
-
-    trip = session.query(Trip).filter_by(trip_id=trip_id).first()
+    participants = participant_usernames(request.json['participants']) if 'participants' in request.json else None
 
     datetime_format = '%Y-%m-%d'
-    isChanged = False
-
-    if trip is not None and trip.is_owner(user):
-
-        if 'date_from' in request.json:
-            isChanged = True
-            trip.date_from = datetime.strptime(request.json['date_from'], datetime_format).date()
-        if 'date_to' in request.json:
-            isChanged = True
-            trip.date_to = datetime.strptime(request.json['date_to'], datetime_format).date()
-        if 'trip_name' in request.json:
-            isChanged = True
-            trip.trip_name = request.json['trip_name']
-        if 'participants' in request.json:
-            isChanged = True
-            update_participants(request.json['participants'], trip, session)
-        commit_and_close(session)
-        if isChanged:
-            return make_response(jsonify({'Response': 'OK'}), 201)
+    changes = {}
+    if 'date_from' in request.json:
+        changes['date_from'] = datetime.strptime(request.json['date_from'], datetime_format).date()
+    if 'date_to' in request.json:
+        changes['date_to'] = datetime.strptime(request.json['date_to'], datetime_format).date()
+    if 'trip_name' in request.json:
+        changes['trip_name'] = request.json['trip_name']
+    if not changes and participants is None:
         return make_response(jsonify({'error': 'Missing at least one required parameter'}), 422)
 
-    return make_response(jsonify({'Response': 'User is not the owner of trip or trip doesn\'t exist'}), 403)
+    def change_trip(session):
+        if session.query(User.username).filter_by(username=username).first() is None:
+            return 400, {'error': 'Incorrect username'}
+        trip = session.query(Trip).filter_by(trip_id=trip_id).first()
+        if trip is None or trip.owner_name != username:
+            return 403, {'Response': 'User is not the owner of trip or trip doesn\'t exist'}
+        for column, value in changes.items():
+            setattr(trip, column, value)
+        version = next_version(session)
+        response = {'Response': 'OK'}
+        if participants is not None:
+            response['Participants'] = add_trip_participants(session, participants, trip, version)
+        record_trip_changes(session, [trip_id], version)
+        add_membership_changes(session, [trip_id])
+        return 201, response
+
+    status, response = run_write(change_trip)
+    if status == 201:
+        membership_cache.invalidate_trip(trip_id)
+    return make_response(jsonify(response), status)
 
 
 """
@@ -444,6 +1009,8 @@ def update_trip(username, trip_id):
     Params: None
     Response: 
         - {'Participants: '<list of participants for trip>'} if trip exists
+        - HTTP 304 with empty body if If-None-Match holds the ETag of the previous response and the trip
+          didn't change since
         -HTTP Error 400 Incorrect trip_id, trip doesn't exist
 """
 
@@ -454,17 +1021,21 @@ def get_user_participants(participants):
 
 @app.route('/api/trip/<int:trip_id>/participants', methods=['GET'])
 def get_participants(trip_id):
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
+    session = Session()
 
-    trip = session.query(Trip).filter_by(trip_id=trip_id).first()
-    if trip is None:
+    trip_version = session.query(Trip.version).filter_by(trip_id=trip_id).scalar()
+    if trip_version is None:
         commit_and_close(session)
         return make_response(jsonify({'Response': 'Incorrect trip_id '}), 400)
-    participants = session.query(Participant).filter_by(trip_id=trip.trip_id).all()
+    etag = version_etag(request, 'participants', trip_version)
+    cached = not_modified(request, etag, private=False)
+    if cached is not None:
+        commit_and_close(session)
+        return cached
+    participants = session.query(Participant).filter_by(trip_id=trip_id).all()
+    response = [p.convert_to_json() for p in participants]
     commit_and_close(session)
-    return make_response(jsonify({"Participants": [p.convert_to_json() for p in participants]}), 201)
+    return with_etag(make_response(jsonify({"Participants": response}), 201), etag, private=False)
 
 
 """
@@ -475,41 +1046,103 @@ def get_participants(trip_id):
 
     Params:participants list
     Response: 
-        - {'Response': 'OK'} if users was added successfully 
+        - {'Response': 'OK', 'Participants': {<username>: <status>}} if request was processed,
+          status is one of 'added', 'already present', 'unknown user' 
         - HTTP Error 422 'Missing required parameter' - if some params is missing 
+        - HTTP Error 422 'Invalid participants' if participants is not a list of usernames or {'username': ...}
         -HTTP Error 403 if user is not the owner of trip or trip doesn't exist
 
 """
 
 
-def add_participant_from_response(session, json_participant, trip):
-    user = session.query(User).filter_by(username=json_participant).first()
-    if user is not None:
-        return Participant(user, trip)
-    return None
+def participant_usernames(json_participants):
+    """
+        Usernames of a participants list, duplicates dropped. Entries are usernames or {'username': <username>},
+        anything else raises InvalidParticipants before the request writes.
+    """
+    if not isinstance(json_participants, list):
+        raise InvalidParticipants()
+    usernames = []
+    for json_participant in json_participants:
+        if isinstance(json_participant, dict):
+            json_participant = json_participant.get('username')
+        if not isinstance(json_participant, str):
+            raise InvalidParticipants()
+        usernames.append(json_participant)
+    return list(OrderedDict.fromkeys(usernames))
+
+
+def select_in_chunks(query, column, values, chunk_size=500):
+    for i in range(0, len(values), chunk_size):
+        for row in query.filter(column.in_(values[i:i + chunk_size])):
+            yield row
+
+
+def add_trip_participants(session, usernames, trip, version):
+    """
+        Add users to the trip using one IN query for the users and one for the existing participants,
+        then a single bulk insert. Returns {<username>: 'added' | 'already present' | 'unknown user'}.
+    """
+    now = datetime.utcnow()
+    known = {u for (u,) in select_in_chunks(session.query(User.username), User.username, usernames)}
+    present = {u for (u,) in select_in_chunks(
+        session.query(Participant.username).filter(Participant.trip_id == trip.trip_id),
+        Participant.username, usernames)}
+
+    results = {}
+    new_participants = []
+    for username in usernames:
+        if username not in known:
+            results[username] = 'unknown user'
+        elif username in present:
+            results[username] = 'already present'
+        else:
+            results[username] = 'added'
+            new_participants.append({'username': username, 'trip_id': trip.trip_id,
+                                     'version': version, 'updated_at': now})
+    if new_participants:
+        session.bulk_insert_mappings(Participant, new_participants)
+    return results
+
+
+def remove_trip_participants(session, usernames, trip_id, version):
+    """
+        Remove users from the trip with one IN query and one bulk delete, leaving sync tombstones for them.
+        Returns {<username>: 'removed' | 'not a participant'}.
+    """
+    present = {u for (u,) in select_in_chunks(
+        session.query(Participant.username).filter(Participant.trip_id == trip_id),
+        Participant.username, usernames)}
+    to_remove = [u for u in usernames if u in present]
+    for i in range(0, len(to_remove), 500):
+        session.query(Participant).filter(
+            and_(Participant.trip_id == trip_id, Participant.username.in_(to_remove[i:i + 500]))).\
+            delete(synchronize_session=False)
+    add_tombstones(session, [(u, trip_id) for u in to_remove], version)
+    return {u: 'removed' if u in present else 'not a participant' for u in usernames}
 
 
 @app.route('/api/user/<string:username>/trip/<int:trip_id>/add-participants', methods=['POST'])
+@token_required
 def add_participants(username, trip_id):
     if not request.json or 'participants' not in request.json:
         return make_response(jsonify({'error': 'Missing required parameter'}), 422)
-    participants = request.json.get('participants')
-
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
-
-    trip = session.query(Trip).filter(and_(Trip.trip_id == trip_id, Trip.owner_name == username)).first()
-    if trip is not None:
-        for p in participants:
-            participant = add_participant_from_response(session, p, trip)
-            if participant is not None:
-                session.add(participant)
-
-        commit_and_close(session)
-        return make_response(jsonify({'Response': 'OK'}), 201)
-
-    commit_and_close(session)
+    participants = participant_usernames(request.json.get('participants'))
+
+    def add_to_trip(session):
+        trip = session.query(Trip).filter(and_(Trip.trip_id == trip_id, Trip.owner_name == username)).first()
+        if trip is None:
+            return None
+        version = next_version(session)
+        results = add_trip_participants(session, participants, trip, version)
+        record_trip_changes(session, [trip_id], version)
+        add_membership_changes(session, [trip_id])
+        return results
+
+    results = run_write(add_to_trip)
+    if results is not None:
+        membership_cache.invalidate_trip(trip_id)
+        return make_response(jsonify({'Response': 'OK', 'Participants': results}), 201)
     return make_response(jsonify({'Error': 'User is not the owner of trip or trip doesn\'t exist'}), 403)
 
 
@@ -522,33 +1155,306 @@ def add_participants(username, trip_id):
 
     Params:participants list
     Response: 
-        - {'Response': 'OK'} if users was deleted successfully 
+        - {'Response': 'OK', 'Participants': {<username>: <status>}} if request was processed,
+          status is one of 'removed', 'not a participant' 
         - HTTP Error 422 'Missing required parameter' - if some params is missing 
+        - HTTP Error 422 'Invalid participants' if participants is not a list of usernames or {'username': ...}
         -HTTP Error 403 if user is not the owner of trip or trip doesn't exist 
 
 """
 
 
 @app.route('/api/user/<string:username>/trip/<int:trip_id>/delete-participants', methods=['DELETE'])
+@token_required
 def delete_participants(username, trip_id):
     if not request.json or 'participants' not in request.json:
         return make_response(jsonify({'error': 'Missing required parameter'}), 422)
-    participants = request.json.get('participants')
+    participants = participant_usernames(request.json.get('participants'))
+
+    def remove_from_trip(session):
+        trip = session.query(Trip).filter(and_(Trip.trip_id == trip_id, Trip.owner_name == username)).first()
+        if trip is None:
+            return None
+        version = next_version(session)
+        results = remove_trip_participants(session, participants, trip_id, version)
+        record_trip_changes(session, [trip_id], version)
+        add_membership_changes(session, [trip_id])
+        return results
+
+    results = run_write(remove_from_trip)
+    if results is not None:
+        membership_cache.invalidate_trip(trip_id)
+        return make_response(jsonify({'Response': 'OK', 'Participants': results}), 201)
+    return make_response(jsonify({'Error': 'User is not the owner of trip or trip doesn\'t exist'}), 403)
 
-    e = create_engine("sqlite:///trip_communicator.db")
-    Ses = sessionmaker(bind=e)
-    session = Ses()
 
-    trip = session.query(Trip).filter(and_(Trip.trip_id == trip_id, Trip.owner_name == username)).first()
-    if trip is not None:
-        for p in participants:
-            session.query(Participant).filter(
-                and_(Participant.username == p, Participant.trip_id == trip_id)).delete()
-        commit_and_close(session)
-        return make_response(jsonify({'Response': 'OK'}), 201)
-    commit_and_close(session)
-    return make_response(jsonify({'Error': 'User is not the owner of trip or trip doesn\'t exist'}), 403)
+"""
+
+    Run several operations in one request and one transaction. Operations are requests to the routes
+    below, with the Authorization header of the batch; {<i>[<key>]} in a path is replaced by <key> of the
+    response of operation i, e.g. the id of a trip created earlier in the batch
+    Example: curl -i -X POST -H "Content-Type: application/json" -d '{"operations": [
+        {"method": "POST", "path": "/api/user/ala/create-trip", "body": {"trip_name": "Rome",
+         "date_from": "2020-06-01", "date_to": "2020-06-05", "participants": ["ela"]}},
+        {"method": "POST", "path": "/api/user/ala/trip/{0[Trip id]}/add-participants",
+         "body": {"participants": ["aala"]}},
+        {"method": "PUT", "path": "/api/user/ala/trip/{0[Trip id]}/update", "body": {"trip_name": "Rome 2020"}}]}'
+        http://127.0.0.1:5000/api/batch
+    Params: operations (list of {'method', 'path', 'body' (optional)}, at most TRIP_BATCH_MAX_OPERATIONS),
+            atomic (optional, default true: the first failing operation undoes the whole batch; false: only
+            failing operations are undone)
+    Routes: users, trips, all-trips, trips-in-range, conflicts, search, sync, participants, join-chat, messages (GET),
+            create-trip, update, delete (trip), add-participants, delete-participants
+    Response: 
+        - {'Response': 'OK', 'Results': [{'status': <HTTP status>, 'body': <response>}]} if the batch was saved
+        - HTTP Error 409 {'error': ..., 'failed': <index>, 'Results': <results up to the failing one>}
+          if an atomic batch failed, nothing was saved
+        - HTTP Error 422 'Missing required parameter' - if operations is missing or not a list,
+          'Too many operations' above the limit
+"""
+
+BATCH_ENDPOINTS = {'get_users', 'get_user_trips', 'get_trips', 'get_trips_in_range', 'get_conflicts', 'search_trips',
+                   'sync_trips', 'get_participants', 'join_chat', 'get_messages', 'add_trip', 'update_trip',
+                   'delete_trip', 'add_participants', 'delete_participants'}
+RESULT_REFERENCE = re.compile(r'\{(\d+)\[([^\]]+)\]\}')
+
+
+def resolve_references(path, bodies):
+    """
+        path with {<i>[<key>]} replaced from the responses of earlier operations, None if one is missing.
+    """
+    missing = []
+
+    def value(match):
+        index, key = int(match.group(1)), match.group(2)
+        if index < len(bodies) and isinstance(bodies[index], dict) and key in bodies[index]:
+            return quote(str(bodies[index][key]), safe='')
+        missing.append(match.group(0))
+        return ''
+
+    path = RESULT_REFERENCE.sub(value, path)
+    return None if missing else path
+
+
+def run_operation(operation, bodies):
+    """
+        (status, JSON body, trip_id or None) of one batch operation, run by the route's handler on the batch's
+        session.
+    """
+    if not isinstance(operation, dict) or not isinstance(operation.get('method'), str) \
+            or not isinstance(operation.get('path'), str):
+        return 422, {'error': 'Missing required parameter'}, None
+    path = resolve_references(operation['path'], bodies)
+    if path is None:
+        return 422, {'error': 'Reference to a missing result'}, None
+    headers = {'Authorization': request.headers['Authorization']} if 'Authorization' in request.headers else {}
+    body = {'json': operation['body']} if operation.get('body') is not None else {}
+    builder = EnvironBuilder(path=path, method=operation['method'].upper(), base_url=request.host_url,
+                             headers=headers, **body)
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    with app.request_context(environ):
+        if request.routing_exception is not None:
+            return 404, {'error': 'Unknown operation'}, None
+        if request.url_rule.endpoint not in BATCH_ENDPOINTS:
+            return 403, {'error': 'Operation not allowed in a batch'}, None
+        try:
+            response = app.full_dispatch_request()
+        except Exception:
+            app.log_exception(sys.exc_info())
+            return 500, {'error': 'Internal Server Error'}, None
+        body = response.get_json(silent=True)
+        trip_id = request.view_args.get('trip_id') or (body.get('Trip id') if isinstance(body, dict) else None)
+        return response.status_code, body, trip_id
+
+
+@app.route('/api/batch', methods=['POST'])
+def run_batch():
+    operations = request.json.get('operations') if isinstance(request.json, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return make_response(jsonify({'error': 'Missing required parameter'}), 422)
+    if len(operations) > config.BATCH_MAX_OPERATIONS:
+        return make_response(jsonify({'error': 'Too many operations'}), 422)
+    atomic = request.json.get('atomic', True) is not False
+
+    results = []
+    changed_trip_ids = set()
+    with batch_session() as session:
+        for operation in operations:
+            savepoint = session.begin_nested()
+            status, body, trip_id = run_operation(operation, [result['body'] for result in results])
+            if savepoint.is_active:
+                if status < 400:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+            results.append({'status': status, 'body': body})
+            if status < 400 and trip_id is not None and operation['method'].upper() != 'GET':
+                changed_trip_ids.add(trip_id)
+            if atomic and status >= 400:
+                name_route(request.url_rule.rule)
+                return make_response(jsonify({'error': 'Operation %d failed, nothing was saved' % (len(results) - 1),
+                                              'failed': len(results) - 1, 'Results': results}), 409)
+        session.commit_batch()
+    # handlers invalidated these before the commit, a concurrent request may have cached the old membership since
+    for trip_id in changed_trip_ids:
+        membership_cache.invalidate_trip(trip_id)
+    name_route(request.url_rule.rule)
+    return make_response(jsonify({'Response': 'OK', 'Results': results}), 201)
+
+
+"""
+
+    Liveness and readiness probes for process supervisors and load balancers
+    Example: curl -i http://127.0.0.1:5000/health/ready
+    Params: None
+    Response: 
+        - live: {'status': 'ok', 'pid': <worker pid>} while the worker answers requests
+        - ready: {'status': 'ready', 'schema_version': <n>} if the database answers and its schema is up
+          to date, HTTP Error 503 with 'status': 'not ready' otherwise
+"""
+
+
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    return make_response(jsonify({'status': 'ok', 'pid': os.getpid()}), 200)
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    try:
+        version = schema_version()
+    except Exception:
+        return make_response(jsonify({'status': 'not ready', 'error': 'Database unavailable'}), 503)
+    if version != LATEST_VERSION:
+        return make_response(jsonify({'status': 'not ready', 'error': 'Database schema is out of date',
+                                      'schema_version': version}), 503)
+    return make_response(jsonify({'status': 'ready', 'schema_version': version}), 200)
+
+
+"""
+
+    Request metrics of all workers in the Prometheus text format, for scraping
+    Example: curl -i http://127.0.0.1:5000/metrics
+    Params: None
+    Response: 
+        - per route latency, response size and SQL statement histograms, SQL time and slow statement counters,
+          password hashing time
+        - HTTP Error 404 if TRIP_METRICS=0
+"""
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not config.METRICS:
+        return make_response(jsonify({'error': 'Not found'}), 404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+"""
+
+    Slowest requests of the last one or two TRIP_SLOW_REQUESTS_WINDOW, slowest first, with their SQL
+    Example: curl -i -H "X-Admin-Secret: <secret>" http://127.0.0.1:5000/api/admin/slow-requests
+    Params: None
+    Response: 
+        - {'Requests': [{'method', 'path', 'route', 'status', 'ms', 'finished_at', 'response_bytes',
+          'statement_count', 'sql_ms', 'statements': [{'sql', 'ms'}]}]}, statements lists the first 100
+        - HTTP Error 401 if X-Admin-Secret is wrong, 404 if TRIP_ADMIN_SECRET is unset
+"""
+
+
+@app.route('/api/admin/slow-requests', methods=['GET'])
+@admin_required
+def get_slow_requests():
+    return make_response(jsonify({'Requests': metrics.slow_requests.snapshot()}), 200)
+
+
+"""
+
+    Profiles of requests sent with 'X-Profile: <secret>' header or profile=<secret> query parameter,
+    the id of a profile is in the X-Profile-Id header of the profiled response
+    Example: curl -i -H "X-Profile: <secret>" http://127.0.0.1:5000/api/user/ala/all-trips
+             curl -H "X-Admin-Secret: <secret>" http://127.0.0.1:5000/api/admin/profiles/<id>?sort=tottime
+    Params: sort (optional, pstats order, default cumulative), limit (optional, functions listed, default 50),
+            format (optional, 'pstats' for the profile file, to open with pstats or snakeviz)
+    Response: 
+        - list: {'Profiles': [{'id', 'method', 'path', 'status', 'ms', 'created_at', 'statements'}]}, newest first
+        - one profile: pstats report as text
+        - HTTP Error 404 if the profile is not kept any more, 422 if sort or limit is invalid
+        - HTTP Error 401 if X-Admin-Secret is wrong, 404 if TRIP_ADMIN_SECRET is unset
+"""
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def get_profiles():
+    return make_response(jsonify({'Profiles': profile_store.list()}), 200)
+
+
+@app.route('/api/admin/profiles/<string:profile_id>', methods=['GET'])
+@admin_required
+def get_profile(profile_id):
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        return make_response(jsonify({'error': 'Unknown profile'}), 404)
+    if request.args.get('format') == 'pstats':
+        return Response(profile[1], mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=%s.prof' % profile_id})
+    try:
+        text = report(profile[1], request.args.get('sort', 'cumulative'), int(request.args.get('limit', 50)))
+    except (KeyError, ValueError):
+        return make_response(jsonify({'error': 'Invalid sort or limit'}), 422)
+    return Response(text, mimetype='text/plain')
+
+
+"""
+
+    Export users, trips, participants and chat messages as NDJSON, streamed, one row per line with its table
+    Example: curl -H "X-Admin-Secret: <secret>" http://127.0.0.1:5000/api/admin/export > backup.ndjson
+    Params: None
+    Response: 
+        - rows of users, then trips, participants and messages, e.g. {"table": "users", "username": "ala",
+          "password_hash": "..."}
+        - HTTP Error 401 if X-Admin-Secret is wrong, 404 if TRIP_ADMIN_SECRET is unset
+"""
+
+
+@app.route('/api/admin/export', methods=['GET'])
+@admin_required
+def export_data():
+    return Response(export_ndjson(), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=trip_communicator.ndjson'})
+
+
+"""
+
+    Import rows in the format of /api/admin/export, TRIP_IMPORT_BATCH_SIZE rows per transaction; rows whose
+    key exists are skipped, users may have 'password' instead of 'password_hash'
+    Example: curl -i -X POST -H "X-Admin-Secret: <secret>" -H "Content-Type: application/x-ndjson"
+     --data-binary @backup.ndjson http://127.0.0.1:5000/api/admin/import
+    Params: NDJSON body
+    Response: 
+        - {'Response': 'OK', 'Tables': {<table>: {'inserted': <n>, 'skipped': <n>}}} if all lines were imported
+        - HTTP Error 422 {'error': 'line <n>: <reason>'} at the first bad line, batches before it are imported
+        - HTTP Error 401 if X-Admin-Secret is wrong, 404 if TRIP_ADMIN_SECRET is unset
+"""
+
+
+@app.route('/api/admin/import', methods=['POST'])
+@admin_required
+def import_data():
+    try:
+        counts = import_ndjson(request.stream)
+    except InvalidImportLine as e:
+        return make_response(jsonify({'error': str(e)}), 422)
+    finally:
+        membership_cache.clear()
+        run_write(lambda session: add_membership_changes(session, everything=True))
+    return make_response(jsonify({'Response': 'OK', 'Tables': counts}), 201)
 
 
 if __name__ == '__main__':
+    migrate_database()
     app.run(host='0.0.0.0', debug=True, port=5000)
@@ -0,0 +1,160 @@
+import asyncio
+import queue
+import threading
+from collections import defaultdict
+
+import config
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class SubscriptionClosed(Exception):
+    pass
+
+
+class Subscription:
+    def __init__(self, broker, trip_id, max_queue):
+        self.broker = broker
+        self.trip_id = trip_id
+        self.overflowed = False
+        self._queue = queue.Queue(max_queue)
+
+    def offer(self, message):
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.overflowed = True
+            return False
+
+    def get(self, timeout=None):
+        """
+            Next message or None after timeout. Raises SubscriptionClosed once an overflowed subscription
+            has handed out everything it still holds.
+        """
+        try:
+            return self._queue.get(timeout=0 if self.overflowed else timeout)
+        except queue.Empty:
+            if self.overflowed:
+                raise SubscriptionClosed()
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """
+        Subscription read by a coroutine on loop, offer may be called from any thread. Messages are handed
+        to the loop with call_soon_threadsafe; on overflow a marker is queued after them, so the reader gets
+        everything offered before SubscriptionClosed.
+    """
+    _CLOSED = object()
+
+    def __init__(self, broker, trip_id, max_queue, loop):
+        self.broker = broker
+        self.trip_id = trip_id
+        self.overflowed = False
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._max_queue = max_queue
+        self._pending = 0
+        self._queue = asyncio.Queue()
+
+    def offer(self, message):
+        with self._lock:
+            if self.overflowed:
+                return False
+            if self._pending >= self._max_queue:
+                self.overflowed = True
+                message = self._CLOSED
+            else:
+                self._pending += 1
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        return message is not self._CLOSED
+
+    async def get(self, timeout=None):
+        try:
+            message = await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is self._CLOSED:
+            raise SubscriptionClosed()
+        with self._lock:
+            self._pending -= 1
+        return message
+
+
+class ChatBroker:
+    """
+        In-process pub/sub of chat messages per trip. Each subscriber has a bounded queue; a subscriber whose
+        queue is full is dropped instead of slowing down the publisher, and is expected to reconnect and
+        read what it missed from the database. Only subscribers of this process are reached; with several
+        worker processes each one sets relayed and db/chat_relay.py publishes what any worker wrote.
+    """
+
+    def __init__(self, max_queue=config.CHAT_SUBSCRIBER_QUEUE, max_subscribers=config.CHAT_MAX_SUBSCRIBERS):
+        self.max_queue = max_queue
+        self.max_subscribers = max_subscribers
+        self.published = 0
+        self.dropped_subscribers = 0
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._count = 0
+        self.relayed = False
+
+    def subscribe(self, trip_id, loop=None):
+        """
+            With loop, returns an AsyncSubscription to be read by a coroutine running on it.
+        """
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise TooManySubscribers()
+            if loop is None:
+                subscription = Subscription(self, trip_id, self.max_queue)
+            else:
+                subscription = AsyncSubscription(self, trip_id, self.max_queue, loop)
+            self._subscribers[trip_id].add(subscription)
+            self._count += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.trip_id)
+            if subscribers is not None and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.trip_id]
+
+    def publish(self, trip_id, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(trip_id, ()))
+            self.published += 1
+        for subscription in subscribers:
+            if not subscription.offer(message):
+                self.unsubscribe(subscription)
+                with self._lock:
+                    self.dropped_subscribers += 1
+        return len(subscribers)
+
+    def post(self, trip_id, message):
+        """
+            Called after message was committed. Publishes it unless the relay will, in message_id order.
+        """
+        if not self.relayed:
+            self.publish(trip_id, message)
+
+    def has_subscribers(self):
+        with self._lock:
+            return self._count > 0
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': self._count, 'trips': len(self._subscribers), 'published': self.published,
+                    'dropped_subscribers': self.dropped_subscribers}
+
+
+chat_broker = ChatBroker()
@@ -0,0 +1,52 @@
+"""
+    Conditional GET for the read endpoints. ETags are weak and built from the version counters kept in
+    db/sync.py instead of hashing the body, so a matching If-None-Match is answered with 304 after one
+    primary key lookup, before any listing query runs. The version is read before the data, a write
+    committing in between only makes the tag older than the body and the next request refetches.
+"""
+import hashlib
+
+from flask import make_response
+from werkzeug.http import parse_etags
+
+import config
+from services.streaming import stream_mode
+
+
+def version_etag(request, resource, version):
+    return make_etag(resource, version, request.query_string, stream_mode(request))
+
+
+def make_etag(resource, version, query_string, mode=None):
+    """
+        Query string and the streaming mode from Accept select a different body, so they are part of the tag.
+    """
+    variant = hashlib.blake2b(query_string + b'|' + (mode or '').encode('ascii'), digest_size=6).hexdigest()
+    return '%s-%d-%s' % (resource, version, variant)
+
+
+def etag_matches(if_none_match, etag):
+    """
+        True if the raw If-None-Match header value lists etag.
+    """
+    return parse_etags(if_none_match).contains_weak(etag)
+
+
+def cache_control(private):
+    max_age = 'no-cache' if config.HTTP_CACHE_MAX_AGE <= 0 else 'max-age=%d' % config.HTTP_CACHE_MAX_AGE
+    return '%s, %s' % ('private' if private else 'public', max_age)
+
+
+def with_etag(response, etag, private=True):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cache_control(private)
+    return response
+
+
+def not_modified(request, etag, private=True):
+    """
+        304 response if the client already has etag, None otherwise.
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(make_response('', 304), etag, private)
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from passlib.context import CryptContext
+
+import config
+from services.metrics import metrics
+
+
+class HashingBusy(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def _context(scheme, rounds):
+    schemes = [scheme] + [s for s in ('sha512_crypt', 'sha256_crypt') if s != scheme]
+    return CryptContext(schemes=schemes, default=scheme,
+                        deprecated=['auto'],
+                        **{scheme + '__default_rounds': rounds,
+                           scheme + '__min_rounds': rounds,
+                           scheme + '__max_rounds': rounds})
+
+
+def _hash(password, scheme, rounds):
+    return _context(scheme, rounds).hash(password)
+
+
+def _verify_and_update(password, password_hash, scheme, rounds):
+    return _context(scheme, rounds).verify_and_update(password, password_hash)
+
+
+def _warm(scheme, rounds):
+    _context(scheme, rounds)
+    return os.getpid()
+
+
+class HashingService:
+    """
+        Runs password hashing in a process pool so that a burst of logins uses every core and does not hold
+        the request threads. At most max_pending operations may wait for the pool, callers above that limit
+        get HashingBusy after queue_timeout seconds. With workers=0 hashing runs in the calling thread.
+    """
+
+    def __init__(self, scheme=config.PASSWORD_HASH_SCHEME, rounds=config.PASSWORD_HASH_ROUNDS,
+                 workers=config.PASSWORD_HASH_WORKERS, max_pending=config.PASSWORD_HASH_MAX_PENDING,
+                 queue_timeout=config.PASSWORD_HASH_QUEUE_TIMEOUT):
+        self.scheme = scheme
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args, self.scheme, self.rounds)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusy()
+        try:
+            return self._executor().submit(fn, *args, self.scheme, self.rounds).result()
+        finally:
+            self._slots.release()
+
+    def _timed(self, operation, fn, *args):
+        started = time.perf_counter()
+        try:
+            return self._run(fn, *args)
+        finally:
+            metrics.password_hash(operation, time.perf_counter() - started)
+
+    def hash(self, password):
+        return self._timed('hash', _hash, password)
+
+    def verify_and_update(self, password, password_hash):
+        """
+            Returns (is_valid, new_hash), new_hash is not None when the stored hash was made with
+            other parameters than the current ones and should be replaced.
+        """
+        return self._timed('verify', _verify_and_update, password, password_hash)
+
+    def warm(self):
+        """
+            Start the pool's processes and build their CryptContext before the first login needs them.
+        """
+        if self.workers > 0:
+            executor = self._executor()
+            for future in [executor.submit(_warm, self.scheme, self.rounds) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+hashing_service = HashingService()
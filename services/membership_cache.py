@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import config
+
+
+class MembershipCache:
+    """
+        LRU cache with TTL answering "may username join chat of trip_id". Entries are dropped by
+        invalidate_trip / invalidate_user when participants, trips or users change. The cache is per process;
+        with several workers changes made by the others arrive through db/invalidations.py.
+        A reader takes generation() before reading the database and passes it to set, which drops the answer
+        if the trip or user was invalidated meanwhile: the read may have seen the data from before the change.
+    """
+
+    def __init__(self, max_size=config.MEMBERSHIP_CACHE_SIZE, ttl=config.MEMBERSHIP_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_trip = defaultdict(set)
+        self._by_user = defaultdict(set)
+        # generation of the last invalidation of each trip and user, and below which all are assumed changed
+        self._generation = 0
+        self._trip_changes = {}
+        self._user_changes = {}
+        self._forgotten = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, trip_id, username):
+        key = (int(trip_id), username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, trip_id, username, is_member, generation):
+        key = (int(trip_id), username)
+        with self._lock:
+            if self._forgotten > generation or self._trip_changes.get(key[0], 0) > generation \
+                    or self._user_changes.get(username, 0) > generation:
+                return
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (is_member, time.monotonic() + self.ttl)
+            self._by_trip[key[0]].add(key)
+            self._by_user[username].add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_trip(self, trip_id):
+        with self._lock:
+            self._record_change(self._trip_changes, int(trip_id))
+            for key in list(self._by_trip.get(int(trip_id), ())):
+                self._remove(key)
+
+    def invalidate_user(self, username):
+        with self._lock:
+            self._record_change(self._user_changes, username)
+            for key in list(self._by_user.get(username, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._forget_changes()
+            self._entries.clear()
+            self._by_trip.clear()
+            self._by_user.clear()
+
+    def _record_change(self, changes, subject):
+        self._generation += 1
+        changes[subject] = self._generation
+        if len(self._trip_changes) + len(self._user_changes) > self.max_size:
+            self._forget_changes()
+
+    def _forget_changes(self):
+        # readers holding an older generation can't store their answers until they read again
+        self._trip_changes.clear()
+        self._user_changes.clear()
+        self._forgotten = self._generation
+
+    def _remove(self, key):
+        del self._entries[key]
+        trip_keys = self._by_trip[key[0]]
+        trip_keys.discard(key)
+        if not trip_keys:
+            del self._by_trip[key[0]]
+        user_keys = self._by_user[key[1]]
+        user_keys.discard(key)
+        if not user_keys:
+            del self._by_user[key[1]]
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+membership_cache = MembershipCache()
@@ -0,0 +1,405 @@
+"""
+    Request metrics in the Prometheus text format. MetricsMiddleware wraps the WSGI app and times each request
+    until its body is sent, the route is named by the Flask rule (name_route); SQL statements are timed through
+    SQLAlchemy engine events and charged to the request running them. A request keeps its numbers in its own
+    RequestMetrics and adds them to the shared series once, when it ends. Statements slower than
+    TRIP_SLOW_QUERY_MS are logged with the route that sent them. SlowRequests keeps the slowest requests
+    with their statements. Numbers are per process; under serve.py with several workers SharedMetrics writes
+    each worker's series to TRIP_METRICS_DIR and /metrics adds up the series of all workers.
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (128, 1024, 8192, 65536, 524288, 4194304, 33554432)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+HASH_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# statements of a request kept for SlowRequests, the rest are only counted
+MAX_SAMPLED_STATEMENTS = 100
+# route of statements sent outside requests: migrations, the chat relay, commits of the write queue
+NO_ROUTE = 'none'
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def add(self, values, total):
+        self.inc(values, total)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s counter' % self.name]
+        for values, total in sorted(self.series.items()):
+            lines.append('%s%s %s' % (self.name, _labels(self.labels, values), _number(total)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, values, amount):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect_left(self.buckets, amount)] += 1
+        series[1] += amount
+
+    def add(self, values, data):
+        counts, total = data
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [[0] * (len(self.buckets) + 1), 0]
+        series[0] = [count + other for count, other in zip(series[0], counts)]
+        series[1] += total
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        for values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels, values, 'le="%s"' % bound),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, values), _number(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labels, values), cumulative))
+        return lines
+
+
+class RequestMetrics:
+    def __init__(self, method, route='unmatched', path='', sample_statements=False):
+        self.method = method
+        self.route = route
+        self.path = path
+        self.status = ''
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.slow_statements = 0
+        self.size = 0
+        # (statement, seconds) of the first MAX_SAMPLED_STATEMENTS statements, None when not sampled
+        self.sampled = [] if sample_statements else None
+
+    def as_json(self, seconds):
+        return {'method': self.method, 'path': self.path, 'route': self.route, 'status': self.status,
+                'ms': round(seconds * 1000, 3), 'finished_at': datetime.now(timezone.utc).isoformat(),
+                'response_bytes': self.size, 'statement_count': self.statements,
+                'sql_ms': round(self.sql_seconds * 1000, 3),
+                'statements': [{'sql': statement, 'ms': round(statement_seconds * 1000, 3)}
+                               for statement, statement_seconds in self.sampled or []]}
+
+
+class SlowRequests:
+    """
+        The `size` slowest requests of the current and the previous window of `window` seconds, so the list
+        follows recent traffic. A request faster than all kept ones costs one comparison.
+    """
+
+    def __init__(self, size=config.SLOW_REQUESTS, window=config.SLOW_REQUESTS_WINDOW):
+        self.size = size
+        self.window = window
+        self._lock = threading.Lock()
+        self._current = []
+        self._previous = []
+        self._window_started = time.monotonic()
+        self._order = itertools.count()
+
+    def offer(self, state, seconds):
+        if self.size <= 0 or (len(self._current) >= self.size and seconds <= self._current[0][0]):
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_started >= self.window:
+                self._previous = self._current if now - self._window_started < 2 * self.window else []
+                self._current = []
+                self._window_started = now
+            entry = (seconds, next(self._order), state.as_json(seconds))
+            if len(self._current) < self.size:
+                heapq.heappush(self._current, entry)
+            elif seconds > self._current[0][0]:
+                heapq.heapreplace(self._current, entry)
+
+    def snapshot(self):
+        with self._lock:
+            entries = self._current + self._previous
+        return [record for _, _, record in sorted(entries, reverse=True)[:self.size]]
+
+
+class Metrics:
+    def __init__(self, enabled=config.METRICS, slow_query_ms=config.SLOW_QUERY_MS, slow_requests=None):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_ms / 1000.0
+        self.slow_requests = slow_requests or SlowRequests()
+        # SharedMetrics of the worker, render() then answers for all workers
+        self.shared = None
+        self._lock = threading.Lock()
+        self.request_seconds = Histogram('trip_http_request_duration_seconds',
+                                         'Time from the start of a request to the end of its response body.',
+                                         ('method', 'route', 'status'), LATENCY_BUCKETS)
+        self.response_bytes = Histogram('trip_http_response_size_bytes', 'Size of response bodies.',
+                                        ('method', 'route'), SIZE_BUCKETS)
+        self.request_statements = Histogram('trip_sql_statements_per_request', 'SQL statements sent by a request.',
+                                            ('method', 'route'), STATEMENT_BUCKETS)
+        self.sql_statements = Counter('trip_sql_statements_total', 'SQL statements sent.', ('route',))
+        self.sql_seconds = Counter('trip_sql_duration_seconds_total', 'Time spent in SQL statements.', ('route',))
+        self.slow_statements = Counter('trip_sql_slow_statements_total',
+                                       'SQL statements slower than TRIP_SLOW_QUERY_MS.', ('route',))
+        self.hash_seconds = Histogram('trip_password_hash_duration_seconds',
+                                      'Time of password hashing calls, waiting for a pool process included.',
+                                      ('operation',), HASH_BUCKETS)
+        self._series = [self.request_seconds, self.response_bytes, self.request_statements, self.sql_statements,
+                        self.sql_seconds, self.slow_statements, self.hash_seconds]
+
+    def begin_request(self, method, route='unmatched', path=''):
+        state = RequestMetrics(method, route, path, sample_statements=self.slow_requests.size > 0)
+        _current.set(state)
+        return state
+
+    def end_request(self, state):
+        _current.set(None)
+        seconds = time.perf_counter() - state.started
+        with self._lock:
+            self.request_seconds.observe((state.method, state.route, state.status), seconds)
+            self.response_bytes.observe((state.method, state.route), state.size)
+            self.request_statements.observe((state.method, state.route), state.statements)
+            self.sql_statements.inc((state.route,), state.statements)
+            self.sql_seconds.inc((state.route,), state.sql_seconds)
+            if state.slow_statements:
+                self.slow_statements.inc((state.route,), state.slow_statements)
+        self.slow_requests.offer(state, seconds)
+
+    def statement(self, statement, seconds):
+        """
+            Charge one SQL statement to the current request, or to NO_ROUTE outside requests.
+        """
+        state = _current.get()
+        slow = seconds >= self.slow_query_seconds
+        if slow:
+            logger.warning('Slow SQL statement (%.1f ms) in %s: %s', seconds * 1000,
+                           state.route if state is not None else NO_ROUTE, statement)
+        if state is not None:
+            state.statements += 1
+            state.sql_seconds += seconds
+            state.slow_statements += slow
+            if state.sampled is not None and len(state.sampled) < MAX_SAMPLED_STATEMENTS:
+                state.sampled.append((statement, seconds))
+            return
+        with self._lock:
+            self.sql_statements.inc((NO_ROUTE,))
+            self.sql_seconds.inc((NO_ROUTE,), seconds)
+            if slow:
+                self.slow_statements.inc((NO_ROUTE,))
+
+    def password_hash(self, operation, seconds):
+        if self.enabled:
+            with self._lock:
+                self.hash_seconds.observe((operation,), seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {series.name: [[list(values), data] for values, data in series.series.items()]
+                    for series in self._series}
+
+    def add(self, snapshot):
+        with self._lock:
+            for series in self._series:
+                for values, data in snapshot.get(series.name, ()):
+                    series.add(tuple(values), data)
+
+    def render(self):
+        if self.shared is not None:
+            return self.shared.render()
+        with self._lock:
+            lines = [line for series in self._series for line in series.render()]
+        return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics:
+    """
+        Series of all workers. Every `interval` seconds and at each scrape the worker replaces its own file in
+        `directory` with its numbers, a scrape adds up all files. Files of workers that exited stay so that
+        totals never go down, serve.py empties the directory when it starts.
+    """
+
+    def __init__(self, registry, directory, interval=config.METRICS_FLUSH_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        # pids are reused by later workers, the random part keeps their files apart
+        self.path = os.path.join(directory, '%d-%s.json' % (os.getpid(), uuid.uuid4().hex))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.flush()
+        self.registry.shared = self
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def flush(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.registry.snapshot(), file)
+        # readers see the old or the new file, never a partly written one
+        os.replace(temporary, self.path)
+
+    def render(self):
+        self.flush()
+        total = Metrics(enabled=True, slow_requests=self.registry.slow_requests)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    total.add(json.load(file))
+            except (OSError, ValueError):
+                logger.exception('Reading metrics file %s failed', name)
+        return total.render()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing metrics file %s failed', self.path)
+
+
+metrics = Metrics()
+
+
+def current_request():
+    """
+        RequestMetrics of the request being served, None outside requests or with TRIP_METRICS=0.
+    """
+    return _current.get()
+
+
+def name_route(route):
+    """
+        Name the current request's route, by its URL rule so that label values stay few.
+    """
+    state = _current.get()
+    if state is not None:
+        state.route = route
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.statement(statement, time.perf_counter() - conn.info['metrics_started'].pop())
+
+
+def _handle_error(context):
+    started = context.connection.info.get('metrics_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_sqlalchemy():
+    """
+        Time statements of every engine, the ones init_engine makes later included.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+class MetricsMiddleware:
+    def __init__(self, wsgi_app, registry=metrics):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        state = self.registry.begin_request(environ.get('REQUEST_METHOD', ''), path=environ.get('PATH_INFO', ''))
+
+        def start(status, headers, exc_info=None):
+            state.status = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, start)
+        except BaseException:
+            state.status = state.status or '500'
+            self.registry.end_request(state)
+            raise
+        return _CountedBody(body, state, self.registry)
+
+
+class _CountedBody:
+    """
+        Response iterable adding up the size of the body, the request ends when the server closes it.
+    """
+
+    def __init__(self, body, state, registry):
+        self._body = body
+        self._chunks = iter(body)
+        self._state = state
+        self._registry = registry
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._chunks)
+        self._state.size += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._registry.end_request(self._state)
@@ -0,0 +1,55 @@
+import base64
+import json
+
+import config
+
+
+class InvalidPageParameter(Exception):
+    pass
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, key_type=None):
+    """
+        Key encoded in cursor. With key_type the key must be of that type (str for usernames, int for ids),
+        a cursor made up by the client raises InvalidPageParameter instead of reaching the query.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidPageParameter()
+    if key_type is not None and (not isinstance(key, key_type) or isinstance(key, bool)):
+        raise InvalidPageParameter()
+    return key
+
+
+def page_params(args, key_type=int):
+    """
+        Read 'limit' and 'cursor' query parameters, returns (limit, key of the last row of the previous page).
+        key_type is the type of the key column the cursor holds.
+    """
+    try:
+        limit = int(args.get('limit', config.PAGE_SIZE_DEFAULT))
+    except ValueError:
+        raise InvalidPageParameter()
+    if limit < 1:
+        raise InvalidPageParameter()
+    cursor = args.get('cursor')
+    return min(limit, config.PAGE_SIZE_MAX), decode_cursor(cursor, key_type) if cursor else None
+
+
+def paginate(query, column, limit, after, key):
+    """
+        Keyset pagination: rows ordered by column and strictly after the previous page's key, so every page
+        is an index range read no matter how deep. Returns (rows, next_cursor or None on the last page).
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(key(rows[-1]))
+    return rows, None
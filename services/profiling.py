@@ -0,0 +1,164 @@
+"""
+    Profiling of single live requests. A request sent with the 'X-Profile: <TRIP_ADMIN_SECRET>' header (or the
+    profile=<secret> query parameter) runs under cProfile until its body is sent; the profile gets an id sent
+    back in the X-Profile-Id header and is kept in memory for /api/admin/profiles, and saved as <id>.prof in
+    TRIP_PROFILE_DIR when it is set. Other requests only pay for a header lookup. One request is profiled at a
+    time, a flagged request arriving meanwhile runs unprofiled with 'X-Profile-Id: busy'.
+"""
+import cProfile
+import hmac
+import io
+import marshal
+import os
+import pstats
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
+import config
+from services.metrics import current_request
+
+
+def is_admin(secret):
+    """
+        True if secret is TRIP_ADMIN_SECRET, always False while that is unset.
+    """
+    if not config.ADMIN_SECRET or not secret:
+        return False
+    return hmac.compare_digest(secret.encode('utf-8'), config.ADMIN_SECRET.encode('utf-8'))
+
+
+def requested_profile(environ):
+    """
+        Secret sent to ask for a profile of the request, None for ordinary requests.
+    """
+    secret = environ.get('HTTP_X_PROFILE')
+    if secret is None and 'profile=' in environ.get('QUERY_STRING', ''):
+        secret = parse_qs(environ['QUERY_STRING']).get('profile', [None])[0]
+    return secret
+
+
+class _LoadedStats:
+    # what pstats.Stats expects of a profiler
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class ProfileStore:
+    def __init__(self, keep=config.PROFILE_KEEP, directory=config.PROFILE_DIR):
+        self.keep = keep
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()
+
+    def add(self, profile_id, profiler, info):
+        profiler.create_stats()
+        data = marshal.dumps(profiler.stats)
+        if self.directory:
+            with open(os.path.join(self.directory, '%s.prof' % profile_id), 'wb') as f:
+                f.write(data)
+        with self._lock:
+            self._profiles[profile_id] = (info, data)
+            while len(self._profiles) > self.keep:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id):
+        """
+            (info, pstats file content) of the profile, None if it isn't kept (any more).
+        """
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def list(self):
+        with self._lock:
+            return [dict(info, id=profile_id) for profile_id, (info, _) in reversed(self._profiles.items())]
+
+
+profile_store = ProfileStore()
+
+
+def report(data, sort='cumulative', limit=50):
+    """
+        pstats text of a stored profile, the `limit` first functions ordered by `sort`.
+    """
+    out = io.StringIO()
+    pstats.Stats(_LoadedStats(marshal.loads(data)), stream=out).sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+class ProfilingMiddleware:
+    def __init__(self, wsgi_app, store=profile_store):
+        self.wsgi_app = wsgi_app
+        self.store = store
+        # one profiler at a time, cProfile can't run in two threads at once on newer Pythons
+        self._running = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        secret = requested_profile(environ)
+        if secret is None or not is_admin(secret):
+            return self.wsgi_app(environ, start_response)
+        if not self._running.acquire(blocking=False):
+            return self.wsgi_app(environ, lambda status, headers, exc_info=None: start_response(
+                status, headers + [('X-Profile-Id', 'busy')], exc_info))
+
+        profile_id = secrets.token_hex(8)
+        info = {'method': environ.get('REQUEST_METHOD', ''), 'path': environ.get('PATH_INFO', ''), 'status': '',
+                'created_at': datetime.now(timezone.utc).isoformat()}
+
+        def start(status, headers, exc_info=None):
+            info['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers + [('X-Profile-Id', profile_id)], exc_info)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            body = self.wsgi_app(environ, start)
+        except BaseException:
+            profiler.disable()
+            self._running.release()
+            raise
+
+        def finish():
+            profiler.disable()
+            try:
+                info['ms'] = round((time.perf_counter() - started) * 1000, 3)
+                state = current_request()
+                if state is not None and state.sampled is not None:
+                    info['statements'] = [{'sql': statement, 'ms': round(seconds * 1000, 3)}
+                                          for statement, seconds in state.sampled]
+                self.store.add(profile_id, profiler, info)
+            finally:
+                self._running.release()
+
+        return _ProfiledBody(body, finish)
+
+
+class _ProfiledBody:
+    def __init__(self, body, finish):
+        self._body = body
+        self._chunks = iter(body)
+        self._finish = finish
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._finish()
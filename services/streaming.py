@@ -0,0 +1,88 @@
+import json
+from itertools import islice
+
+from flask import Response, stream_with_context
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import config
+
+NDJSON = 'application/x-ndjson'
+JSON_STREAM = 'application/stream+json'
+
+
+def stream_mode(request):
+    """
+        NDJSON or JSON_STREAM when the client explicitly asked for it in Accept header, otherwise None.
+    """
+    return accepted_stream_mode(request.accept_mimetypes)
+
+
+def accepted_stream_mode(accept):
+    """
+        stream_mode for a parsed Accept header or its raw value.
+    """
+    if not isinstance(accept, MIMEAccept):
+        accept = parse_accept_header(accept, MIMEAccept)
+    accepted = [mimetype for mimetype, quality in accept if quality > 0]
+    for mode in (NDJSON, JSON_STREAM):
+        if mode in accepted:
+            return mode
+    return None
+
+
+def iter_query(query, batch_size=config.STREAM_BATCH_SIZE):
+    return query.yield_per(batch_size)
+
+
+def iter_keyset(query, column, key, after=None, batch_size=config.STREAM_BATCH_SIZE):
+    """
+        Yield rows of query in column order, batch_size rows per SELECT. Unlike yield_per this works with
+        eager loaded collections; the session is emptied after each batch to keep memory flat.
+    """
+    session = query.session
+    while True:
+        batch_query = query if after is None else query.filter(column > after)
+        rows = batch_query.order_by(column).limit(batch_size).all()
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        after = key(rows[-1])
+        session.expunge_all()
+
+
+def _ndjson(items):
+    for item in items:
+        yield json.dumps(item, separators=(',', ':')) + '\n'
+
+
+def _json_array(items, wrapper_key):
+    yield '{"%s":[' % wrapper_key if wrapper_key else '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item, separators=(',', ':'))
+        separator = ','
+    yield ']}' if wrapper_key else ']'
+
+
+def stream_response(mode, items, limit=None, wrapper_key=None, status=201, on_close=None):
+    """
+        Serialize items one by one. With JSON_STREAM the body has the same shape as the buffered response,
+        wrapped in {wrapper_key: [...]} when wrapper_key is given.
+    """
+    if limit is not None:
+        items = islice(items, limit)
+
+    def generate():
+        try:
+            if mode == NDJSON:
+                yield from _ndjson(items)
+            else:
+                yield from _json_array(items, wrapper_key)
+        finally:
+            if on_close is not None:
+                on_close()
+
+    return Response(stream_with_context(generate()), status=status,
+                    mimetype=NDJSON if mode == NDJSON else 'application/json')
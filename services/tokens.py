@@ -0,0 +1,99 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import config
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class TokenService:
+    """
+        Issues and checks HMAC-SHA256 signed tokens '<payload>.<signature>' carrying the username, issue
+        and expiry time. Checking a token needs no database access. Revoked tokens are kept in memory
+        until they expire, revoke_user rejects every token of the user issued before the call. Revocations
+        reach the other worker processes through db/invalidations.py.
+    """
+
+    def __init__(self, secret=config.SECRET_KEY, ttl=config.TOKEN_TTL):
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._revoked = {}
+        self._revoked_users = {}
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, username):
+        now = time.time()
+        claims = {'sub': username, 'iat': now, 'exp': int(now) + self.ttl, 'jti': _b64encode(os.urandom(12))}
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        return payload + '.' + self._sign(payload)
+
+    def verify(self, token):
+        # signatures are compared as ASCII, other characters could never be part of a token
+        if not isinstance(token, str) or not token.isascii():
+            raise InvalidToken()
+        try:
+            payload, signature = token.split('.')
+        except ValueError:
+            raise InvalidToken()
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise InvalidToken()
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            raise InvalidToken()
+        if claims['exp'] < time.time() or claims['jti'] in self._revoked:
+            raise InvalidToken()
+        if claims['iat'] <= self._revoked_users.get(claims['sub'], 0):
+            raise InvalidToken()
+        return claims
+
+    def revoke(self, token):
+        """
+            Returns the claims of the revoked token.
+        """
+        claims = self.verify(token)
+        self.revoke_id(claims['jti'], claims['exp'])
+        return claims
+
+    def revoke_id(self, jti, exp):
+        with self._lock:
+            self._revoked[jti] = exp
+            self._prune()
+
+    def revoke_user(self, username, at=None):
+        """
+            Reject tokens of username issued up to at, now by default. Returns at.
+        """
+        at = time.time() if at is None else at
+        with self._lock:
+            self._revoked_users[username] = max(at, self._revoked_users.get(username, 0))
+            self._prune()
+        return at
+
+    def _prune(self):
+        now = time.time()
+        for jti in [jti for jti, exp in self._revoked.items() if exp < now]:
+            del self._revoked[jti]
+        for username in [u for u, t in self._revoked_users.items() if t + self.ttl < now]:
+            del self._revoked_users[username]
+
+
+token_service = TokenService()
@@ -0,0 +1,109 @@
+import os
+import tempfile
+
+# config is read at import, cheap hashing and fixed secrets keep the tests fast and the tokens stable
+os.environ.setdefault('TRIP_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'import.db'))
+os.environ.setdefault('TRIP_PASSWORD_HASH_ROUNDS', '1000')
+os.environ.setdefault('TRIP_PASSWORD_HASH_WORKERS', '0')
+os.environ.setdefault('TRIP_SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('TRIP_ADMIN_SECRET', 'admin-secret')
+
+import pytest  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+import config  # noqa: E402
+import server  # noqa: E402
+from db import base  # noqa: E402
+from db.migrations import migrate_database  # noqa: E402
+from services.membership_cache import membership_cache  # noqa: E402
+from services.tokens import token_service  # noqa: E402
+
+PASSWORD = 'password'
+ADMIN_HEADERS = {'X-Admin-Secret': 'admin-secret'}
+
+
+@pytest.fixture
+def database_url(tmp_path, monkeypatch):
+    url = 'sqlite:///' + str(tmp_path / 'trips.db')
+    monkeypatch.setattr(config, 'DATABASE_URL', url)
+    base.init_engine(url)
+    migrate_database()
+    membership_cache.clear()
+    token_service._revoked.clear()
+    token_service._revoked_users.clear()
+    yield url
+    base.Session.remove()
+    base.engine.dispose()
+
+
+@pytest.fixture
+def client(database_url):
+    return server.app.test_client()
+
+
+class Api:
+    """
+        Shortcuts for the requests most tests start with, every call sends the user's token.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.tokens = {}
+
+    def create_user(self, username, password=PASSWORD):
+        response = self.client.post('/api/user/create', json={'username': username, 'password': password})
+        assert response.status_code == 201, response.get_json()
+        return username
+
+    def login(self, username, password=PASSWORD):
+        response = self.client.post('/api/user/login', json={'username': username, 'password': password})
+        assert response.status_code == 201, response.get_json()
+        self.tokens[username] = response.get_json()['token']
+        return self.tokens[username]
+
+    def headers(self, username):
+        if username not in self.tokens:
+            self.login(username)
+        return {'Authorization': 'Bearer %s' % self.tokens[username]}
+
+    def request(self, method, username, path, **kwargs):
+        headers = dict(self.headers(username), **kwargs.pop('headers', {}))
+        return self.client.open('/api/user/%s/%s' % (username, path), method=method, headers=headers, **kwargs)
+
+    def get(self, username, path, **kwargs):
+        return self.request('GET', username, path, **kwargs)
+
+    def create_trip(self, owner, participants=(), trip_name='Trip', date_from='2020-06-01', date_to='2020-06-05'):
+        response = self.request('POST', owner, 'create-trip', json={
+            'trip_name': trip_name, 'date_from': date_from, 'date_to': date_to, 'participants': list(participants)})
+        assert response.status_code == 201, response.get_json()
+        return response.get_json()['Trip id']
+
+
+@pytest.fixture
+def api(client):
+    return Api(client)
+
+
+class StatementCounter:
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def reset(self):
+        del self.statements[:]
+
+
+@pytest.fixture
+def statements():
+    counter = StatementCounter()
+    event.listen(Engine, 'before_cursor_execute', counter)
+    yield counter
+    event.remove(Engine, 'before_cursor_execute', counter)
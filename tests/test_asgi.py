@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+
+from db import aio
+
+
+async def call(app, method, path, body=None, headers=None):
+    """
+        (status, headers, body) of one request to an ASGI app.
+    """
+    path, _, query = path.partition('?')
+    raw_headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in (headers or {}).items()]
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    if body is not None:
+        raw_headers.append((b'content-type', b'application/json'))
+    raw_headers.append((b'content-length', str(len(payload)).encode('ascii')))
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+             'path': path, 'raw_path': path.encode('utf-8'), 'query_string': query.encode('utf-8'), 'root_path': '',
+             'headers': raw_headers, 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+    received = []
+
+    async def receive():
+        if received:
+            await asyncio.Event().wait()
+        received.append(True)
+        return {'type': 'http.request', 'body': payload, 'more_body': False}
+
+    response = {'body': b''}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in message['headers']}
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+
+    await app(scope, receive, send)
+    return response['status'], response['headers'], response['body']
+
+
+@pytest.fixture
+def asgi_app(database_url):
+    from asgi import app
+    return app
+
+
+def run(coroutine):
+    async def closing():
+        try:
+            return await coroutine
+        finally:
+            await aio.database.close()
+    return asyncio.run(closing())
+
+
+def test_async_routes_answer_like_flask(api, client, asgi_app):
+    for username in ('ala', 'ela', 'ola'):
+        api.create_user(username)
+    trip_id = api.create_trip('ala', ['ela'])
+    headers = api.headers('ela')
+
+    async def scenario():
+        status, response_headers, body = await call(asgi_app, 'GET', '/api/users?limit=2')
+        assert status == 201
+        users = json.loads(body)
+        assert users == client.get('/api/users?limit=2').get_json()
+        status, _, body = await call(asgi_app, 'GET', '/api/users?limit=2&cursor=%s' % users['next_cursor'])
+        assert json.loads(body)['Users'] == [{'username': 'ola'}]
+        assert (await call(asgi_app, 'GET', '/api/users', headers={
+            'If-None-Match': response_headers['etag']}))[0] == 201
+        etag = (await call(asgi_app, 'GET', '/api/users?limit=2'))[1]['etag']
+        assert (await call(asgi_app, 'GET', '/api/users?limit=2', headers={'If-None-Match': etag}))[0] == 304
+
+        status, _, body = await call(asgi_app, 'GET', '/api/user/ela/all-trips', headers=headers)
+        assert json.loads(body) == client.get('/api/user/ela/all-trips', headers=headers).get_json()
+        assert (await call(asgi_app, 'GET', '/api/user/ala/all-trips', headers=headers))[0] == 403
+        assert (await call(asgi_app, 'GET', '/api/user/ela/join-chat/%d' % trip_id, headers=headers))[0] == 201
+        status, _, body = await call(asgi_app, 'GET', '/api/trip/%d/participants' % trip_id)
+        assert sorted(json.loads(body)['Participants']) == ['ala', 'ela']
+        assert (await call(asgi_app, 'GET', '/api/users?limit=0'))[0] == 422
+        for cursor in ('W10', 'eyJhIjoxfQ', 'MQ'):
+            assert (await call(asgi_app, 'GET', '/api/users?cursor=' + cursor))[0] == 422
+        for cursor in ('W10', 'eyJhIjoxfQ', 'ImEi'):
+            assert (await call(asgi_app, 'GET', '/api/user/ela/trips?cursor=' + cursor, headers=headers))[0] == 422
+
+        # routes without an async version go to the Flask app
+        status, _, body = await call(asgi_app, 'POST', '/api/user/ela/trip/%d/messages' % trip_id,
+                                     body={'text': 'hi'}, headers=headers)
+        assert status == 201
+        status, _, body = await call(asgi_app, 'GET', '/api/user/ela/trip/%d/messages' % trip_id, headers=headers)
+        assert [m['text'] for m in json.loads(body)['Messages']] == ['hi']
+    run(scenario())
+
+
+def test_non_ascii_token_is_unauthorized(api, asgi_app):
+    api.create_user('ala')
+    status, _, _ = run(call(asgi_app, 'GET', '/api/user/ala/trips', headers={'Authorization': 'Bearer x.é'}))
+    assert status == 401
+
+
+def test_async_history_pages_follow_message_ids(api, asgi_app):
+    trip_id = api.create_trip(api.create_user('ala'))
+    for text in ('first', 'second'):
+        api.request('POST', 'ala', 'trip/%d/messages' % trip_id, json={'text': text})
+    first, second = run(aio.trip_messages(trip_id, 0, 10))
+    assert run(aio.trip_messages(trip_id, first['message_id'], 1)) == [second]
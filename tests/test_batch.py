@@ -0,0 +1,61 @@
+import pytest
+
+import config
+
+
+@pytest.fixture
+def users(api):
+    for username in ('ala', 'ela', 'ola'):
+        api.create_user(username)
+
+
+def batch(api, operations, **kwargs):
+    return api.client.post('/api/batch', headers=api.headers('ala'), json=dict(operations=operations, **kwargs))
+
+
+def test_operations_run_in_one_transaction(api, client, users):
+    response = batch(api, [
+        {'method': 'POST', 'path': '/api/user/ala/create-trip', 'body': {
+            'trip_name': 'Rome', 'date_from': '2020-06-01', 'date_to': '2020-06-05', 'participants': ['ela']}},
+        {'method': 'POST', 'path': '/api/user/ala/trip/{0[Trip id]}/add-participants',
+         'body': {'participants': ['ola']}},
+        {'method': 'GET', 'path': '/api/user/ala/trips'}])
+    assert response.status_code == 201
+    results = response.get_json()['Results']
+    assert [r['status'] for r in results] == [201, 201, 201]
+    trip_id = results[0]['body']['Trip id']
+    assert sorted(results[2]['body'][0]['participants']) == ['ala', 'ela', 'ola']
+    assert sorted(client.get('/api/trip/%d/participants' % trip_id).get_json()['Participants']) == \
+        ['ala', 'ela', 'ola']
+
+
+def test_failing_operation_undoes_atomic_batch(api, users):
+    response = batch(api, [
+        {'method': 'POST', 'path': '/api/user/ala/create-trip', 'body': {
+            'trip_name': 'Rome', 'date_from': '2020-06-01', 'date_to': '2020-06-05', 'participants': []}},
+        {'method': 'DELETE', 'path': '/api/user/ala/trip/999/delete'}])
+    assert response.status_code == 409
+    assert response.get_json()['failed'] == 1
+    assert api.get('ala', 'trips').get_json() == []
+
+
+def test_non_atomic_batch_keeps_successful_operations(api, users):
+    response = batch(api, [
+        {'method': 'DELETE', 'path': '/api/user/ala/trip/999/delete'},
+        {'method': 'POST', 'path': '/api/user/ala/create-trip', 'body': {
+            'trip_name': 'Rome', 'date_from': '2020-06-01', 'date_to': '2020-06-05', 'participants': []}}],
+        atomic=False)
+    assert response.status_code == 201
+    assert [r['status'] for r in response.get_json()['Results']] == [403, 201]
+    assert len(api.get('ala', 'trips').get_json()) == 1
+
+
+def test_operations_are_checked(api, users, monkeypatch):
+    assert batch(api, []).status_code == 422
+    results = batch(api, [{'method': 'POST', 'path': '/api/user/create', 'body': {}}], atomic=False)
+    assert results.get_json()['Results'][0]['status'] == 403
+    results = batch(api, [{'method': 'GET', 'path': '/nowhere'}, {'method': 'GET', 'path': '/api/user/{5[x]}/trips'},
+                          {'method': 'GET', 'path': '/api/user/ela/trips'}], atomic=False)
+    assert [r['status'] for r in results.get_json()['Results']] == [404, 422, 403]
+    monkeypatch.setattr(config, 'BATCH_MAX_OPERATIONS', 1)
+    assert batch(api, [{'method': 'GET', 'path': '/api/users'}] * 2).status_code == 422
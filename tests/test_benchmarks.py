@@ -0,0 +1,18 @@
+import server
+from benchmarks import endpoints
+
+
+def test_percentile():
+    assert endpoints.percentile([], 0.5) is None
+    assert endpoints.percentile([1, 2, 3, 4], 0.5) == 3
+    assert endpoints.percentile([1, 2, 3, 4], 0.99) == 4
+
+
+def test_every_scenario_runs_without_server_errors(database_url, statements):
+    endpoints.generate(30, 60, 2, seed=1)
+    data = endpoints.Dataset(database_url[len('sqlite:///'):])
+    for name in endpoints.SCENARIOS:
+        result = endpoints.run_scenario(name, lambda: endpoints.TestClientTransport(server.app), data, 1, 2,
+                                        statements)
+        assert result['requests'] == 2 and result['errors'] == 0, (name, result)
+        assert '401' not in result['status_codes'], (name, result)
@@ -0,0 +1,110 @@
+import sqlite3
+
+import pytest
+
+from db.chat_relay import ChatRelay
+from services.broker import ChatBroker, SubscriptionClosed, TooManySubscribers
+
+
+def test_subscribers_of_trip_get_messages():
+    broker = ChatBroker(max_queue=10, max_subscribers=10)
+    first, other = broker.subscribe(1), broker.subscribe(2)
+    assert broker.publish(1, {'message_id': 1}) == 1
+    assert first.get(timeout=0) == {'message_id': 1}
+    assert other.get(timeout=0) is None
+    first.close()
+    assert broker.stats()['subscribers'] == 1
+
+
+def test_slow_subscriber_is_dropped():
+    broker = ChatBroker(max_queue=1, max_subscribers=10)
+    subscription = broker.subscribe(1)
+    broker.publish(1, {'message_id': 1})
+    broker.publish(1, {'message_id': 2})
+    assert broker.stats()['dropped_subscribers'] == 1
+    assert subscription.get(timeout=0) == {'message_id': 1}
+    with pytest.raises(SubscriptionClosed):
+        subscription.get(timeout=0)
+
+
+def test_subscribers_are_limited():
+    broker = ChatBroker(max_queue=1, max_subscribers=1)
+    broker.subscribe(1)
+    with pytest.raises(TooManySubscribers):
+        broker.subscribe(1)
+
+
+@pytest.fixture
+def trip_id(api):
+    api.create_user('ala')
+    api.create_user('ela')
+    api.create_user('ola')
+    return api.create_trip('ala', ['ela'])
+
+
+def test_messages_are_posted_and_read_by_members(api, trip_id):
+    path = 'trip/%d/messages' % trip_id
+    first = api.request('POST', 'ela', path, json={'text': 'hi'}).get_json()
+    second = api.request('POST', 'ala', path, json={'text': 'hello'}).get_json()
+    messages = api.get('ela', path).get_json()['Messages']
+    assert [m['text'] for m in messages] == ['hi', 'hello']
+    assert [m['text'] for m in api.get('ala', path + '?after=%d' % first['message_id']).get_json()['Messages']] == \
+        ['hello']
+    assert second['username'] == 'ala'
+    assert api.request('POST', 'ola', path, json={'text': 'hi'}).status_code == 403
+    assert api.get('ola', path).status_code == 403
+
+
+def test_stream_sends_missed_messages(api, trip_id):
+    path = 'trip/%d/messages' % trip_id
+    first = api.request('POST', 'ela', path, json={'text': 'hi'}).get_json()
+    api.request('POST', 'ela', path, json={'text': 'hello'})
+    response = api.get('ala', path + '/stream', headers={'Last-Event-ID': str(first['message_id'])})
+    assert response.mimetype == 'text/event-stream'
+    event = next(response.response)
+    event = event.decode('utf-8') if isinstance(event, bytes) else event
+    assert event.startswith('id: %d\nevent: message\n' % (first['message_id'] + 1))
+    assert '"hello"' in event
+    response.close()
+
+
+def test_relay_publishes_committed_messages(api, trip_id):
+    broker = ChatBroker(max_queue=10, max_subscribers=10)
+    relay = ChatRelay(broker, interval=60)
+    relay._last_id = relay._max_id()
+    subscription = broker.subscribe(trip_id)
+    api.request('POST', 'ela', 'trip/%d/messages' % trip_id, json={'text': 'hi'})
+    assert relay.poll() == 1
+    assert subscription.get(timeout=0)['text'] == 'hi'
+    assert relay.poll() == 0
+
+
+def test_ids_of_deleted_messages_are_not_given_again(api, trip_id):
+    path = 'trip/%d/messages' % trip_id
+    api.request('POST', 'ala', path, json={'text': 'first'})
+    last = api.request('POST', 'ela', path, json={'text': 'second'}).get_json()['message_id']
+    assert api.request('DELETE', 'ela', 'delete').status_code == 201
+    message = api.request('POST', 'ala', path, json={'text': 'third'}).get_json()
+    assert message['message_id'] > last
+    assert [m['text'] for m in api.get('ala', path + '?after=%d' % last).get_json()['Messages']] == ['third']
+
+
+def test_history_pages_follow_message_ids(api, trip_id, database_url):
+    path = 'trip/%d/messages' % trip_id
+    ids = [api.request('POST', 'ala', path, json={'text': text}).get_json()['message_id']
+           for text in ('first', 'second', 'third')]
+    connection = sqlite3.connect(database_url[len('sqlite:///'):])
+    try:
+        # a clock step back must not make a page skip or repeat messages
+        connection.execute("UPDATE messages SET created_at = '2030-01-01 00:00:00' WHERE message_id = ?", (ids[0],))
+        connection.commit()
+    finally:
+        connection.close()
+    after, pages = 0, []
+    while True:
+        page = api.get('ala', path + '?limit=1&after=%d' % after).get_json()['Messages']
+        if not page:
+            break
+        pages.append(page[0]['text'])
+        after = page[0]['message_id']
+    assert pages == ['first', 'second', 'third']
@@ -0,0 +1,29 @@
+def test_listing_is_not_modified_until_a_trip_changes(api):
+    api.create_user('ala')
+    api.create_user('ela')
+    trip_id = api.create_trip('ala', ['ela'])
+    response = api.get('ela', 'all-trips')
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'].startswith('private')
+
+    cached = api.get('ela', 'all-trips', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.get_data() == b''
+    assert api.get('ela', 'all-trips?limit=1', headers={'If-None-Match': etag}).status_code == 201
+
+    api.request('PUT', 'ala', 'trip/%d/update' % trip_id, json={'trip_name': 'Rome'})
+    changed = api.get('ela', 'all-trips', headers={'If-None-Match': etag})
+    assert changed.status_code == 201
+    assert changed.headers['ETag'] != etag
+
+
+def test_public_listings_have_etags(api, client):
+    api.create_user('ala')
+    trip_id = api.create_trip('ala')
+    for path in ('/api/users', '/api/trip/%d/participants' % trip_id):
+        response = client.get(path)
+        assert response.headers['Cache-Control'].startswith('public')
+        assert client.get(path, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    etag = client.get('/api/users').headers['ETag']
+    api.create_user('ela')
+    assert client.get('/api/users', headers={'If-None-Match': etag}).status_code == 201
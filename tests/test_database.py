@@ -0,0 +1,48 @@
+from sqlalchemy import text
+
+from db import base
+from db.database import generate_dataset
+from db.summaries import rebuild_trip_summaries
+
+
+def scalar(sql):
+    with base.engine.connect() as connection:
+        return connection.execute(text(sql)).scalar()
+
+
+def summaries():
+    with base.engine.connect() as connection:
+        return connection.execute(text('SELECT * FROM trip_summaries ORDER BY username, trip_id')).fetchall()
+
+
+def test_generated_dataset_is_consistent(database_url):
+    generate_dataset(200, 500, participants=3, seed=1, batch_size=128)
+    assert scalar('SELECT count(*) FROM users') == 200
+    assert scalar('SELECT count(*) FROM trips') == 500
+    assert scalar('SELECT count(*) FROM participants') > 500
+    assert scalar('SELECT count(*) FROM participant_intervals') == scalar('SELECT count(*) FROM participants')
+    assert scalar("SELECT count(*) FROM trip_search WHERE trip_search MATCH 'trip'") > 0
+    assert scalar("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN "
+                  "('participant_intervals_insert', 'trip_search_insert')") == 2
+    generated = summaries()
+    rebuild_trip_summaries()
+    assert summaries() == generated
+
+
+def test_dataset_is_reproducible(tmp_path, database_url):
+    generate_dataset(50, 100, seed=3)
+    first = scalar('SELECT group_concat(trip_id || owner_name || date_from, ",") FROM trips')
+    base.init_engine('sqlite:///' + str(tmp_path / 'other.db'))
+    from db.migrations import migrate_database
+    migrate_database()
+    generate_dataset(50, 100, seed=3)
+    assert scalar('SELECT group_concat(trip_id || owner_name || date_from, ",") FROM trips') == first
+
+
+def test_owners_participate_in_their_generated_trips(database_url):
+    generate_dataset(50, 100, participants=0, seed=2)
+    assert scalar('SELECT count(*) FROM participants p JOIN trips t ON t.trip_id = p.trip_id '
+                  'AND t.owner_name = p.username') == 100
+    assert scalar('SELECT count(*) FROM participants') == 100
+    assert scalar("SELECT count(*) FROM trip_summaries WHERE role = 'owner' AND is_participant "
+                  "AND participant_count = 1") == 100
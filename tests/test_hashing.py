@@ -0,0 +1,46 @@
+import pytest
+
+from services.hashing import HashingBusy, HashingService
+
+
+def test_hash_and_verify_in_calling_thread():
+    service = HashingService(rounds=1000, workers=0)
+    password_hash = service.hash('secret')
+    assert service.verify_and_update('secret', password_hash) == (True, None)
+    assert service.verify_and_update('wrong', password_hash)[0] is False
+
+
+def test_hash_made_with_other_rounds_is_replaced():
+    old_hash = HashingService(rounds=1000, workers=0).hash('secret')
+    is_valid, new_hash = HashingService(rounds=1001, workers=0).verify_and_update('secret', old_hash)
+    assert is_valid and new_hash is not None and new_hash != old_hash
+
+
+def test_hash_in_process_pool():
+    service = HashingService(rounds=1000, workers=1, max_pending=2)
+    try:
+        service.warm()
+        assert service.verify_and_update('secret', service.hash('secret'))[0]
+    finally:
+        service.shutdown()
+
+
+def test_busy_when_too_many_wait():
+    service = HashingService(rounds=1000, workers=1, max_pending=1, queue_timeout=0.01)
+    service._slots.acquire()
+    try:
+        with pytest.raises(HashingBusy):
+            service.hash('secret')
+    finally:
+        service._slots.release()
+        service.shutdown()
+
+
+def test_busy_hashing_answers_503(client, monkeypatch):
+    from services.hashing import hashing_service
+
+    def busy(*args):
+        raise HashingBusy()
+    monkeypatch.setattr(hashing_service, '_run', busy)
+    response = client.post('/api/user/create', json={'username': 'ala', 'password': 'secret'})
+    assert response.status_code == 503
@@ -0,0 +1,110 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from db import base
+from db.intervals import find_conflicts
+
+
+def intervals():
+    with base.engine.connect() as connection:
+        return connection.execute(text('SELECT count(*) FROM participant_intervals')).scalar()
+
+
+def test_find_conflicts_reports_common_days():
+    trips = [(1, date(2020, 6, 1), date(2020, 6, 10)), (2, date(2020, 6, 5), date(2020, 6, 7)),
+             (3, date(2020, 6, 10), date(2020, 6, 12)), (4, date(2020, 7, 1), date(2020, 7, 2)),
+             (5, None, date(2020, 6, 1))]
+    assert find_conflicts(trips) == ([(1, 2, date(2020, 6, 5), date(2020, 6, 7)),
+                                      (1, 3, date(2020, 6, 10), date(2020, 6, 10))], None)
+
+
+def test_conflicts_pages_add_up_to_all_conflicts():
+    rng = random.Random(1)
+    trips = []
+    for trip_id in range(1, 80):
+        date_from = date(2020, 6, 1) + timedelta(days=rng.randrange(60))
+        trips.append((trip_id, date_from, date_from + timedelta(days=rng.randrange(10))))
+    everything, next_key = find_conflicts(trips)
+    assert next_key is None and len(everything) > 100
+    assert len(set((first, second) for first, second, _, _ in everything)) == len(everything)
+
+    pages, after = [], None
+    while True:
+        page, after = find_conflicts(trips, 7, after)
+        assert len(page) <= 7
+        pages += page
+        if after is None:
+            break
+        assert len(after) == 6
+    assert pages == everything
+
+
+@pytest.fixture
+def users(api):
+    for username in ('ala', 'ela'):
+        api.create_user(username)
+
+
+def test_triggers_keep_intervals_in_step(api, users):
+    trip_id = api.create_trip('ala', ['ela'])
+    assert intervals() == 2
+    api.request('DELETE', 'ala', 'trip/%d/delete-participants' % trip_id, json={'participants': ['ela']})
+    assert intervals() == 1
+    api.request('POST', 'ala', 'trip/%d/add-participants' % trip_id, json={'participants': ['ela']})
+    assert intervals() == 2
+    api.request('DELETE', 'ala', 'trip/%d/delete' % trip_id)
+    assert intervals() == 0
+    api.create_trip('ala', ['ela'])
+    api.request('DELETE', 'ela', 'delete')
+    assert intervals() == 1
+
+
+def test_trips_in_range_follow_date_changes(api, users):
+    june = api.create_trip('ala', ['ela'], date_from='2020-06-01', date_to='2020-06-10')
+    july = api.create_trip('ala', date_from='2020-07-01', date_to='2020-07-03')
+
+    def in_range(username, date_from, date_to):
+        response = api.get(username, 'trips-in-range?date_from=%s&date_to=%s' % (date_from, date_to))
+        assert response.status_code == 201
+        return [t['trip_id'] for t in response.get_json()]
+
+    assert in_range('ala', '2020-06-10', '2020-07-01') == [june, july]
+    assert in_range('ela', '2020-06-11', '2020-07-01') == []
+    api.request('PUT', 'ala', 'trip/%d/update' % june, json={'date_to': '2020-06-20'})
+    assert in_range('ela', '2020-06-11', '2020-07-01') == [june]
+    assert api.get('ala', 'trips-in-range?date_from=2020-07-01&date_to=2020-06-01').status_code == 422
+    assert api.get('ala', 'trips-in-range?date_from=2020-07-01').status_code == 422
+
+
+def test_conflicts_of_user(api, users):
+    first = api.create_trip('ala', ['ela'], date_from='2020-06-01', date_to='2020-06-10')
+    second = api.create_trip('ela', date_from='2020-06-08', date_to='2020-06-12')
+    api.create_trip('ela', date_from='2020-08-01', date_to='2020-08-02')
+    conflicts = api.get('ela', 'conflicts').get_json()['Conflicts']
+    assert conflicts == [{'trip_ids': [first, second], 'date_from': '2020-06-08', 'date_to': '2020-06-10'}]
+    assert api.get('ala', 'conflicts').get_json()['Conflicts'] == []
+    assert api.get('ela', 'conflicts?date_from=2020-07-01&date_to=2020-08-31').get_json()['Conflicts'] == []
+
+
+def test_conflicts_are_paged(api, users):
+    trip_ids = [api.create_trip('ala', date_from='2020-06-01', date_to='2020-06-10') for _ in range(4)]
+    pairs, cursor = [], None
+    while True:
+        response = api.get('ala', 'conflicts?limit=4' + ('&cursor=%s' % cursor if cursor else ''))
+        assert response.status_code == 201
+        conflicts = response.get_json()['Conflicts']
+        assert len(conflicts) <= 4
+        pairs += [tuple(c['trip_ids']) for c in conflicts]
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    assert pairs == [(first, second) for i, second in enumerate(trip_ids) for first in trip_ids[:i]]
+
+
+@pytest.mark.parametrize('cursor', ['MQ', 'W10', 'WzEsMiwzXQ', 'WzEsMiwzLDQsNSwiNiJd', 'limit'])
+def test_conflicts_reject_invalid_cursor(api, users, cursor):
+    # 1, [], [1, 2, 3], [1, 2, 3, 4, 5, "6"]
+    assert api.get('ala', 'conflicts?cursor=' + cursor).status_code == 422
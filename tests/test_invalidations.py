@@ -0,0 +1,92 @@
+import time
+
+import pytest
+from sqlalchemy import text
+
+import config
+import serve
+from db import base
+from db.invalidations import InvalidationRelay, add_token_revocation
+from db.writer import run_write
+from services.membership_cache import MembershipCache
+from services.tokens import InvalidToken, TokenService
+
+
+@pytest.fixture
+def other_worker(database_url):
+    """
+        Token service and membership cache of another worker process, fed by its relay.
+    """
+    tokens = TokenService(secret=config.SECRET_KEY)
+    relay = InvalidationRelay(tokens, MembershipCache(max_size=100, ttl=60), interval=60)
+    relay.start()
+    yield relay
+    relay.stop()
+
+
+def test_logout_reaches_other_workers(api, client, other_worker):
+    api.create_user('ala')
+    headers = api.headers('ala')
+    other_worker.tokens.verify(api.tokens['ala'])
+    client.post('/api/user/logout', headers=headers)
+    assert other_worker.poll() == 1
+    with pytest.raises(InvalidToken):
+        other_worker.tokens.verify(api.tokens['ala'])
+
+
+@pytest.mark.parametrize('method, path, body', [
+    ('PUT', 'change-password', {'password': 'password', 'new_password': 'changed'}),
+    ('DELETE', 'delete', None)])
+def test_user_revocation_reaches_other_workers(api, other_worker, method, path, body):
+    api.create_user('ala')
+    token = api.login('ala')
+    assert api.request(method, 'ala', path, json=body).status_code == 201
+    other_worker.poll()
+    with pytest.raises(InvalidToken):
+        other_worker.tokens.verify(token)
+
+
+def test_membership_changes_reach_other_workers(api, other_worker):
+    api.create_user('ala')
+    api.create_user('ela')
+    trip_id = api.create_trip('ala', ['ela'])
+    cache = other_worker.cache
+    other_worker.poll()
+    cache.set(trip_id, 'ela', True, cache.generation())
+
+    api.request('DELETE', 'ala', 'trip/%d/delete-participants' % trip_id, json={'participants': ['ela']})
+    assert cache.get(trip_id, 'ela') is True
+    other_worker.poll()
+    assert cache.get(trip_id, 'ela') is None
+
+    cache.set(trip_id, 'ala', True, cache.generation())
+    api.request('DELETE', 'ala', 'delete')
+    other_worker.poll()
+    assert cache.get(trip_id, 'ala') is None
+
+
+def test_starting_worker_applies_kept_revocations(api, client, database_url):
+    api.create_user('ala')
+    token = api.login('ala')
+    client.post('/api/user/logout', headers={'Authorization': 'Bearer %s' % token})
+    tokens = TokenService(secret=config.SECRET_KEY)
+    relay = InvalidationRelay(tokens, MembershipCache(max_size=10, ttl=60), interval=60, batch_size=1)
+    relay.start()
+    relay.stop()
+    with pytest.raises(InvalidToken):
+        tokens.verify(token)
+
+
+def test_expired_rows_are_deleted(database_url):
+    run_write(lambda session: add_token_revocation(session, {'jti': 'old', 'exp': time.time() - 1}))
+    run_write(lambda session: add_token_revocation(session, {'jti': 'new', 'exp': time.time() + 60}))
+    with base.engine.connect() as connection:
+        assert [s for (s,) in connection.execute(text('SELECT subject FROM invalidations'))] == ['new']
+
+
+def test_serve_refuses_several_workers_without_secret_key(monkeypatch):
+    monkeypatch.setattr(config, 'WORKERS', 2)
+    monkeypatch.delenv('TRIP_SECRET_KEY', raising=False)
+    with pytest.raises(SystemExit) as error:
+        serve.main()
+    assert 'TRIP_SECRET_KEY' in str(error.value)
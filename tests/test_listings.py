@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+
+def create_trips(api, owner, count, guests=('ela', 'ola')):
+    return [api.create_trip(owner, guests, trip_name='Trip %d' % i) for i in range(count)]
+
+
+@pytest.fixture
+def users(api):
+    for username in ('ala', 'ela', 'ola'):
+        api.create_user(username)
+        api.login(username)
+
+
+@pytest.mark.parametrize('path', ['trips', 'all-trips'])
+def test_listing_statements_do_not_grow_with_trips(api, users, statements, path):
+    create_trips(api, 'ala', 1)
+    statements.reset()
+    assert len(api.get('ala', path).get_json()) == 1
+    one_trip = statements.count
+
+    create_trips(api, 'ala', 19)
+    statements.reset()
+    trips = api.get('ala', path).get_json()
+    assert len(trips) == 20
+    assert statements.count == one_trip
+
+
+def test_listing_has_participants_of_each_trip(api, users):
+    trip_id = api.create_trip('ala', ['ela', 'ola'])
+    trip, = api.get('ela', 'all-trips').get_json()
+    assert trip['trip_id'] == trip_id
+    assert sorted(trip['participants']) == ['ala', 'ela', 'ola']
+    assert trip['participant_count'] == 3
+    assert trip['owner'] == 'ala'
+    assert trip['role'] == 'participant'
+    assert api.get('ela', 'trips').get_json() == []
+
+
+def test_trips_are_paged_by_cursor(api, users):
+    trip_ids = create_trips(api, 'ala', 5)
+    seen = []
+    cursor = None
+    while True:
+        query = 'all-trips?limit=2' + ('&cursor=%s' % cursor if cursor else '')
+        response = api.get('ala', query)
+        assert response.status_code == 201
+        seen += [t['trip_id'] for t in response.get_json()]
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            break
+    assert seen == trip_ids
+
+
+def test_users_are_paged_by_cursor(client, users):
+    first = client.get('/api/users?limit=2').get_json()
+    assert [u['username'] for u in first['Users']] == ['ala', 'ela']
+    second = client.get('/api/users?limit=2&cursor=%s' % first['next_cursor']).get_json()
+    assert second == {'Users': [{'username': 'ola'}], 'next_cursor': None}
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=x', 'cursor=%%%'])
+def test_invalid_page_parameters(api, client, users, query):
+    assert client.get('/api/users?' + query).status_code == 422
+    assert api.get('ala', 'trips?' + query).status_code == 422
+
+
+@pytest.mark.parametrize('cursor', ['W10', 'eyJhIjoxfQ', 'dHJ1ZQ', 'bnVsbA', 'MS41'])
+def test_cursor_of_wrong_type_is_rejected(api, client, users, cursor):
+    # [], {"a": 1}, true, null, 1.5
+    assert client.get('/api/users?cursor=' + cursor).status_code == 422
+    assert api.get('ala', 'trips?cursor=' + cursor).status_code == 422
+    assert api.get('ala', 'all-trips?cursor=' + cursor).status_code == 422
+    assert api.get('ala', 'sync?cursor=' + cursor).status_code == 422
+
+
+def test_cursor_of_other_listing_is_rejected(api, client, users):
+    user_cursor = client.get('/api/users?limit=1').get_json()['next_cursor']
+    assert api.get('ala', 'trips?cursor=' + user_cursor).status_code == 422
+    assert client.get('/api/users?cursor=MQ').status_code == 422
+
+
+def test_trips_streamed_as_ndjson(api, users):
+    trip_ids = create_trips(api, 'ala', 3)
+    response = api.get('ala', 'all-trips', headers={'Accept': 'application/x-ndjson'})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['trip_id'] for line in lines] == trip_ids
+
+
+def test_users_streamed_as_json(client, users):
+    response = client.get('/api/users', headers={'Accept': 'application/stream+json'})
+    assert json.loads(response.get_data(as_text=True)) == {
+        'Users': [{'username': 'ala'}, {'username': 'ela'}, {'username': 'ola'}]}
+
+
+def test_summaries_follow_trip_changes(api, users):
+    trip_id = api.create_trip('ala', ['ela'])
+    api.request('PUT', 'ala', 'trip/%d/update' % trip_id, json={'trip_name': 'Rome'})
+    api.request('DELETE', 'ala', 'trip/%d/delete-participants' % trip_id, json={'participants': ['ela']})
+    assert api.get('ela', 'all-trips').get_json() == []
+    trip, = api.get('ala', 'all-trips').get_json()
+    assert trip['trip_name'] == 'Rome'
+    assert trip['participants'] == ['ala']
+
+    api.request('DELETE', 'ala', 'trip/%d/delete' % trip_id)
+    assert api.get('ala', 'all-trips').get_json() == []
@@ -0,0 +1,106 @@
+import time
+
+from services.membership_cache import MembershipCache
+
+
+def test_get_set_and_invalidate():
+    cache = MembershipCache(max_size=10, ttl=60)
+    assert cache.get(1, 'ala') is None
+    cache.set(1, 'ala', True, cache.generation())
+    cache.set(2, 'ala', False, cache.generation())
+    cache.set(1, 'ela', True, cache.generation())
+    assert cache.get('1', 'ala') is True
+    assert cache.get(2, 'ala') is False
+    cache.invalidate_trip(1)
+    assert cache.get(1, 'ala') is None and cache.get(1, 'ela') is None
+    assert cache.get(2, 'ala') is False
+    cache.invalidate_user('ala')
+    assert cache.get(2, 'ala') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = MembershipCache(max_size=2, ttl=60)
+    cache.set(1, 'ala', True, cache.generation())
+    cache.set(2, 'ala', True, cache.generation())
+    cache.get(1, 'ala')
+    cache.set(3, 'ala', True, cache.generation())
+    assert cache.get(2, 'ala') is None
+    assert cache.get(1, 'ala') is True
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire():
+    cache = MembershipCache(max_size=10, ttl=0.01)
+    cache.set(1, 'ala', True, cache.generation())
+    time.sleep(0.02)
+    assert cache.get(1, 'ala') is None
+
+
+def test_join_chat_follows_participant_changes(api):
+    for username in ('ala', 'ela', 'ola'):
+        api.create_user(username)
+    trip_id = api.create_trip('ala', ['ela'])
+    path = 'join-chat/%d' % trip_id
+    assert api.get('ela', path).status_code == 201
+    assert api.get('ola', path).status_code == 403
+
+    api.request('POST', 'ala', 'trip/%d/add-participants' % trip_id, json={'participants': ['ola']})
+    api.request('DELETE', 'ala', 'trip/%d/delete-participants' % trip_id, json={'participants': ['ela']})
+    assert api.get('ola', path).status_code == 201
+    assert api.get('ela', path).status_code == 403
+
+
+def test_answer_read_before_an_invalidation_is_not_stored():
+    cache = MembershipCache(max_size=10, ttl=60)
+    generation = cache.generation()
+    cache.invalidate_trip(1)
+    cache.set(1, 'ala', True, generation)
+    assert cache.get(1, 'ala') is None
+    cache.set(2, 'ala', True, generation)
+    assert cache.get(2, 'ala') is True
+
+    generation = cache.generation()
+    cache.invalidate_user('ela')
+    cache.set(3, 'ela', True, generation)
+    cache.set(3, 'ola', True, generation)
+    assert cache.get(3, 'ela') is None
+    assert cache.get(3, 'ola') is True
+
+    generation = cache.generation()
+    cache.clear()
+    cache.set(4, 'ola', True, generation)
+    assert cache.get(4, 'ola') is None
+    cache.set(4, 'ola', True, cache.generation())
+    assert cache.get(4, 'ola') is True
+
+
+def test_forgotten_changes_reject_older_readers():
+    cache = MembershipCache(max_size=2, ttl=60)
+    generation = cache.generation()
+    for trip_id in range(3):
+        cache.invalidate_trip(trip_id)
+    cache.set(10, 'ala', True, generation)
+    assert cache.get(10, 'ala') is None
+    cache.set(10, 'ala', True, cache.generation())
+    assert cache.get(10, 'ala') is True
+
+
+def test_join_chat_does_not_cache_membership_removed_during_its_read(api, monkeypatch):
+    import server
+    from services.membership_cache import membership_cache
+
+    api.create_user('ala')
+    api.create_user('ela')
+    trip_id = api.create_trip('ala', ['ela'])
+    commit_and_close = server.commit_and_close
+
+    def read_then_concurrent_removal(session):
+        commit_and_close(session)
+        monkeypatch.setattr(server, 'commit_and_close', commit_and_close)
+        api.request('DELETE', 'ala', 'trip/%d/delete-participants' % trip_id, json={'participants': ['ela']})
+    monkeypatch.setattr(server, 'commit_and_close', read_then_concurrent_removal)
+
+    assert server.can_join_chat('ela', trip_id) is True
+    assert membership_cache.get(trip_id, 'ela') is None
+    assert api.get('ela', 'join-chat/%d' % trip_id).status_code == 403
@@ -0,0 +1,50 @@
+import re
+
+from services.metrics import Metrics, SharedMetrics, SlowRequests
+
+
+def test_metrics_count_requests_and_statements(api, client):
+    api.create_user('ala')
+    api.get('ala', 'trips').close()
+    text = client.get('/metrics').get_data(as_text=True)
+    route = 'route="/api/user/<string:username>/trips"'
+    assert re.search(r'trip_http_request_duration_seconds_count\{method="GET",%s,status="201"\} [1-9]' % route, text)
+    assert re.search(r'trip_sql_statements_total\{%s\} [1-9]' % route, text)
+    assert 'trip_password_hash_duration_seconds_count{operation="hash"}' in text
+
+
+def test_slow_statements_are_counted():
+    registry = Metrics(enabled=True, slow_query_ms=0, slow_requests=SlowRequests(size=2, window=60))
+    state = registry.begin_request('GET', '/api/users', '/api/users')
+    registry.statement('SELECT 1', 0.5)
+    state.status = '200'
+    registry.end_request(state)
+    assert 'trip_sql_slow_statements_total{route="/api/users"} 1' in registry.render()
+    slow, = registry.slow_requests.snapshot()
+    assert slow['statements'] == [{'sql': 'SELECT 1', 'ms': 500.0}]
+
+
+def test_slow_requests_need_admin_secret(client):
+    assert client.get('/api/admin/slow-requests').status_code == 401
+    response = client.get('/api/admin/slow-requests', headers={'X-Admin-Secret': 'admin-secret'})
+    assert response.status_code == 200
+    assert 'Requests' in response.get_json()
+
+
+def test_shared_metrics_add_up_workers(tmp_path):
+    workers = [Metrics(enabled=True, slow_requests=SlowRequests(size=0)) for _ in range(2)]
+    for registry in workers:
+        shared = SharedMetrics(registry, str(tmp_path), interval=60)
+        shared.start()
+        shared.stop()
+        state = registry.begin_request('GET', '/api/users', '/api/users')
+        registry.statement('SELECT 1', 0.01)
+        state.status = '200'
+        registry.end_request(state)
+    # the other worker's numbers are read as last written, its own are written at the scrape
+    workers[1].shared.flush()
+    text = workers[0].render()
+    assert 'trip_http_request_duration_seconds_count{method="GET",route="/api/users",status="200"} 2' in text
+    assert 'trip_sql_statements_total{route="/api/users"} 2' in text
+    assert 'trip_http_request_duration_seconds_bucket{method="GET",route="/api/users",status="200",le="+Inf"} 2' \
+        in text
@@ -0,0 +1,104 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+import config
+from db import base, migrations
+from db.migrations import LATEST_VERSION, migrate_database, schema_version
+
+
+def test_new_database_is_created_at_latest_version(database_url):
+    assert schema_version() == LATEST_VERSION
+    assert migrate_database() == []
+
+
+def shipped_database(tmp_path):
+    path = str(tmp_path / 'shipped.db')
+    shutil.copy(os.path.join(config.BASE_DIR, 'trip_communicator.db'), path)
+    return path
+
+
+def count(path, sql):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(sql).fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_shipped_database_is_migrated(tmp_path):
+    path = shipped_database(tmp_path)
+    engine = base.make_engine('sqlite:///' + path)
+    try:
+        applied = migrate_database(engine)
+        assert applied == list(range(1, LATEST_VERSION + 1))
+        assert schema_version(engine) == LATEST_VERSION
+        assert migrate_database(engine) == []
+    finally:
+        engine.dispose()
+
+    connection = sqlite3.connect(path)
+    try:
+        table_sql = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'participants'").fetchone()[0]
+        assert 'uq_participants_trip_id_username' in table_sql
+        trips = connection.execute('SELECT count(*) FROM trips').fetchone()[0]
+        owners = connection.execute("SELECT count(*) FROM trip_summaries WHERE role = 'owner'").fetchone()[0]
+        assert owners == trips
+        searched = connection.execute('SELECT count(*) FROM trip_search').fetchone()[0]
+        assert searched == trips
+    finally:
+        connection.close()
+
+
+def test_message_ids_keep_growing_after_migration(api, database_url):
+    trip_id = api.create_trip(api.create_user('ala'))
+    connection = sqlite3.connect(database_url[len('sqlite:///'):])
+    try:
+        connection.executescript(
+            "DROP TABLE messages; "
+            "CREATE TABLE messages (message_id INTEGER NOT NULL, trip_id INTEGER NOT NULL, username VARCHAR NOT NULL, "
+            "text VARCHAR NOT NULL, created_at DATETIME NOT NULL, PRIMARY KEY (message_id)); "
+            "INSERT INTO messages VALUES (4, %d, 'ala', 'hi', '2020-06-01 10:00:00'); "
+            "PRAGMA user_version = 9;" % trip_id)
+    finally:
+        connection.close()
+    assert migrate_database() == [10, 11]
+
+    connection = sqlite3.connect(database_url[len('sqlite:///'):])
+    try:
+        table_sql = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'messages'").fetchone()[0]
+        assert 'AUTOINCREMENT' in table_sql
+        assert connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone() == (4,)
+        assert connection.execute('SELECT message_id, text FROM messages').fetchall() == [(4, 'hi')]
+    finally:
+        connection.close()
+
+
+def fail(*args):
+    raise RuntimeError('failed')
+
+
+@pytest.mark.parametrize('failing', ['schema', 'data'])
+def test_trip_summaries_are_filled_after_a_failed_upgrade(tmp_path, monkeypatch, failing):
+    path = shipped_database(tmp_path)
+    engine = base.make_engine('sqlite:///' + path)
+    try:
+        with monkeypatch.context() as patch:
+            if failing == 'schema':
+                patch.setattr(migrations, 'MIGRATIONS', [(number, fail if number == 6 else migration)
+                                                         for number, migration in migrations.MIGRATIONS])
+            else:
+                patch.setattr(migrations, 'DATA_MIGRATIONS', {4: fail})
+            with pytest.raises(RuntimeError):
+                migrate_database(engine)
+        assert schema_version(engine) >= 4
+        assert count(path, 'SELECT count(*) FROM trip_summaries') == 0
+        migrate_database(engine)
+        assert migrate_database(engine) == []
+    finally:
+        engine.dispose()
+    assert count(path, "SELECT count(*) FROM trip_summaries WHERE role = 'owner'") == \
+        count(path, 'SELECT count(*) FROM trips')
+    assert count(path, 'SELECT count(*) FROM pending_data_migrations') == 0
@@ -0,0 +1,83 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from db import base
+
+
+@pytest.fixture
+def trip_id(api):
+    for username in ('ala', 'ela', 'ola'):
+        api.create_user(username)
+    return api.create_trip('ala', ['ela'])
+
+
+def participants(client, trip_id):
+    return sorted(client.get('/api/trip/%d/participants' % trip_id).get_json()['Participants'])
+
+
+def test_add_participants_reports_each_user(api, client, trip_id):
+    response = api.request('POST', 'ala', 'trip/%d/add-participants' % trip_id,
+                           json={'participants': ['ela', {'username': 'ola'}, 'nobody', 'ola']})
+    assert response.status_code == 201
+    assert response.get_json()['Participants'] == {'ela': 'already present', 'ola': 'added', 'nobody': 'unknown user'}
+    assert participants(client, trip_id) == ['ala', 'ela', 'ola']
+
+
+def test_delete_participants_reports_each_user(api, client, trip_id):
+    response = api.request('DELETE', 'ala', 'trip/%d/delete-participants' % trip_id,
+                           json={'participants': [{'username': 'ela'}, 'ola']})
+    assert response.get_json()['Participants'] == {'ela': 'removed', 'ola': 'not a participant'}
+    assert participants(client, trip_id) == ['ala']
+
+
+def test_only_owner_changes_participants(api, trip_id):
+    response = api.request('POST', 'ela', 'trip/%d/add-participants' % trip_id, json={'participants': ['ola']})
+    assert response.status_code == 403
+
+
+def test_participant_is_unique_per_trip(trip_id):
+    with base.engine.begin() as connection:
+        with pytest.raises(IntegrityError):
+            connection.execute(text("INSERT INTO participants (username, trip_id) VALUES ('ela', :trip_id)"),
+                               trip_id=trip_id)
+
+
+def test_delete_user_cascades_to_trips_and_participations(api, client, trip_id):
+    other_trip_id = api.create_trip('ola', ['ala'])
+    assert api.request('DELETE', 'ala', 'delete').status_code == 201
+
+    assert client.get('/api/trip/%d/participants' % trip_id).status_code == 400
+    assert participants(client, other_trip_id) == ['ola']
+    assert api.get('ela', 'all-trips').get_json() == []
+    with base.engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM participants WHERE username = 'ala'")).scalar() == 0
+
+
+def test_delete_trip_cascades_to_participants_and_messages(api, trip_id):
+    api.request('POST', 'ela', 'trip/%d/messages' % trip_id, json={'text': 'hi'})
+    assert api.request('DELETE', 'ala', 'trip/%d/delete' % trip_id).status_code == 201
+    with base.engine.connect() as connection:
+        for table in ('participants', 'messages', 'trip_summaries'):
+            assert connection.execute(text('SELECT count(*) FROM %s' % table)).scalar() == 0
+
+
+@pytest.mark.parametrize('entries', [['ela', {'name': 'ola'}], ['ela', 5], ['ela', None], [['ola']], 'ola'])
+def test_invalid_participants_are_rejected_before_writing(api, client, statements, trip_id, entries):
+    for method, path in (('POST', 'trip/%d/add-participants' % trip_id),
+                         ('DELETE', 'trip/%d/delete-participants' % trip_id)):
+        api.headers('ala')
+        statements.reset()
+        response = api.request(method, 'ala', path, json={'participants': entries})
+        assert response.status_code == 422
+        assert response.get_json() == {'error': 'Invalid participants'}
+        assert statements.count == 0
+
+    response = api.request('PUT', 'ala', 'trip/%d/update' % trip_id, json={'trip_name': 'x', 'participants': entries})
+    assert response.status_code == 422
+    response = api.request('POST', 'ala', 'create-trip', json={
+        'trip_name': 'x', 'date_from': '2020-06-01', 'date_to': '2020-06-02', 'participants': entries})
+    assert response.status_code == 422
+    assert len(api.get('ala', 'trips').get_json()) == 1
+    assert api.get('ala', 'all-trips').get_json()[0]['trip_name'] == 'Trip'
+    assert participants(client, trip_id) == ['ala', 'ela']
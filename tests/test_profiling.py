@@ -0,0 +1,22 @@
+from tests.conftest import ADMIN_HEADERS
+
+
+def test_profiled_request_is_kept(api, client):
+    api.create_user('ala')
+    response = api.get('ala', 'trips', headers={'X-Profile': 'admin-secret'})
+    profile_id = response.headers['X-Profile-Id']
+    response.close()
+
+    profiles = client.get('/api/admin/profiles', headers=ADMIN_HEADERS).get_json()['Profiles']
+    assert profile_id in [p['id'] for p in profiles]
+    report = client.get('/api/admin/profiles/%s?sort=tottime&limit=5' % profile_id, headers=ADMIN_HEADERS)
+    assert report.status_code == 200
+    assert 'function calls' in report.get_data(as_text=True)
+    assert client.get('/api/admin/profiles/%s?sort=nope' % profile_id, headers=ADMIN_HEADERS).status_code == 422
+    assert client.get('/api/admin/profiles/unknown', headers=ADMIN_HEADERS).status_code == 404
+
+
+def test_wrong_secret_is_not_profiled(api):
+    api.create_user('ala')
+    response = api.get('ala', 'trips', headers={'X-Profile': 'wrong'})
+    assert 'X-Profile-Id' not in response.headers
@@ -0,0 +1,50 @@
+from sqlalchemy import text
+
+from db import base
+from db.search import match_expression
+
+
+def indexed(expression):
+    with base.engine.connect() as connection:
+        return connection.execute(text('SELECT count(*) FROM trip_search WHERE trip_search MATCH :e'),
+                                  e=expression).scalar()
+
+
+def test_match_expression_quotes_words():
+    assert match_expression('Wars, "OR" zak') == '"Wars"* "OR"* "zak"*'
+    assert match_expression(' - ') is None
+    assert match_expression(None) is None
+
+
+def test_triggers_keep_index_in_step(api):
+    api.create_user('ala')
+    trip_id = api.create_trip('ala', trip_name='Warsaw weekend')
+    assert indexed('"wars"*') == 1
+    api.request('PUT', 'ala', 'trip/%d/update' % trip_id, json={'trip_name': 'Paris'})
+    assert indexed('"wars"*') == 0
+    assert indexed('"paris"') == 1
+    api.request('DELETE', 'ala', 'trip/%d/delete' % trip_id)
+    assert indexed('"paris"') == 0
+    api.create_trip('ala', trip_name='Rome')
+    api.request('DELETE', 'ala', 'delete')
+    assert indexed('"rome"') == 0
+
+
+def test_search_finds_trips_of_user(api):
+    api.create_user('ala')
+    api.create_user('ela')
+    zakopane = api.create_trip('ala', ['ela'], trip_name='Zakopane hiking')
+    api.create_trip('ala', trip_name='Hiking in Žabljak')
+    api.create_trip('ela', trip_name='Rome')
+
+    def search(username, q):
+        response = api.get(username, 'search?q=%s' % q)
+        assert response.status_code == 201
+        return sorted(t['trip_name'] for t in response.get_json())
+
+    assert search('ala', 'hik') == ['Hiking in Žabljak', 'Zakopane hiking']
+    assert search('ala', 'zab') == ['Hiking in Žabljak']
+    assert search('ela', 'hik') == ['Zakopane hiking']
+    assert search('ela', 'zak hik') == ['Zakopane hiking']
+    assert api.get('ela', 'search?q=zak').get_json()[0]['trip_id'] == zakopane
+    assert api.get('ela', 'search?q=').status_code == 422
@@ -0,0 +1,15 @@
+from db.migrations import LATEST_VERSION
+
+
+def test_health(client):
+    assert client.get('/health/live').get_json()['status'] == 'ok'
+    assert client.get('/health/ready').get_json() == {'status': 'ready', 'schema_version': LATEST_VERSION}
+
+
+def test_not_ready_with_old_schema(client):
+    from db import base
+    from db.migrations import _run
+    _run(base.engine, lambda cursor: cursor.execute('PRAGMA user_version = 1'))
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.get_json()['schema_version'] == 1
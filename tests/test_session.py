@@ -0,0 +1,23 @@
+from db import base
+from db.base import Session
+
+
+def test_engine_is_shared_by_requests(api, statements):
+    engine = base.engine
+    api.create_user('ala')
+    api.get('ala', 'trips')
+    assert base.engine is engine
+    assert engine.pool.checkedout() == 0
+
+
+def test_session_is_removed_after_request(api):
+    api.create_user('ala')
+    api.get('ala', 'trips')
+    assert not Session.registry.has() or not Session().new
+
+
+def test_sqlite_pragmas_are_set_on_connections(database_url):
+    with base.engine.connect() as connection:
+        assert connection.execute('PRAGMA foreign_keys').scalar() == 1
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.execute('PRAGMA busy_timeout').scalar() > 0
@@ -0,0 +1,45 @@
+import pytest
+
+
+@pytest.fixture
+def users(api):
+    for username in ('ala', 'ela', 'ola'):
+        api.create_user(username)
+
+
+def sync(api, username, cursor=None):
+    response = api.get(username, 'sync' + ('?cursor=%s' % cursor if cursor else ''))
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def test_sync_returns_changes_since_cursor(api, users):
+    kept = api.create_trip('ala', ['ela'], trip_name='Kept')
+    left = api.create_trip('ala', ['ela'], trip_name='Left')
+    first = sync(api, 'ela')
+    assert [t['trip_id'] for t in first['Trips']] == [kept, left]
+    assert first['Deleted'] == []
+
+    assert sync(api, 'ela', first['cursor']) == {'Trips': [], 'Deleted': [], 'cursor': first['cursor']}
+
+    api.request('PUT', 'ala', 'trip/%d/update' % kept, json={'trip_name': 'Renamed'})
+    api.request('DELETE', 'ala', 'trip/%d/delete-participants' % left, json={'participants': ['ela']})
+    added = api.create_trip('ola', ['ela'])
+    second = sync(api, 'ela', first['cursor'])
+    assert [(t['trip_id'], t['trip_name']) for t in second['Trips']] == [(kept, 'Renamed'), (added, 'Trip')]
+    assert second['Deleted'] == [left]
+
+    api.request('DELETE', 'ala', 'trip/%d/delete' % kept)
+    assert sync(api, 'ela', second['cursor'])['Deleted'] == [kept]
+
+
+def test_sync_of_deleted_owner_tombstones_trips(api, users):
+    trip_id = api.create_trip('ala', ['ela'])
+    cursor = sync(api, 'ela')['cursor']
+    api.request('DELETE', 'ala', 'delete')
+    assert sync(api, 'ela', cursor)['Deleted'] == [trip_id]
+
+
+def test_sync_rejects_invalid_cursor(api, users):
+    assert api.get('ela', 'sync?cursor=%%%').status_code == 422
+    assert api.get('ela', 'sync?cursor=ImEi').status_code == 422
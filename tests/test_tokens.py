@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+import config
+from services.tokens import InvalidToken, TokenService
+
+
+def test_token_carries_username():
+    service = TokenService(secret='secret', ttl=60)
+    assert service.verify(service.issue('ala'))['sub'] == 'ala'
+
+
+@pytest.mark.parametrize('token', ['', 'abc', 'a.b', None, 'x.\u00e9', '\u00e9.abc'])
+def test_malformed_token_is_rejected(token):
+    with pytest.raises(InvalidToken):
+        TokenService(secret='secret').verify(token)
+
+
+def test_token_of_other_secret_or_expired_is_rejected():
+    token = TokenService(secret='other', ttl=60).issue('ala')
+    with pytest.raises(InvalidToken):
+        TokenService(secret='secret', ttl=60).verify(token)
+    service = TokenService(secret='secret', ttl=-1)
+    with pytest.raises(InvalidToken):
+        service.verify(service.issue('ala'))
+
+
+def test_revoke_and_revoke_user():
+    service = TokenService(secret='secret', ttl=60)
+    first, second = service.issue('ala'), service.issue('ala')
+    service.revoke(first)
+    with pytest.raises(InvalidToken):
+        service.verify(first)
+    service.verify(second)
+    service.revoke_user('ala')
+    with pytest.raises(InvalidToken):
+        service.verify(second)
+    time.sleep(0.001)
+    service.verify(service.issue('ala'))
+
+
+def test_login_and_logout(api, client):
+    api.create_user('ala')
+    headers = api.headers('ala')
+    assert api.get('ala', 'trips').status_code == 201
+    assert client.post('/api/user/logout', headers=headers).status_code == 201
+    assert client.get('/api/user/ala/trips', headers=headers).status_code == 401
+    assert client.post('/api/user/logout', headers=headers).status_code == 401
+
+
+def test_wrong_password_gets_no_token(api, client):
+    api.create_user('ala')
+    response = client.post('/api/user/login', json={'username': 'ala', 'password': 'wrong'})
+    assert response.status_code == 401
+    assert 'token' not in response.get_json()
+
+
+def test_token_of_other_user_is_forbidden(api, client):
+    api.create_user('ala')
+    api.create_user('ela')
+    assert client.get('/api/user/ela/trips', headers=api.headers('ala')).status_code == 403
+
+
+def test_change_password_revokes_tokens(api, client):
+    api.create_user('ala')
+    headers = api.headers('ala')
+    response = client.put('/api/user/ala/change-password', headers=headers,
+                          json={'password': 'password', 'new_password': 'changed'})
+    assert response.status_code == 201
+    assert client.get('/api/user/ala/trips', headers=headers).status_code == 401
+    time.sleep(0.001)
+    api.login('ala', 'changed')
+    assert api.get('ala', 'trips').status_code == 201
+
+
+def test_request_without_token_is_rejected_unless_not_required(api, client, monkeypatch):
+    api.create_user('ala')
+    assert client.get('/api/user/ala/trips').status_code == 401
+    assert client.post('/api/user/ala/create-trip', json={
+        'trip_name': 'Trip', 'date_from': '2020-06-01', 'date_to': '2020-06-05'}).status_code == 401
+    monkeypatch.setattr(config, 'REQUIRE_TOKEN', False)
+    assert client.get('/api/user/ala/trips').status_code == 201
+
+
+@pytest.mark.parametrize('token', ['x.\u00e9', '\u00e9.abc'])
+def test_non_ascii_token_is_unauthorized(api, client, token):
+    api.create_user('ala')
+    headers = {'Authorization': 'Bearer ' + token}
+    assert client.get('/api/user/ala/trips', headers=headers).status_code == 401
+    assert client.post('/api/user/logout', headers=headers).status_code == 401
@@ -0,0 +1,92 @@
+import io
+import json
+
+import pytest
+
+from db.transfer import InvalidImportLine, export_ndjson, import_ndjson
+from tests.conftest import ADMIN_HEADERS
+
+
+def ndjson(*rows):
+    return [json.dumps(row) + '\n' for row in rows]
+
+
+def test_export_and_import_round_trip(api, client, tmp_path):
+    api.create_user('ala')
+    api.create_user('ela')
+    trip_id = api.create_trip('ala', ['ela'], trip_name='Rome')
+    api.request('POST', 'ela', 'trip/%d/messages' % trip_id, json={'text': 'hi'})
+    exported = client.get('/api/admin/export', headers=ADMIN_HEADERS).get_data(as_text=True)
+    tables = [json.loads(line)['table'] for line in exported.splitlines()]
+    assert tables == ['users', 'users', 'trips', 'participants', 'participants', 'messages']
+
+    response = client.post('/api/admin/import', headers=ADMIN_HEADERS, data=exported)
+    assert response.status_code == 201
+    assert response.get_json()['Tables']['participants'] == {'inserted': 0, 'skipped': 2}
+
+    api.request('DELETE', 'ala', 'delete')
+    api.request('DELETE', 'ela', 'delete')
+    counts = client.post('/api/admin/import', headers=ADMIN_HEADERS, data=exported).get_json()['Tables']
+    assert counts == {'users': {'inserted': 2, 'skipped': 0}, 'trips': {'inserted': 1, 'skipped': 0},
+                      'participants': {'inserted': 2, 'skipped': 0}, 'messages': {'inserted': 1, 'skipped': 0}}
+    api.tokens.clear()
+    trip, = api.get('ela', 'all-trips').get_json()
+    assert trip['trip_name'] == 'Rome' and sorted(trip['participants']) == ['ala', 'ela']
+    assert api.get('ela', 'search?q=rom').get_json()[0]['trip_id'] == trip_id
+    assert ''.join(export_ndjson()) == exported
+
+
+def test_import_hashes_passwords(api, database_url):
+    import_ndjson(ndjson({'table': 'users', 'username': 'ala', 'password': 'secret'}))
+    api.login('ala', 'secret')
+
+
+def test_import_stops_at_bad_line(database_url):
+    with pytest.raises(InvalidImportLine) as error:
+        import_ndjson(ndjson({'table': 'users', 'username': 'ala', 'password_hash': 'x'}) + ['{nope\n'])
+    assert error.value.line_number == 2
+    with pytest.raises(InvalidImportLine):
+        import_ndjson(ndjson({'table': 'trips', 'trip_id': 1, 'trip_name': 'x', 'date_from': 'june',
+                              'date_to': '2020-06-01', 'owner_name': 'ala'}))
+
+
+def test_import_needs_referenced_rows(database_url):
+    with pytest.raises(InvalidImportLine) as error:
+        import_ndjson(io.StringIO(''.join(ndjson({'table': 'participants', 'trip_id': 5, 'username': 'ala'}))))
+    assert error.value.line_number == 1
+
+
+def test_admin_routes_need_secret(client):
+    assert client.get('/api/admin/export').status_code == 401
+    assert client.post('/api/admin/import', data='').status_code == 401
+
+
+@pytest.mark.parametrize('row, reason', [
+    ({'table': 'users', 'username': 'ela', 'password_hash': None}, 'password_hash must be a string'),
+    ({'table': 'trips', 'trip_id': '1', 'trip_name': 'x', 'date_from': None, 'date_to': None, 'owner_name': 'ala'},
+     'trip_id must be an integer'),
+    ({'table': 'participants', 'trip_id': True, 'username': 'ala'}, 'trip_id must be an integer'),
+    ({'table': 'messages', 'trip_id': 1, 'username': 'ala', 'text': None, 'created_at': '2020-06-01T10:00:00'},
+     'text must be a string'),
+    ({'table': 'messages', 'trip_id': 1, 'username': 'ala', 'text': 'hi', 'created_at': 'noon'},
+     'created_at must be an ISO date and time'),
+])
+def test_import_reports_wrong_types_instead_of_skipping(database_url, row, reason):
+    with pytest.raises(InvalidImportLine) as error:
+        import_ndjson(ndjson({'table': 'users', 'username': 'ala', 'password_hash': 'x'}, row))
+    assert (error.value.line_number, error.value.reason) == (2, reason)
+
+
+def test_import_reports_line_the_database_refuses(database_url):
+    rows = ndjson({'table': 'users', 'username': 'ala', 'password_hash': 'x'},
+                  {'table': 'trips', 'trip_id': 1, 'trip_name': 'x', 'date_from': '2020-06-01',
+                   'date_to': '2020-06-02', 'owner_name': 'ala'},
+                  {'table': 'participants', 'trip_id': 1, 'username': 'ala'},
+                  {'table': 'participants', 'trip_id': 1, 'username': 'ala'},
+                  {'table': 'participants', 'trip_id': 1, 'username': 'ghost'})
+    with pytest.raises(InvalidImportLine) as error:
+        import_ndjson(rows)
+    assert (error.value.line_number, error.value.reason) == (5, 'references a missing user or trip')
+    counts = import_ndjson(rows[:4])
+    assert counts['users'] == {'inserted': 0, 'skipped': 1}
+    assert counts['participants'] == {'inserted': 1, 'skipped': 1}
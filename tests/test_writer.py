@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+import config
+from db import base
+from db.writer import WriteQueue, run_write
+
+
+def insert_user(username):
+    def job(session):
+        session.execute(text("INSERT INTO users (username, password_hash, version) VALUES (:username, 'x', 0)"),
+                        {'username': username})
+        return username
+    return job
+
+
+def usernames():
+    with base.engine.connect() as connection:
+        return sorted(u for (u,) in connection.execute(text('SELECT username FROM users')))
+
+
+def test_run_write_commits_without_queue(database_url):
+    assert run_write(insert_user('ala')) == 'ala'
+    assert usernames() == ['ala']
+
+
+def test_queued_jobs_share_commits_and_fail_alone(database_url):
+    queue = WriteQueue(max_batch=64, max_wait=0.05)
+    results = {}
+
+    def submit(username):
+        try:
+            results[username] = queue.submit(insert_user(username))
+        except IntegrityError as e:
+            results[username] = e
+
+    run_write(insert_user('taken'))
+    threads = [threading.Thread(target=submit, args=(username,)) for username in ('ala', 'ela', 'taken', 'ola')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert isinstance(results.pop('taken'), IntegrityError)
+    assert results == {'ala': 'ala', 'ela': 'ela', 'ola': 'ola'}
+    assert usernames() == ['ala', 'ela', 'ola', 'taken']
+
+
+def test_routes_write_through_queue(api, client, monkeypatch):
+    monkeypatch.setattr(config, 'WRITE_QUEUE_ENABLED', True)
+    api.create_user('ala')
+    api.create_user('ela')
+    trip_id = api.create_trip('ala', ['ela'])
+    response = api.request('POST', 'ela', 'trip/%d/messages' % trip_id, json={'text': 'hi'})
+    assert response.status_code == 201
+    assert sorted(client.get('/api/trip/%d/participants' % trip_id).get_json()['Participants']) == ['ala', 'ela']
+
+
+def test_user_and_trip_routes_write_only_on_writer_thread(api, client, monkeypatch):
+    monkeypatch.setattr(config, 'WRITE_QUEUE_ENABLED', True)
+    writing_threads = set()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            writing_threads.add(threading.current_thread().name)
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        api.create_user('ala')
+        api.create_user('ela')
+        assert client.post('/api/user/create', json={'username': 'ala', 'password': 'x'}).status_code == 400
+        trip_id = api.create_trip('ala')
+        response = api.request('PUT', 'ala', 'trip/%d/update' % trip_id,
+                               json={'trip_name': 'Rome', 'participants': ['ela']})
+        assert response.get_json() == {'Response': 'OK', 'Participants': {'ela': 'added'}}
+        assert api.request('PUT', 'ela', 'trip/%d/update' % trip_id, json={'trip_name': 'x'}).status_code == 403
+        assert api.request('DELETE', 'ela', 'trip/%d/delete' % trip_id).status_code == 403
+        response = api.request('PUT', 'ela', 'change-password', json={'password': 'password', 'new_password': 'new'})
+        assert response.status_code == 201
+        assert api.request('DELETE', 'ala', 'trip/%d/delete' % trip_id).status_code == 201
+        assert api.request('DELETE', 'ala', 'delete').status_code == 201
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+    assert writing_threads == {'sqlite-writer'}
+    assert usernames() == ['ela']
+    api.login('ela', 'new')
+
+
+def test_failing_job_is_rolled_back(database_url):
+    def job(session):
+        insert_user('ala')(session)
+        raise ValueError()
+    with pytest.raises(ValueError):
+        run_write(job)
+    assert usernames() == []